@@ -0,0 +1,94 @@
+"""
+Benchmark: recording ticks into the candle store and serving /market/candles ranges.
+
+Records `--days` of 5 s ticks for `--symbols` instruments into a temporary directory,
+then times range queries on a store opened fresh (as after a restart). Memory is split
+into anonymous RSS (heap: what the store costs) and file-backed RSS (mapped history pages
+the kernel can drop at any time).
+
+    python benchmarks/bench_candles.py --symbols 200 --days 7
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from candles import CandleStore  # noqa: E402
+from market_engine import MarketEngine  # noqa: E402
+
+TICK_MS = 5000
+
+
+def rss_mb():
+    """(anonymous, file-backed) resident memory of this process in MB, from /proc (Linux only)."""
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("RssAnon:", "RssFile:")):
+                key, kb, _ = line.split()
+                values[key] = int(kb) / 1024
+    return values.get("RssAnon:", 0.0), values.get("RssFile:", 0.0)
+
+
+def directory_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.stat(os.path.join(root, name)).st_blocks * 512 for name in files)  # Files are sparse
+    return total / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--symbols", type=int, default=200)
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="novatrade-candles-")
+    try:
+        engine = MarketEngine({"BTCUSD": {"price": 60000.00, "change_24h": 0.0, "type": "crypto"}},
+                              extra_symbols=args.symbols - 1, seed=1)
+        store = CandleStore(directory, engine.symbols)
+        ticks = int(args.days * 86_400_000 / TICK_MS)
+        start_ms = 1_700_000_000_000
+        anon_before, _ = rss_mb()
+        elapsed = 0.0
+        for k in range(ticks):
+            snapshot = engine.step()
+            snapshot.epoch_ms = start_ms + k * TICK_MS
+            t = time.perf_counter()
+            store.record(snapshot)
+            elapsed += time.perf_counter() - t
+        store.flush()
+        anon_after, file_after = rss_mb()
+        print(f"{ticks} ticks x {len(engine.symbols)} symbols ({args.days:g} days at {TICK_MS / 1000:g} s)")
+        print(f"record         {elapsed / ticks * 1e6:8.1f} us/tick")
+        print(f"on disk        {directory_mb(directory):8.1f} MB")
+        print(f"RSS anon       {anon_after - anon_before:+8.1f} MB while recording (file-backed: {file_after:.1f} MB)")
+        del store
+
+        rng = random.Random(42)
+        t = time.perf_counter()
+        store = CandleStore(directory, engine.symbols)  # As after a restart: nothing is read up front
+        open_ms = (time.perf_counter() - t) * 1e3
+        bars = store.bars["1m"].count
+        for label in ("cold", "warm"):
+            t = time.perf_counter()
+            for _ in range(args.queries):
+                first = start_ms + rng.randrange(bars) * 60_000
+                store.candles(engine.symbols[rng.randrange(len(engine.symbols))], "1m", start=first, limit=500)
+            print(f"query 1m {label:5} {(time.perf_counter() - t) / args.queries * 1e6:8.1f} us (500 bars of {bars})")
+        anon_final, file_final = rss_mb()
+        print(f"reopen         {open_ms:8.2f} ms")
+        print(f"RSS anon       {anon_final - anon_before:+8.1f} MB after queries (file-backed: {file_final:.1f} MB)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark: order book operations and per-tick matching with a deep book.
+
+Rests `--orders` limit orders on one symbol (bids below the market, asks above it),
+cancels a third of them, then times the tick that sweeps through the crossed levels
+and a quiet tick that crosses nothing. Everything must fit well inside the 5 s tick.
+
+    python benchmarks/bench_orderbook.py --orders 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from market_engine import MarketEngine  # noqa: E402
+from orderbook import BUY, SELL, MatchingEngine, Order  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--spread", type=float, default=0.05, help="orders rest within +/- this fraction of the price")
+    args = parser.parse_args()
+
+    engine = MarketEngine({"BTCUSD": {"price": 60000.00, "change_24h": 0.0, "type": "crypto"}}, seed=1)
+    price = engine.snapshot.price("BTCUSD")
+    rng = random.Random(42)
+    book = MatchingEngine(liquidity_usd=float("inf"))  # Unlimited liquidity: worst case, every crossed order fills
+    orders = []
+    for i in range(args.orders):
+        side = BUY if i % 2 else SELL
+        offset = rng.uniform(0, args.spread) * price
+        orders.append(Order(str(i), f"user{i % 1000}", "BTCUSD", side,
+                            price - offset if side == BUY else price + offset, 0.01, ""))
+
+    start = time.perf_counter()
+    for order in orders:
+        book.add(order)
+    add_us = (time.perf_counter() - start) / len(orders) * 1e6
+
+    cancelled = orders[::3]
+    start = time.perf_counter()
+    for order in cancelled:
+        book.cancel(order)
+    cancel_us = (time.perf_counter() - start) / len(cancelled) * 1e6
+
+    timings = []
+    for _ in range(3):
+        snapshot = engine.step()
+        start = time.perf_counter()
+        fills = book.match(snapshot)
+        timings.append(((time.perf_counter() - start) * 1e3, len(fills)))
+
+    print(f"{args.orders} resting orders on one symbol")
+    print(f"add          {add_us:8.2f} us/order")
+    print(f"cancel       {cancel_us:8.2f} us/order")
+    for n, (ms, fills) in enumerate(timings, 1):
+        print(f"tick {n}      {ms:8.2f} ms  ({fills} fills)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark: PositionStore vs the old list-of-dicts portfolio structure.
+
+Measures memory held by the positions and the cost of the lookup execute_trade does
+(find one user's holding of one asset), plus the open/close cycle that used list.remove.
+
+    python benchmarks/bench_positions.py --users 2000 --holdings 200
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from positions import PositionStore  # noqa: E402
+
+
+def build_list_db(users, assets):
+    db = {}
+    for uid in users:
+        db[uid] = [{"asset_id": a, "quantity": 1.0, "average_buy_price": 100.0} for a in assets]
+    return db
+
+
+def build_store(users, assets):
+    store = PositionStore()
+    for uid in users:
+        for a in assets:
+            store.buy(uid, a, 1.0, 100.0)
+    return store
+
+
+def measure_memory(builder, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = builder(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def time_per_op(fn, operations):
+    start = time.perf_counter()
+    for args in operations:
+        fn(*args)
+    return (time.perf_counter() - start) / len(operations) * 1e9  # ns/op
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--holdings", type=int, default=100, help="positions per user")
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+
+    users = [f"user{i}" for i in range(args.users)]
+    assets = [f"SIM{i:05d}" for i in range(args.holdings)]
+    rng = random.Random(42)
+    operations = [(rng.choice(users), rng.choice(assets)) for _ in range(args.lookups)]
+
+    list_db, list_bytes = measure_memory(build_list_db, users, assets)
+    store, store_bytes = measure_memory(build_store, users, assets)
+
+    def list_lookup(uid, asset_id):
+        return next((item for item in list_db[uid] if item["asset_id"] == asset_id), None)
+
+    def list_close_reopen(uid, asset_id):
+        portfolio = list_db[uid]
+        item = next(item for item in portfolio if item["asset_id"] == asset_id)
+        portfolio.remove(item)
+        portfolio.append(item)
+
+    def store_close_reopen(uid, asset_id):
+        store.sell(uid, asset_id, 1.0)
+        store.buy(uid, asset_id, 1.0, 100.0)
+
+    positions = args.users * args.holdings
+    print(f"{args.users} users x {args.holdings} holdings = {positions} positions")
+    print(f"{'':24}{'list-of-dicts':>16}{'PositionStore':>16}")
+    print(f"{'memory (bytes/position)':24}{list_bytes / positions:>16.1f}{store_bytes / positions:>16.1f}")
+    print(f"{'lookup (ns/op)':24}{time_per_op(list_lookup, operations):>16.0f}"
+          f"{time_per_op(store.get, operations):>16.0f}")
+    print(f"{'close+reopen (ns/op)':24}{time_per_op(list_close_reopen, operations):>16.0f}"
+          f"{time_per_op(store_close_reopen, operations):>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark: durable trade commits per second for each storage configuration.
+
+Every simulated trade commits the same three ops execute_trade does (user balance,
+position, transaction record). `--concurrency` trades are in flight at once, which is
+what lets the SQLite writer group them into one transaction and one fsync.
+
+    python benchmarks/bench_storage.py --trades 5000 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage, SQLiteStorage  # noqa: E402
+
+
+async def run(storage, trades: int, concurrency: int) -> float:
+    seq = iter(range(1, trades + 1))
+
+    async def worker(w: int):
+        uid = f"user{w}"
+        user = {"id": w, "firebase_uid": uid, "email": None, "full_name": None, "is_active": True,
+                "balance_usd": 10000.0}
+        for n in seq:
+            user["balance_usd"] -= 1.0
+            record = {"seq": n, "type": "BUY", "asset_id": "BTCUSD", "quantity": 0.001, "price": 60000.0}
+            await storage.commit([("user", dict(user)), ("position", uid, "BTCUSD", n * 0.001, 60000.0),
+                                  ("transaction", uid, record)])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await storage.close()
+    return trades / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trades", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    configs = [
+        ("memory (durability off)", lambda path: MemoryStorage()),
+        ("sqlite synchronous=OFF", lambda path: SQLiteStorage(path, synchronous="OFF")),
+        ("sqlite FULL, no grouping", lambda path: SQLiteStorage(path, synchronous="FULL", max_batch=1)),
+        ("sqlite FULL, group commit", lambda path: SQLiteStorage(path, synchronous="FULL")),
+    ]
+    print(f"{args.trades} trades, concurrency {args.concurrency}")
+    for name, factory in configs:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = factory(os.path.join(tmp, "bench.db"))
+            rate = asyncio.run(run(storage, args.trades, args.concurrency))
+            groups = getattr(storage, "groups", 0)
+            per_group = f"{args.trades / groups:.1f} trades/transaction" if groups else ""
+            print(f"{name:28}{rate:>12.0f} trades/s  {per_group}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Benchmark: bytes per tick and encode time per tick for each wire format.
+
+Steps a market of `--symbols` instruments and encodes what one tick costs on the wire:
+the market_update delta every client receives, a full market_snapshot, and the
+/market/prices body. "stdlib json" is the encoding path from before wire.py, as fanout.py
+and market_engine.py had it (StdlibEncoder); "json" and "msgpack" are the codecs in
+wire.py. Every format pays for formatting the tick's ISO timestamp once, as the old
+snapshot did when it was built. Encode time includes assembling the per-client update for
+`--clients` sockets. The formats take turns on each tick, after one warmup tick, so none
+of them gets warmer caches than the others.
+
+    python benchmarks/bench_wire.py --symbols 1000 --clients 100
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from market_engine import MarketEngine  # noqa: E402
+from wire import CODECS, JSON_CODEC, MSGPACK_SUBPROTOCOL  # noqa: E402
+
+ASSETS = {
+    "BTCUSD": {"price": 60000.00, "change_24h": 1.5, "type": "crypto"},
+    "EURUSD": {"price": 1.0850, "change_24h": 0.1, "type": "forex"},
+}
+
+
+class StdlibEncoder:
+    """The encoding fanout.py and MarketSnapshot used before wire.py, copied from them."""
+
+    def __init__(self):
+        self._symbol_json_cache = {}
+
+    def update(self, snapshot, indices, clients):
+        timestamp = datetime.fromtimestamp(snapshot.epoch_ms / 1000, timezone.utc).isoformat()  # Once per tick
+        # One encoded delta row per changed symbol, shared by every client that wants it
+        symbols = snapshot.symbols
+        prices, changes = snapshot.prices.tolist(), snapshot.change_24h.tolist()
+        price_changed, change_changed = snapshot.price_changed.tolist(), snapshot.change_changed.tolist()
+        symbol_json = self._symbol_json
+        fragments = {}
+        for i in indices:
+            symbol = symbols[i]
+            if price_changed[i] and change_changed[i]:
+                fragments[symbol] = f'{{"symbol":{symbol_json(symbol)},"price":{prices[i]!r},"change_24h":{changes[i]!r}}}'
+            elif price_changed[i]:
+                fragments[symbol] = f'{{"symbol":{symbol_json(symbol)},"price":{prices[i]!r}}}'
+            else:
+                fragments[symbol] = f'{{"symbol":{symbol_json(symbol)},"change_24h":{changes[i]!r}}}'
+        header = f',"tick":{snapshot.tick},"timestamp":"{timestamp}","data":['
+        shared_body = ",".join(fragments.values())
+        return [f'{{"type":"market_update","seq":{seq}{header}{shared_body}]}}' for seq in range(clients)]
+
+    def snapshot(self, snapshot):
+        return self.encode_message({"type": "market_snapshot", "seq": 1, "tick": snapshot.tick,
+                                    "data": self.rows(snapshot)})
+
+    def rest_body(self, snapshot):
+        fragments = [json.dumps(row, separators=(",", ":")).encode() for row in self.rows(snapshot)]
+        return b"[" + b",".join(fragments) + b"]"
+
+    @staticmethod
+    def rows(snapshot):
+        timestamp = datetime.fromtimestamp(snapshot.epoch_ms / 1000, timezone.utc).isoformat()
+        return [{"symbol": symbol, "price": price, "change_24h": change, "timestamp": timestamp}
+                for symbol, price, change in zip(snapshot.symbols, snapshot.prices.tolist(),
+                                                 snapshot.change_24h.tolist())]
+
+    @staticmethod
+    def encode_message(message):
+        return json.dumps(message, separators=(",", ":"))
+
+    def _symbol_json(self, symbol):
+        try:
+            return self._symbol_json_cache[symbol]
+        except KeyError:
+            encoded = self._symbol_json_cache[symbol] = json.dumps(symbol)
+            return encoded
+
+
+def codec_update(codec, snapshot, indices, clients):
+    fragments = codec.delta_fragments(snapshot, indices)
+    header = codec.update_header(snapshot)
+    body = codec.join(list(fragments.values()))
+    return [codec.update(seq, header, body) for seq in range(clients)]
+
+
+def size(payload) -> int:
+    return len(payload.encode() if isinstance(payload, str) else payload)
+
+
+def timed(rows, ticks):
+    """
+    Per row, (mean us per call, bytes of its payload) over `ticks` fresh snapshots. The rows
+    take turns on each tick, starting from a different row every time, and each result is
+    freed before the next row runs, so no format is favoured by running first or by the heap.
+    """
+    totals = [0.0] * len(rows)
+    sizes = [0] * len(rows)
+    for n, (snapshot, indices) in enumerate(ticks):
+        for r in range(len(rows)):
+            r = (r + n) % len(rows)
+            start = time.perf_counter()
+            result = rows[r][2](snapshot, indices)
+            if n:  # The first tick is a warmup
+                totals[r] += time.perf_counter() - start
+            sizes[r] = size(result[0])
+            del result
+    return [(total / (len(ticks) - 1) * 1e6, nbytes) for total, nbytes in zip(totals, sizes)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--symbols", type=int, default=1000, help="synthetic symbols on top of the built-in ones")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=50, help="measured ticks (plus one warmup)")
+    args = parser.parse_args()
+
+    engine = MarketEngine(ASSETS, extra_symbols=args.symbols, seed=1)
+    ticks = []
+    for _ in range(args.ticks + 1):
+        snapshot = engine.step()
+        ticks.append((snapshot, snapshot.changed_indices()))
+    msgpack_codec = CODECS[MSGPACK_SUBPROTOCOL]
+    stdlib = StdlibEncoder()
+
+    def fresh(snapshot):  # Undo the per-snapshot caches so every format pays for its own encoding
+        snapshot._timestamp = snapshot._rows = snapshot._fragments = snapshot._body = None
+        return snapshot
+
+    rows = [
+        ("market_update", "stdlib json", lambda s, i: stdlib.update(s, i, args.clients)),
+        ("market_update", "json", lambda s, i: codec_update(JSON_CODEC, fresh(s), i, args.clients)),
+        ("market_update", "msgpack", lambda s, i: codec_update(msgpack_codec, fresh(s), i, args.clients)),
+        ("market_snapshot", "stdlib json", lambda s, i: [stdlib.snapshot(s)]),
+        ("market_snapshot", "json", lambda s, i: [JSON_CODEC.snapshot(1, fresh(s))]),
+        ("market_snapshot", "msgpack", lambda s, i: [msgpack_codec.snapshot(1, fresh(s))]),
+        ("/market/prices", "stdlib json", lambda s, i: [stdlib.rest_body(s)]),
+        ("/market/prices", "json", lambda s, i: [fresh(s).encoded_rows()]),
+    ]
+    print(f"{len(engine.symbols)} symbols, {args.clients} clients, mean over {args.ticks} ticks")
+    print(f"{'message':16} {'format':12} {'bytes/tick':>11} {'encode us/tick':>15}")
+    for (message, name, _), (us, nbytes) in zip(rows, timed(rows, ticks)):
+        print(f"{message:16} {name:12} {nbytes:11d} {us:15.1f}")
+
+
+if __name__ == "__main__":
+    main()
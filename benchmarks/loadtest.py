@@ -0,0 +1,480 @@
+"""
+Load test: the real server under a configurable mix of HTTP and WebSocket clients, offline.
+
+Starts uvicorn on a free local port (`--workers` processes) with everything in a temp dir
+(SQLite, ledger spill, candle history, tick bus). Instead of a Firebase project, the server
+trusts a throwaway RSA key generated here (TokenVerifier.pin_certs), and this script signs
+Firebase-shaped ID tokens with it, so auth runs its normal path: cache, then local RS256 check.
+
+Every user is created (GET /users/me) before measuring. Then `--concurrency` HTTP loops pick
+requests by `--mix` weights while `--ws-clients` authenticated sockets read market data, and
+after `--warmup` seconds everything is measured for `--duration` seconds:
+
+  * throughput and p50/p99/p999 latency per request type, with status codes
+  * WebSocket fan-out lag: arrival time of each market_update minus its tick's timestamp
+  * server RSS (all worker processes) at the start and end of the measured window, and peak
+
+The load generator shares the box with the server; its own CPU time is reported so a
+saturated client can be told apart from a slow server. Results are JSON (stdout, or
+--output), with the commit and configuration, and --compare prints the change from an
+earlier results file.
+
+    python benchmarks/loadtest.py --duration 30 --concurrency 64 --ws-clients 200 --output run.json
+    python benchmarks/loadtest.py --mix prices=70,trade=30 --workers 2 --compare run.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import httpx  # noqa: E402
+import msgpack  # noqa: E402
+import numpy as np  # noqa: E402
+import orjson  # noqa: E402
+import websockets  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from google.auth import crypt, jwt  # noqa: E402
+
+from wire import MSGPACK_SUBPROTOCOL  # noqa: E402
+
+PROJECT_ID = "novatrade-loadtest"
+RESULTS_VERSION = 1
+OPERATIONS = ("prices", "portfolio", "trade", "transactions", "candles", "me")
+# Small orders (~$10-60) so accounts can trade for the whole run
+TRADE_SIZES = {"BTCUSD": 0.001, "ETHUSD": 0.01, "EURUSD": 10.0, "TSLA": 0.1}
+
+
+class LocalIssuer:
+    """Signs Firebase-shaped RS256 ID tokens with a throwaway key; the server pins its public half."""
+
+    def __init__(self, private_pem: bytes):
+        key = serialization.load_pem_private_key(private_pem, password=None)
+        self.private_pem = private_pem
+        self.public_pem = key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode("ascii")
+        self.kid = hashlib.sha256(self.public_pem.encode("ascii")).hexdigest()[:16]
+        self._signer = crypt.RSASigner.from_string(private_pem, key_id=self.kid)
+
+    @classmethod
+    def generate(cls) -> "LocalIssuer":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        return cls(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()))
+
+    @classmethod
+    def load(cls, path: str) -> "LocalIssuer":
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def token(self, uid: str, ttl_seconds: int = 6 * 3600) -> str:
+        now = int(time.time())
+        claims = {"iss": f"https://securetoken.google.com/{PROJECT_ID}", "aud": PROJECT_ID, "sub": uid,
+                  "iat": now, "exp": now + ttl_seconds, "auth_time": now, "email": f"{uid}@example.com"}
+        return jwt.encode(self._signer, claims).decode("ascii")
+
+
+def create_app():
+    """Server side, run by uvicorn in each worker (--factory): the real app, trusting the load test's key."""
+    import firebase_admin
+    import main
+
+    issuer = LocalIssuer.load(os.environ["NOVATRADE_LOADTEST_KEY"])
+    if not firebase_admin._apps:  # No service account offline; a project id is all verification needs
+        firebase_admin.initialize_app(options={"projectId": PROJECT_ID})
+    main.token_verifier.pin_certs({issuer.kid: issuer.public_pem}, PROJECT_ID)
+    return main.app
+
+
+# --- Measurement ---
+class Recorder:
+    def __init__(self):
+        self.measuring = False
+        self.latencies = {op: [] for op in OPERATIONS}  # ms
+        self.statuses = {op: Counter() for op in OPERATIONS}
+        self.fanout_lag: list = []  # ms
+        self.ws_messages = 0
+        self.ws_seq_gaps = 0
+        self.ws_disconnects = 0
+
+    def request(self, op: str, started: float, status):
+        if self.measuring:
+            self.latencies[op].append((time.perf_counter() - started) * 1000)
+            self.statuses[op][str(status)] += 1
+
+
+def summarize(values) -> dict:
+    if not values:
+        return {"count": 0}
+    array = np.asarray(values, dtype=np.float64)
+    p50, p99, p999 = np.percentile(array, [50, 99, 99.9]).tolist()
+    return {"count": len(values), "mean": float(array.mean()), "p50": p50, "p99": p99, "p999": p999,
+            "max": float(array.max())}
+
+
+def server_pids(root_pid: int) -> list:
+    """The uvicorn process and its workers (found through /proc, Linux only)."""
+    children: dict = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids, queue = [], [root_pid]
+    while queue:
+        pid = queue.pop()
+        pids.append(pid)
+        queue.extend(children.get(pid, []))
+    return pids
+
+
+def rss_mb(pids) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+# --- Clients ---
+async def http_client(client: httpx.AsyncClient, tokens, mix, recorder: Recorder, rng: random.Random, stop):
+    ops, weights = zip(*mix.items())
+    symbols = list(TRADE_SIZES)
+    while not stop.is_set():
+        op = rng.choices(ops, weights)[0]
+        headers = {"Authorization": f"Bearer {rng.choice(tokens)}"}
+        started = time.perf_counter()
+        try:
+            if op == "prices":
+                response = await client.get("/market/prices", headers=headers)
+            elif op == "portfolio":
+                response = await client.get("/portfolio", headers=headers)
+            elif op == "trade":
+                asset_id = rng.choice(symbols)
+                response = await client.post("/trade/execute", headers=headers, json={
+                    "asset_id": asset_id, "quantity": TRADE_SIZES[asset_id],
+                    "trade_type": "BUY" if rng.random() < 0.6 else "SELL"})
+            elif op == "transactions":
+                response = await client.get("/transactions", params={"limit": 50}, headers=headers)
+            elif op == "candles":
+                response = await client.get("/market/candles", params={"symbol": rng.choice(symbols)},
+                                            headers=headers)
+            else:
+                response = await client.get("/users/me", headers=headers)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        recorder.request(op, started, status)
+
+
+async def ws_client(url: str, protocol: str, recorder: Recorder, stop):
+    subprotocols = [MSGPACK_SUBPROTOCOL] if protocol == "msgpack" else None
+    while not stop.is_set():
+        try:
+            async with websockets.connect(url, subprotocols=subprotocols, max_size=None) as ws:
+                last_seq = None
+                while not stop.is_set():
+                    try:
+                        frame = await asyncio.wait_for(ws.recv(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        continue
+                    received_ms = time.time() * 1000
+                    message = msgpack.unpackb(frame) if isinstance(frame, bytes) else orjson.loads(frame)
+                    message_type = message.get("type")
+                    if message_type not in ("market_update", "market_snapshot"):
+                        continue
+                    seq = message["seq"]
+                    if recorder.measuring and last_seq is not None and seq != last_seq + 1:
+                        recorder.ws_seq_gaps += 1
+                    last_seq = seq
+                    if message_type == "market_update" and recorder.measuring:
+                        recorder.ws_messages += 1
+                        if "ts" in message:
+                            tick_ms = message["ts"]
+                        else:
+                            tick_ms = datetime.fromisoformat(message["timestamp"]).timestamp() * 1000
+                        recorder.fanout_lag.append(received_ms - tick_ms)
+        except (OSError, websockets.WebSocketException):
+            if recorder.measuring:
+                recorder.ws_disconnects += 1
+            await asyncio.sleep(0.5)
+
+
+# --- Server ---
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, directory: str, key_path: str, port: int,
+                 extra_env: Optional[dict] = None) -> subprocess.Popen:
+    env = dict(os.environ,
+               NOVATRADE_LOADTEST_KEY=key_path,
+               NOVATRADE_WORKERS=str(args.workers),
+               NOVATRADE_BUS_PATH=os.path.join(directory, "bus.sock"),
+               NOVATRADE_DB_PATH=os.path.join(directory, "novatrade.db"),
+               NOVATRADE_DB_SYNCHRONOUS=args.db_synchronous,
+               NOVATRADE_LEDGER_DIR=os.path.join(directory, "ledger_spill"),
+               NOVATRADE_HISTORY_DIR=os.path.join(directory, "history"),
+               NOVATRADE_SIM_SYMBOLS=str(args.symbols),
+               NOVATRADE_TICK_INTERVAL=str(args.tick_interval))
+    if not getattr(args, "rate_limits", False):  # Every client here shares one IP; measure the server, not the limiter
+        env.update(NOVATRADE_IP_RATE="0", NOVATRADE_USER_RATE="0", NOVATRADE_WS_CONNECT_RATE="0",
+                   NOVATRADE_MAX_INFLIGHT="1000000")
+    env.update(extra_env or {})
+    env.pop("FIREBASE_AUTH_EMULATOR_HOST", None)
+    log = open(os.path.join(directory, "server.log"), "wb")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "loadtest:create_app", "--factory", "--app-dir", BENCH_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+async def wait_ready(base_url: str, token: str, server: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            try:
+                response = await client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"server not ready after {timeout:.0f}s")
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args, mix) -> dict:
+    directory = tempfile.mkdtemp(prefix="novatrade-loadtest-")
+    server = None
+    try:
+        issuer = LocalIssuer.generate()
+        key_path = os.path.join(directory, "signing-key.pem")
+        with open(key_path, "wb") as f:
+            f.write(issuer.private_pem)
+        tokens = [issuer.token(f"loadtest-{i}") for i in range(args.users)]
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server = start_server(args, directory, key_path, port)
+        await wait_ready(base_url, tokens[0], server)
+        pids = server_pids(server.pid)
+
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+            # Create every account up front so first-touch user creation is not measured
+            gate = asyncio.Semaphore(args.concurrency)
+
+            async def create(token):
+                async with gate:
+                    await client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+            await asyncio.gather(*(create(token) for token in tokens))
+
+            recorder = Recorder()
+            stop = asyncio.Event()
+            rng = random.Random(args.seed)
+            ws_url = f"ws://127.0.0.1:{port}/ws/market-data?max_rate={args.ws_max_rate}&"
+            tasks = [asyncio.create_task(ws_client(f"{ws_url}token={tokens[i % len(tokens)]}", args.ws_protocol,
+                                                   recorder, stop)) for i in range(args.ws_clients)]
+            tasks += [asyncio.create_task(http_client(client, tokens, mix, recorder, random.Random(rng.random()),
+                                                      stop)) for _ in range(args.concurrency)]
+            await asyncio.sleep(args.warmup)
+
+            pids = server_pids(server.pid)
+            rss_start = peak = rss_mb(pids)
+            cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.perf_counter()
+            recorder.measuring = True
+            while time.perf_counter() - started < args.duration:
+                await asyncio.sleep(min(1.0, args.duration - (time.perf_counter() - started)))
+                peak = max(peak, rss_mb(pids))
+            recorder.measuring = False
+            elapsed = time.perf_counter() - started
+            cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+            rss_end = rss_mb(pids)
+            stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        endpoints = {}
+        for op in mix:
+            endpoints[op] = {"requests": len(recorder.latencies[op]),
+                             "rps": len(recorder.latencies[op]) / elapsed,
+                             "latency_ms": summarize(recorder.latencies[op]),
+                             "status": dict(recorder.statuses[op])}
+        total = sum(e["requests"] for e in endpoints.values())
+        client_cpu = (cpu_end.ru_utime + cpu_end.ru_stime) - (cpu_start.ru_utime + cpu_start.ru_stime)
+        return {
+            "version": RESULTS_VERSION,
+            "commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "config": {**vars(args), "mix": mix, "cpus": os.cpu_count()},
+            "duration_seconds": elapsed,
+            "throughput_rps": total / elapsed,
+            "endpoints": endpoints,
+            "websocket": {"clients": args.ws_clients, "protocol": args.ws_protocol,
+                          "market_updates": recorder.ws_messages, "seq_gaps": recorder.ws_seq_gaps,
+                          "disconnects": recorder.ws_disconnects, "fanout_lag_ms": summarize(recorder.fanout_lag)},
+            "memory_mb": {"server_processes": len(pids), "start": rss_start, "end": rss_end, "peak": peak,
+                          "growth": rss_end - rss_start},
+            "client_cpu_seconds": client_cpu,
+        }
+    except Exception:
+        log_path = os.path.join(directory, "server.log")
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                sys.stderr.write(f.read()[-4000:].decode("utf-8", "replace"))
+        raise
+    finally:
+        if server is not None and server.poll() is None:
+            os.killpg(server.pid, signal.SIGTERM)
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                os.killpg(server.pid, signal.SIGKILL)
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+        else:
+            print(f"Kept {directory}", file=sys.stderr)
+
+
+# --- Reporting ---
+def print_summary(results: dict, out=sys.stderr):
+    print(f"commit {results['commit']}: {results['throughput_rps']:.1f} req/s over "
+          f"{results['duration_seconds']:.1f}s", file=out)
+    print(f"{'request':14} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}  status", file=out)
+    for op, e in results["endpoints"].items():
+        lat = e["latency_ms"]
+        if lat["count"]:
+            print(f"{op:14} {e['rps']:9.1f} {lat['p50']:9.2f} {lat['p99']:9.2f} {lat['p999']:9.2f}  "
+                  f"{dict(e['status'])}", file=out)
+        else:
+            print(f"{op:14} {0:9.1f} {'-':>9} {'-':>9} {'-':>9}", file=out)
+    ws = results["websocket"]
+    lag = ws["fanout_lag_ms"]
+    if lag["count"]:
+        print(f"{'fan-out lag':14} {ws['market_updates']:9d} {lag['p50']:9.2f} {lag['p99']:9.2f} {lag['p999']:9.2f}  "
+              f"({ws['clients']} {ws['protocol']} clients, {ws['seq_gaps']} seq gaps, {ws['disconnects']} disconnects)",
+              file=out)
+    mem = results["memory_mb"]
+    print(f"server RSS {mem['start']:.1f} -> {mem['end']:.1f} MB (peak {mem['peak']:.1f}, "
+          f"growth {mem['growth']:+.1f}) across {mem['server_processes']} process(es); "
+          f"load generator CPU {results['client_cpu_seconds']:.1f}s", file=out)
+
+
+def print_comparison(base: dict, results: dict, out=sys.stderr):
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"vs {base.get('commit', '?')}:", file=out)
+    print(f"  throughput   {base['throughput_rps']:.1f} -> {results['throughput_rps']:.1f} req/s "
+          f"({change(base['throughput_rps'], results['throughput_rps'])})", file=out)
+    for op, e in results["endpoints"].items():
+        old = base.get("endpoints", {}).get(op, {}).get("latency_ms", {})
+        new = e["latency_ms"]
+        if old.get("count") and new.get("count"):
+            print(f"  {op:12} p99 {old['p99']:.2f} -> {new['p99']:.2f} ms ({change(old['p99'], new['p99'])})",
+                  file=out)
+    old_lag = base.get("websocket", {}).get("fanout_lag_ms", {})
+    new_lag = results["websocket"]["fanout_lag_ms"]
+    if old_lag.get("count") and new_lag.get("count"):
+        print(f"  fan-out lag  p99 {old_lag['p99']:.2f} -> {new_lag['p99']:.2f} ms "
+              f"({change(old_lag['p99'], new_lag['p99'])})", file=out)
+    print(f"  memory       growth {base['memory_mb']['growth']:+.1f} -> {results['memory_mb']['growth']:+.1f} MB",
+          file=out)
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown request type {name!r} (choose from {', '.join(OPERATIONS)})")
+        try:
+            mix[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight in {part!r}")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one positive weight")
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds of load before measuring")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32, help="HTTP requests in flight")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("prices=40,portfolio=20,trade=20,transactions=20"),
+                        help=f"request weights, e.g. prices=40,trade=20 (types: {', '.join(OPERATIONS)})")
+    parser.add_argument("--ws-clients", type=int, default=100)
+    parser.add_argument("--ws-protocol", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--ws-max-rate", type=float, default=0.0,
+                        help="market updates per second each socket asks for (0: every tick)")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--symbols", type=int, default=0, help="extra simulated symbols (NOVATRADE_SIM_SYMBOLS)")
+    parser.add_argument("--tick-interval", type=float, default=1.0, help="seconds between market ticks")
+    parser.add_argument("--db-synchronous", default="FULL", help="NOVATRADE_DB_SYNCHRONOUS for the server")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the server's admission control on (off by default: all clients share 127.0.0.1)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the temp dir (server log, database)")
+    args = parser.parse_args()
+    mix = args.mix
+    del args.mix
+
+    results = asyncio.run(run(args, mix))
+    print_summary(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Abuse scenario: do well-behaved users keep their latency while abusive clients are throttled?
+
+Starts the real server (see loadtest.py: temp dir, locally signed tokens) twice, once with
+admission control off and once with it on, and runs the same two phases against each:
+
+  1. baseline: `--users` well-behaved users, each sending `--user-rps` requests per second
+     (prices, portfolio, small trades) from 127.0.0.1, as one office behind a NAT would
+  2. abuse: the same users, plus a separate process flooding the server from other
+     loopback addresses: one account in a tight loop (127.0.0.2), anonymous requests with
+     junk tokens (127.0.0.3) and WebSocket connect/disconnect churn (127.0.0.4)
+
+The well-behaved users' p50/p99 latency and status codes are measured from this process in
+both phases; the abusers report what they got back. With limits on, the run passes when the
+users saw no 429/503 and their p99 under abuse stayed within `--max-slowdown` times the
+baseline (plus `--slack-ms`, for a noisy shared box); the exit status is 1 otherwise.
+Results are JSON (stdout, or --output).
+
+    python benchmarks/ratelimit_scenario.py --duration 15 --users 20 --abusers 32
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import httpx  # noqa: E402
+import websockets  # noqa: E402
+
+from loadtest import TRADE_SIZES, LocalIssuer, free_port, start_server, summarize, wait_ready  # noqa: E402
+
+USER_SOURCE, FLOOD_SOURCE, ANONYMOUS_SOURCE, CONNECT_SOURCE = "127.0.0.1", "127.0.0.2", "127.0.0.3", "127.0.0.4"
+LIMITS_OFF = {"NOVATRADE_IP_RATE": "0", "NOVATRADE_USER_RATE": "0", "NOVATRADE_WS_CONNECT_RATE": "0",
+              "NOVATRADE_MAX_INFLIGHT": "1000000"}
+
+
+# --- Well-behaved users ---
+async def paced_user(client: httpx.AsyncClient, token: str, interval: float, rng: random.Random,
+                     record, stop: asyncio.Event):
+    headers = {"Authorization": f"Bearer {token}"}
+    symbols = list(TRADE_SIZES)
+    next_at = time.perf_counter() + rng.random() * interval  # Spread the users out
+    while not stop.is_set():
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        next_at += interval
+        roll = rng.random()
+        started = time.perf_counter()
+        try:
+            if roll < 0.5:
+                response = await client.get("/market/prices", headers=headers)
+            elif roll < 0.8:
+                response = await client.get("/portfolio", headers=headers)
+            else:
+                asset_id = rng.choice(symbols)
+                response = await client.post("/trade/execute", headers=headers, json={
+                    "asset_id": asset_id, "quantity": TRADE_SIZES[asset_id],
+                    "trade_type": "BUY" if rng.random() < 0.6 else "SELL"})
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        record(started, status)
+
+
+async def measure(base_url: str, tokens, args, seconds: float) -> dict:
+    """Runs the paced users for `seconds` (after a short warmup) and summarizes what they saw."""
+    latencies, statuses = [], Counter()
+    measuring = False
+
+    def record(started, status):
+        if measuring:
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[str(status)] += 1
+
+    stop = asyncio.Event()
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=len(tokens), max_keepalive_connections=len(tokens))
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+        tasks = [asyncio.create_task(paced_user(client, token, 1.0 / args.user_rps, random.Random(rng.random()),
+                                                record, stop)) for token in tokens]
+        await asyncio.sleep(args.warmup)
+        measuring = True
+        await asyncio.sleep(seconds)
+        measuring = False
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"requests": len(latencies), "latency_ms": summarize(latencies), "status": dict(statuses)}
+
+
+# --- Abusers (a separate process, so their client work doesn't slow the measured users) ---
+async def flood(base_url: str, source: str, token: str, concurrency: int, deadline: float) -> dict:
+    statuses = Counter()
+    transport = httpx.AsyncHTTPTransport(local_address=source, limits=httpx.Limits(max_connections=concurrency))
+    async with httpx.AsyncClient(base_url=base_url, transport=transport, timeout=30.0) as client:
+        headers = {"Authorization": f"Bearer {token}"}
+
+        async def loop():
+            while time.monotonic() < deadline:
+                try:
+                    statuses[str((await client.get("/portfolio", headers=headers)).status_code)] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+        await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return dict(statuses)
+
+
+async def connect_flood(ws_url: str, concurrency: int, deadline: float) -> dict:
+    outcomes = Counter()
+
+    async def loop():
+        while time.monotonic() < deadline:
+            try:
+                async with websockets.connect(ws_url, local_addr=(CONNECT_SOURCE, 0), open_timeout=10):
+                    outcomes["connected"] += 1
+            except websockets.InvalidStatus as e:
+                outcomes[str(e.response.status_code)] += 1
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                outcomes[type(e).__name__] += 1
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return dict(outcomes)
+
+
+def run_abusers(base_url: str, ws_url: str, token: str, concurrency: int, seconds: float, results):
+    async def abuse():
+        deadline = time.monotonic() + seconds
+        started = time.monotonic()
+        user, anonymous, connects = await asyncio.gather(
+            flood(base_url, FLOOD_SOURCE, token, concurrency, deadline),
+            flood(base_url, ANONYMOUS_SOURCE, "not-a-token", concurrency, deadline),
+            connect_flood(ws_url, max(1, concurrency // 8), deadline))
+        elapsed = time.monotonic() - started
+        return {name: {"rps": sum(statuses.values()) / elapsed, "status": statuses}
+                for name, statuses in (("user_flood", user), ("anonymous_flood", anonymous),
+                                       ("connect_flood", connects))}
+    results.put(asyncio.run(abuse()))
+
+
+# --- Scenario ---
+async def scenario(args, limits_on: bool) -> dict:
+    directory = tempfile.mkdtemp(prefix="novatrade-ratelimit-")
+    server = None
+    try:
+        issuer = LocalIssuer.generate()
+        key_path = os.path.join(directory, "signing-key.pem")
+        with open(key_path, "wb") as f:
+            f.write(issuer.private_pem)
+        tokens = [issuer.token(f"user-{i}") for i in range(args.users)]
+        abuser_token = issuer.token("abuser")
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        limits = {"NOVATRADE_IP_RATE": str(args.ip_rate), "NOVATRADE_IP_BURST": str(args.ip_rate * 2)}
+        server = start_server(args, directory, key_path, port, limits if limits_on else LIMITS_OFF)
+        await wait_ready(base_url, tokens[0], server)
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            for token in tokens + [abuser_token]:  # Create the accounts; the abuser's buys succeed
+                await client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+
+        baseline = await measure(base_url, tokens, args, args.duration)
+        results = multiprocessing.get_context("spawn").Queue()
+        abusers = multiprocessing.get_context("spawn").Process(
+            target=run_abusers, args=(base_url, f"ws://127.0.0.1:{port}/ws/market-data", abuser_token,
+                                      args.abusers, args.warmup + args.duration + 1.0, results))
+        abusers.start()
+        await asyncio.sleep(1.0)  # Let the flood build up before measuring
+        under_abuse = await measure(base_url, tokens, args, args.duration)
+        abuse = await asyncio.get_running_loop().run_in_executor(None, results.get, True, 60)
+        abusers.join(timeout=10)
+        return {"limits": limits_on, "baseline": baseline, "under_abuse": under_abuse, "abusers": abuse}
+    except Exception:
+        log_path = os.path.join(directory, "server.log")
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                sys.stderr.write(f.read()[-4000:].decode("utf-8", "replace"))
+        raise
+    finally:
+        if server is not None and server.poll() is None:
+            os.killpg(server.pid, signal.SIGTERM)
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                os.killpg(server.pid, signal.SIGKILL)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def verdict(run: dict, args) -> list:
+    """Why the run with limits on fails the scenario; empty when it passes."""
+    problems = []
+    refused = {code: count for code, count in run["under_abuse"]["status"].items() if code in ("429", "503")}
+    if refused:
+        problems.append(f"well-behaved users were refused: {refused}")
+    base_p99 = run["baseline"]["latency_ms"].get("p99", 0.0)
+    p99 = run["under_abuse"]["latency_ms"].get("p99", 0.0)
+    if p99 > base_p99 * args.max_slowdown + args.slack_ms:
+        problems.append(f"p99 under abuse {p99:.1f} ms vs {base_p99:.1f} ms baseline")
+    if "429" not in run["abusers"]["user_flood"]["status"]:
+        problems.append("the flooding account was never throttled")
+    return problems
+
+
+def print_summary(runs, out=sys.stderr):
+    print(f"{'limits':8} {'phase':15} {'p50 ms':>9} {'p99 ms':>9}  users' status codes", file=out)
+    for run in runs:
+        for phase in ("baseline", "under_abuse"):
+            result = run[phase]
+            latency = result["latency_ms"]
+            print(f"{'on' if run['limits'] else 'off':8} {phase:15} {latency.get('p50', 0):9.2f} "
+                  f"{latency.get('p99', 0):9.2f}  {result['status']}", file=out)
+        for name, abuser in run["abusers"].items():
+            print(f"{'':8} {name:15} {abuser['rps']:9.1f}/s  {abuser['status']}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=15.0, help="measured seconds per phase")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of user traffic before measuring")
+    parser.add_argument("--users", type=int, default=20, help="well-behaved users")
+    parser.add_argument("--user-rps", type=float, default=4.0, help="requests per second per user")
+    parser.add_argument("--abusers", type=int, default=32, help="concurrent requests per flooding source")
+    parser.add_argument("--ip-rate", type=float, default=400.0,
+                        help="NOVATRADE_IP_RATE with limits on; the users share one address")
+    parser.add_argument("--max-slowdown", type=float, default=2.0, help="allowed p99 ratio, abuse vs baseline")
+    parser.add_argument("--slack-ms", type=float, default=20.0, help="added to the allowed p99")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    args.symbols, args.tick_interval, args.db_synchronous, args.rate_limits = 0, 1.0, "NORMAL", True
+
+    runs = [asyncio.run(scenario(args, limits_on)) for limits_on in (False, True)]
+    print_summary(runs)
+    problems = verdict(runs[1], args)
+    for problem in problems:
+        print(f"FAIL: {problem}", file=sys.stderr)
+    encoded = json.dumps({"config": vars(args), "runs": runs, "passed": not problems}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
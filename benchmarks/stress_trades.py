@@ -0,0 +1,152 @@
+"""
+Stress check: thousands of concurrent trades through the real /trade/execute handler.
+
+Fires `--trades` market BUY/SELL orders from `--users` accounts with up to `--concurrency`
+requests in flight (through the ASGI app, with auth stubbed out and SQLite storage in a
+temp dir, so every trade really awaits its commit). Buys are sized so that an account
+running two trades at once could overspend. Afterwards, for every account:
+
+  * balance == starting balance - sum(buys) + sum(sells) recorded in its ledger, and >= 0
+  * each position == bought - sold for that asset
+  * the state reloaded from storage matches the in-memory state
+
+Exits non-zero if any check fails, or if any trade was refused with 429/503 (rate limits
+are turned off here, so that would mean the run tested less than it claims).
+
+    python benchmarks/stress_trades.py --users 50 --trades 5000 --concurrency 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+_tmp = tempfile.mkdtemp(prefix="novatrade-stress-")
+os.environ["NOVATRADE_DB_PATH"] = os.path.join(_tmp, "stress.db")
+os.environ["NOVATRADE_LEDGER_DIR"] = os.path.join(_tmp, "ledger_spill")
+os.environ["NOVATRADE_HISTORY_DIR"] = os.path.join(_tmp, "history")
+# Every request comes from one client address; measure the trade path, not the rate limiter
+os.environ.update(NOVATRADE_IP_RATE="0", NOVATRADE_USER_RATE="0", NOVATRADE_MAX_INFLIGHT="1000000")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from fastapi import Request  # noqa: E402
+
+import main  # noqa: E402
+
+STARTING_BALANCE = 10000.00  # What get_current_active_user gives new accounts
+ASSETS = ["BTCUSD", "ETHUSD", "TSLA"]
+TOLERANCE = 1e-6
+
+
+async def stub_firebase_data(request: Request) -> dict:
+    uid = request.headers["x-stress-user"]
+    return {"uid": uid, "email": f"{uid}@example.com"}
+
+
+async def fire(args) -> Counter:
+    rng = random.Random(args.seed)
+    prices = {asset: main.market_engine.snapshot.price(asset) for asset in ASSETS}
+    users = [f"stress{i}" for i in range(args.users)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    outcomes: Counter = Counter()
+
+    async def one(client: httpx.AsyncClient, uid: str, asset: str, trade_type: str, quantity: float):
+        async with semaphore:
+            response = await client.post("/trade/execute", headers={"x-stress-user": uid},
+                                         json={"asset_id": asset, "trade_type": trade_type, "quantity": quantity})
+        if response.status_code == 200:
+            outcomes["ok"] += 1
+        elif response.status_code in (429, 503):  # Admission control: the trade never ran
+            outcomes[f"refused ({response.status_code})"] += 1
+        else:
+            outcomes[response.json().get("detail")] += 1
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://stress") as client:
+        trades = []
+        for _ in range(args.trades):
+            asset = rng.choice(ASSETS)
+            if rng.random() < 0.6:  # Each buy spends 20-45% of the starting balance
+                quantity = STARTING_BALANCE * rng.uniform(0.2, 0.45) / prices[asset]
+                trades.append(one(client, rng.choice(users), asset, "BUY", quantity))
+            else:
+                quantity = STARTING_BALANCE * rng.uniform(0.05, 0.3) / prices[asset]
+                trades.append(one(client, rng.choice(users), asset, "SELL", quantity))
+        start = time.perf_counter()
+        await asyncio.gather(*trades)
+        elapsed = time.perf_counter() - start
+    print(f"{args.trades} trades from {args.users} accounts, concurrency {args.concurrency}: "
+          f"{elapsed:.2f}s ({args.trades / elapsed:.0f} trades/s)")
+    return outcomes
+
+
+async def verify() -> list:
+    failures = []
+    for uid, user in main.fake_users_db.items():
+        expected_balance = STARTING_BALANCE
+        expected_positions: Counter = Counter()
+        for record in main.transaction_ledger.page(uid, limit=10 ** 9):
+            if record["type"] == "BUY":
+                expected_balance -= record["total_amount"]
+                expected_positions[record["asset_id"]] += record["quantity"]
+            elif record["type"] == "SELL":
+                expected_balance += record["total_amount"]
+                expected_positions[record["asset_id"]] -= record["quantity"]
+        if user.balance_usd < -TOLERANCE:
+            failures.append(f"{uid}: negative balance {user.balance_usd}")
+        if abs(user.balance_usd - expected_balance) > TOLERANCE:
+            failures.append(f"{uid}: balance {user.balance_usd} != ledger {expected_balance}")
+        for asset in ASSETS:
+            position = main.position_store.get(uid, asset)
+            held = position.quantity if position is not None else 0.0
+            if abs(held - expected_positions[asset]) > TOLERANCE:
+                failures.append(f"{uid}: {asset} position {held} != ledger {expected_positions[asset]}")
+
+        stored = await main.storage.load_user(uid, 10 ** 9)  # Everything, to compare with the ledger
+        stored_positions = {asset_id: quantity for asset_id, quantity, _ in stored["positions"]}
+        if abs(stored["user"]["balance_usd"] - user.balance_usd) > TOLERANCE:
+            failures.append(f"{uid}: stored balance {stored['user']['balance_usd']} != {user.balance_usd}")
+        if len(stored["transactions"]) != len(main.transaction_ledger.page(uid, limit=10 ** 9)):
+            failures.append(f"{uid}: stored transaction count differs from the ledger")
+        for position in main.position_store.holdings(uid):
+            if abs(stored_positions.pop(position.asset_id, 0.0) - position.quantity) > TOLERANCE:
+                failures.append(f"{uid}: stored {position.asset_id} position differs")
+        if stored_positions:
+            failures.append(f"{uid}: stored positions {sorted(stored_positions)} no longer held")
+    return failures
+
+
+async def run(args) -> int:
+    main.app.dependency_overrides[main.get_current_user_firebase_data] = stub_firebase_data
+    outcomes = await fire(args)
+    print("outcomes:", dict(outcomes))
+    print(f"account locks: {main.account_locks.acquisitions} acquisitions, {main.account_locks.contended} contended, "
+          f"{len(main.account_locks)} left allocated")
+    failures = await verify()
+    refused = sum(count for outcome, count in outcomes.items() if outcome.startswith("refused"))
+    if refused:
+        failures.append(f"{refused} trades refused by admission control, so they were never tested")
+    await main.storage.close()
+    shutil.rmtree(_tmp, ignore_errors=True)
+    for failure in failures[:20]:
+        print("FAIL", failure)
+    print("conservation checks:", "FAILED" if failures else f"passed for {len(main.fake_users_db)} accounts")
+    return 1 if failures else 0
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--trades", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,214 @@
+import bisect
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from market_engine import MarketSnapshot
+
+# Bar intervals served by /market/candles, in milliseconds (bars start on UTC multiples of the interval)
+INTERVALS = {"1m": 60_000, "5m": 300_000, "1h": 3_600_000, "1d": 86_400_000}
+
+_MAGIC = b"NTHIST01"
+_HEADER = np.dtype([("magic", "S8"), ("count", "<i8"), ("symbols", "<i8"), ("interval_ms", "<i8")])
+_HEADER_SIZE = 64  # Rows start here
+_MIN_CAPACITY = 1024  # Rows; files grow by doubling
+_BACKFILL_CHUNK = 65536  # Ticks folded into bars per pass when a new interval is backfilled
+
+
+def _tick_dtype(symbols: int) -> np.dtype:
+    return np.dtype([("ts", "<i8"), ("price", "<f8", (symbols,))])
+
+
+def _bar_dtype(symbols: int) -> np.dtype:
+    # volume is the tick count: the simulated market has no traded volume of its own
+    return np.dtype([("ts", "<i8"), ("volume", "<i8"), ("open", "<f8", (symbols,)), ("high", "<f8", (symbols,)),
+                     ("low", "<f8", (symbols,)), ("close", "<f8", (symbols,))])
+
+
+class _Series:
+    """
+    One append-only file of fixed-width rows, memory-mapped. Row i holds every symbol's values
+    at `ts[i]`, and `count` in the header says how many rows are complete. Only the process that
+    is recording appends; any other process mapping the same file sees new rows and remaps when
+    the file has grown.
+    """
+
+    __slots__ = ("path", "dtype", "_raw", "_header", "rows")
+
+    def __init__(self, path: str, dtype: np.dtype, symbols: int, interval_ms: int = 0):
+        self.path = path
+        self.dtype = dtype
+        if not os.path.exists(path):
+            self._create(symbols, interval_ms)
+        self._map()
+        header = self._header[0]
+        if header["magic"] != _MAGIC or header["symbols"] != symbols or header["interval_ms"] != interval_ms:
+            raise ValueError(f"{path} does not hold this series")
+
+    @property
+    def count(self) -> int:
+        count = int(self._header[0]["count"])
+        if count > len(self.rows):  # Another process grew the file
+            self._map()
+        return count
+
+    def last(self) -> Optional[int]:
+        count = self.count
+        return count - 1 if count else None
+
+    def append(self) -> int:
+        """Index of a new row past the end. It becomes visible on `commit`, once it is filled in."""
+        count = self.count
+        if count == len(self.rows):
+            os.truncate(self.path, _HEADER_SIZE + 2 * len(self.rows) * self.dtype.itemsize)
+            self._map()
+        return count
+
+    def commit(self):
+        self._header["count"] += 1
+
+    def flush(self):
+        self._raw.flush()
+
+    # --- Internals ---
+    def _create(self, symbols: int, interval_ms: int):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(np.array([(_MAGIC, 0, symbols, interval_ms)], dtype=_HEADER).tobytes())
+            f.truncate(_HEADER_SIZE + _MIN_CAPACITY * self.dtype.itemsize)
+        try:
+            os.link(tmp, self.path)  # Atomic: a concurrent worker either creates the file first or sees ours whole
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+
+    def _map(self):
+        self._raw = np.memmap(self.path, dtype=np.uint8, mode="r+")
+        raw = self._raw.view(np.ndarray)  # Plain views: np.memmap's subclass overhead shows up per field access
+        self._header = raw[:_HEADER.itemsize].view(_HEADER)
+        capacity = (len(raw) - _HEADER_SIZE) // self.dtype.itemsize
+        self.rows = raw[_HEADER_SIZE:_HEADER_SIZE + capacity * self.dtype.itemsize].view(self.dtype)
+
+
+class CandleStore:
+    """
+    Tick history and OHLCV bars for every symbol, kept in memory-mapped files.
+
+    Each tick appends one row of prices to the tick history and folds them into the current
+    bar of every interval: the bar is the last row of its file, so aggregation costs one
+    vectorized max/min over the symbols per interval and keeps no state outside the files.
+    Nothing is loaded up front; reads touch only the pages they need (binary search over the
+    timestamp column, then the requested rows), so RAM stays flat however long the history.
+
+    Files live in a subdirectory per symbol universe (the set of simulated symbols), since a
+    row's layout depends on it. An interval without a file yet is backfilled from the ticks.
+    """
+
+    def __init__(self, directory: str, symbols: tuple, intervals: Optional[Dict[str, int]] = None):
+        universe = hashlib.sha1("\n".join(symbols).encode("utf-8")).hexdigest()[:12]
+        self.directory = os.path.join(directory, universe)
+        os.makedirs(self.directory, exist_ok=True)
+        symbols_path = os.path.join(self.directory, "symbols.json")
+        if not os.path.exists(symbols_path):
+            with open(symbols_path, "w") as f:
+                json.dump(list(symbols), f)
+        self.symbols = symbols
+        self.index = {symbol: i for i, symbol in enumerate(symbols)}
+        self.intervals = dict(INTERVALS if intervals is None else intervals)
+        self.ticks = _Series(os.path.join(self.directory, "ticks.bin"), _tick_dtype(len(symbols)), len(symbols))
+        self.bars: Dict[str, _Series] = {}
+        for name, interval_ms in self.intervals.items():
+            path = os.path.join(self.directory, f"bars_{name}.bin")
+            backfill = not os.path.exists(path)
+            self.bars[name] = _Series(path, _bar_dtype(len(symbols)), len(symbols), interval_ms)
+            if backfill and self.ticks.count:
+                self._backfill(name)
+        # Counters
+        self.ticks_recorded = 0
+
+    def record(self, snapshot: MarketSnapshot):
+        """Appends the snapshot's prices to the tick history and every interval's current bar."""
+        ticks = self.ticks
+        row = ticks.append()
+        ticks.rows["ts"][row] = snapshot.epoch_ms
+        ticks.rows["price"][row] = snapshot.prices
+        ticks.commit()
+        for name, series in self.bars.items():
+            self._fold(series, self.intervals[name], snapshot.epoch_ms, snapshot.prices, snapshot.prices,
+                       snapshot.prices, snapshot.prices, 1)
+        self.ticks_recorded += 1
+
+    def candles(self, symbol: str, interval: str, start: Optional[int] = None, end: Optional[int] = None,
+                limit: int = 500) -> List[Dict[str, Any]]:
+        """
+        Bars of `symbol` whose open time (epoch ms) is in [start, end], oldest first, at most `limit`:
+        the first ones after `start` if it is given, otherwise the latest ones up to `end`.
+        """
+        series = self.bars[interval]
+        column = self.index[symbol]
+        count = series.count
+        ts = series.rows["ts"]  # Strided view into the file; bisect reads ~log2(count) entries of it
+        lo = 0 if start is None else bisect.bisect_left(ts, start, 0, count)
+        hi = count if end is None else bisect.bisect_right(ts, end, lo, count)
+        if hi - lo > limit:
+            if start is None:
+                lo = hi - limit
+            else:
+                hi = lo + limit
+        rows = series.rows[lo:hi]
+        return [
+            {"time": t, "open": o, "high": h, "low": l, "close": c, "volume": v}
+            for t, o, h, l, c, v in zip(rows["ts"].tolist(), rows["open"][:, column].tolist(),
+                                        rows["high"][:, column].tolist(), rows["low"][:, column].tolist(),
+                                        rows["close"][:, column].tolist(), rows["volume"].tolist())
+        ]
+
+    def flush(self):
+        """Writes dirty pages back to the files (they survive a process crash regardless; this covers the OS)."""
+        self.ticks.flush()
+        for series in self.bars.values():
+            series.flush()
+
+    # --- Internals ---
+    @staticmethod
+    def _fold(series: _Series, interval_ms: int, ts: int, open_, high, low, close, volume: int):
+        """Merges one bar's worth of prices into the series: into the last bar if it covers `ts`, else a new one."""
+        start = ts - ts % interval_ms
+        last = series.last()
+        rows = series.rows
+        if last is not None and rows["ts"][last] >= start:  # Same bar (or the clock stepped back)
+            np.maximum(rows["high"][last], high, out=rows["high"][last])
+            np.minimum(rows["low"][last], low, out=rows["low"][last])
+            rows["close"][last] = close
+            rows["volume"][last] += volume
+            return
+        row = series.append()
+        rows = series.rows  # May have been remapped
+        rows["ts"][row] = start
+        rows["volume"][row] = volume
+        rows["open"][row] = open_
+        rows["high"][row] = high
+        rows["low"][row] = low
+        rows["close"][row] = close
+        series.commit()
+
+    def _backfill(self, name: str):
+        """Builds a new interval's bars from the recorded ticks, a chunk of ticks at a time."""
+        series, interval_ms = self.bars[name], self.intervals[name]
+        total = self.ticks.count
+        for chunk_start in range(0, total, _BACKFILL_CHUNK):
+            ticks = self.ticks.rows[chunk_start:min(chunk_start + _BACKFILL_CHUNK, total)]
+            ts, prices = ticks["ts"], ticks["price"]
+            buckets = ts - ts % interval_ms
+            starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+            ends = np.r_[starts[1:], len(ts)]
+            highs = np.maximum.reduceat(prices, starts, axis=0)
+            lows = np.minimum.reduceat(prices, starts, axis=0)
+            for i, (first, stop) in enumerate(zip(starts.tolist(), ends.tolist())):
+                self._fold(series, interval_ms, int(ts[first]), prices[first], highs[i], lows[i], prices[stop - 1],
+                           stop - first)
+        print(f"Backfilled {series.count} {name} bars from {total} recorded ticks.")
@@ -0,0 +1,194 @@
+import asyncio
+import base64
+import fcntl
+import itertools
+import os
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from tickbus import LocalTickBus
+
+# Paths whose responses do not depend on who is asking; every worker serves them itself
+PUBLIC_PATH_PREFIXES = ("/market/", "/metrics")
+FORWARD_TIMEOUT_SECONDS = 30.0
+
+
+def claim_worker_slot(path_prefix: str, workers: int) -> int:
+    """
+    Picks this process's worker id: the first of `<path_prefix>.worker<N>.lock` it can flock.
+    The lock is held for the life of the process, so a restarted worker takes over the free id.
+    """
+    for worker_id in range(workers):
+        fd = os.open(f"{path_prefix}.worker{worker_id}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue
+        return worker_id  # fd intentionally left open: closing it would release the slot
+    raise RuntimeError(f"All {workers} worker slots are taken; is NOVATRADE_WORKERS lower than --workers?")
+
+
+def first_sequence_number(start: int, worker_id: int, workers: int) -> int:
+    """Smallest number >= `start` in this worker's share (worker_id mod workers) of an id sequence."""
+    return start + (worker_id - start) % workers
+
+
+def owner_of(firebase_uid: str, workers: int) -> int:
+    """The worker that holds this user's state. Stable across processes (unlike hash())."""
+    return zlib.crc32(firebase_uid.encode("utf-8")) % workers
+
+
+class WorkerRouter:
+    """
+    Keeps each user's state in exactly one worker.
+
+    Every user belongs to worker `owner_of(uid)`. That worker alone loads the user, executes
+    their trades and settles their orders, so the per-worker caches never diverge. Requests
+    that reach another worker are forwarded over the tick bus to the owner, which runs them
+    through its own ASGI app. Public market routes are served by whichever worker receives them.
+    """
+
+    def __init__(self, bus: LocalTickBus, resolve_uid: Callable[[dict, str], Awaitable[Optional[str]]]):
+        self.bus = bus
+        self.resolve_uid = resolve_uid  # (scope, bearer token) -> uid (None if invalid)
+        self.app = None  # The full ASGI app, which serves requests forwarded here
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        # Counters
+        self.forwarded = 0
+        self.served_for_peers = 0
+
+    def owns(self, firebase_uid: str) -> bool:
+        return owner_of(firebase_uid, self.bus.workers) == self.bus.worker_id
+
+    def owner(self, firebase_uid: str) -> int:
+        return owner_of(firebase_uid, self.bus.workers)
+
+    async def forward(self, owner: int, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Runs an HTTP request on `owner` and returns {"status", "headers", "body"}."""
+        request_id = (self.bus.worker_id << 48) | next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        self.forwarded += 1
+        self.bus.send({"type": "http_request", "id": request_id, "from": self.bus.worker_id, **request}, to=owner)
+        try:
+            return await asyncio.wait_for(future, FORWARD_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            return _error_response(504, "Owning worker did not answer")
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def handle_message(self, message: Dict[str, Any]) -> bool:
+        """Handles the router's bus messages; returns False for anything else."""
+        message_type = message.get("type")
+        if message_type == "http_request":
+            self.served_for_peers += 1
+            response = await self._serve_forwarded(message)
+            self.bus.send({"type": "http_response", "id": message["id"], **response}, to=message["from"])
+        elif message_type in ("http_response", "undeliverable"):
+            future = self._pending.get(message["id"])
+            if future is not None and not future.done():
+                if message_type == "undeliverable":
+                    future.set_result(_error_response(503, "Owning worker is not connected"))
+                else:
+                    future.set_result(message)
+        else:
+            return False
+        return True
+
+    async def _serve_forwarded(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": message["method"],
+            "scheme": "http",
+            "path": message["path"],
+            "raw_path": message["path"].encode("utf-8"),
+            "query_string": message["query_string"].encode("latin-1"),
+            "root_path": "",
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in message["headers"]],
+            "client": ("127.0.0.1", 0),
+            "server": None,
+            "novatrade.forwarded": True,  # Already at the owner: RoutingMiddleware must not forward again
+        }
+        body = base64.b64decode(message["body"])
+        finished = asyncio.Event()
+        response: Dict[str, Any] = {"status": 500, "headers": [], "body": b""}
+
+        async def receive():
+            nonlocal body
+            if body is not None:
+                chunk, body = body, None
+                return {"type": "http.request", "body": chunk, "more_body": False}
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(event):
+            if event["type"] == "http.response.start":
+                response["status"] = event["status"]
+                response["headers"] = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in event.get("headers", [])]
+            elif event["type"] == "http.response.body":
+                response["body"] += event.get("body", b"")
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception as e:
+            print(f"Error serving forwarded request {message['method']} {message['path']}: {e}")
+            return _error_response(500, "Internal Server Error")
+        finally:
+            finished.set()
+        response["body"] = base64.b64encode(response["body"]).decode("ascii")
+        return response
+
+
+def _error_response(status_code: int, detail: str) -> Dict[str, Any]:
+    body = ('{"detail":"%s"}' % detail).encode("utf-8")
+    return {"status": status_code, "headers": [("content-type", "application/json")],
+            "body": base64.b64encode(body).decode("ascii")}
+
+
+class RoutingMiddleware:
+    """
+    ASGI middleware that forwards authenticated HTTP requests to the worker owning the user.
+    With a single worker it only adds one comparison per request.
+    """
+
+    def __init__(self, app, router: WorkerRouter):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        router = self.router
+        if (scope["type"] != "http" or router.bus.workers == 1 or scope.get("novatrade.forwarded")
+                or scope["path"].startswith(PUBLIC_PATH_PREFIXES)):
+            return await self.app(scope, receive, send)
+        token = bearer_token(scope)
+        firebase_uid = await router.resolve_uid(scope, token) if token else None
+        if firebase_uid is None or router.owns(firebase_uid):  # Served here (invalid tokens get their 401 here too)
+            return await self.app(scope, receive, send)
+
+        body = b""
+        more_body = True
+        while more_body:
+            event = await receive()
+            body += event.get("body", b"")
+            more_body = event.get("more_body", False)
+        response = await router.forward(router.owner(firebase_uid), {
+            "method": scope["method"],
+            "path": scope["path"],
+            "query_string": scope.get("query_string", b"").decode("latin-1"),
+            "headers": [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]],
+            "body": base64.b64encode(body).decode("ascii"),
+        })
+        await send({"type": "http.response.start", "status": response["status"],
+                    "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in response["headers"]]})
+        await send({"type": "http.response.body", "body": base64.b64decode(response["body"])})
+
+
+def bearer_token(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            return token if scheme.lower() == "bearer" and token else None
+    return None
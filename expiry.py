@@ -0,0 +1,62 @@
+import time
+from typing import Dict, Hashable, List, Optional
+
+
+class TimingWheel:
+    """
+    Keys with an expiry time (epoch seconds), expired in O(1) amortized per key.
+
+    Time is cut into `resolution`-second ticks over a ring of `slots` buckets, and a key
+    lives in the bucket of the tick it expires in. `advance(now)` visits only the buckets
+    of the ticks that passed since the last call, so its cost is the number of keys that
+    expire plus one step per elapsed tick, however many keys are waiting. `schedule` and
+    `cancel` are dict operations. Keys due more than one revolution ahead (slots x
+    resolution seconds) share a bucket with nearer ones and are skipped until their turn;
+    size the ring to cover the usual TTL so that stays rare.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 4096, now: Optional[float] = None):
+        self.resolution = resolution
+        self._slots: List[Dict[Hashable, float]] = [{} for _ in range(slots)]
+        self._slot_of: Dict[Hashable, int] = {}
+        self._next_tick = int((time.time() if now is None else now) // resolution)  # First tick not yet swept
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._slot_of
+
+    def schedule(self, key: Hashable, expires_at: float):
+        """Adds `key`, or moves it if it was already scheduled."""
+        self.cancel(key)
+        tick = max(int(expires_at // self.resolution), self._next_tick)  # Already due: picked up by the next advance
+        slot = tick % len(self._slots)
+        self._slots[slot][key] = expires_at
+        self._slot_of[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        slot = self._slot_of.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        return True
+
+    def advance(self, now: Optional[float] = None) -> List[Hashable]:
+        """Removes and returns the keys due at `now` (default: the current time)."""
+        if now is None:
+            now = time.time()
+        current = int(now // self.resolution)
+        first = max(self._next_tick, current - len(self._slots) + 1)  # After a long pause, every bucket once
+        expired: List[Hashable] = []
+        for tick in range(first, current + 1):
+            bucket = self._slots[tick % len(self._slots)]
+            if not bucket:
+                continue
+            due = [key for key, expires_at in bucket.items() if expires_at <= now]
+            for key in due:
+                del bucket[key]
+                del self._slot_of[key]
+            expired.extend(due)
+        self._next_tick = current  # The current tick's bucket may still hold keys due later in the tick
+        return expired
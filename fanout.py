@@ -0,0 +1,409 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from fastapi import WebSocket
+
+from market_engine import MarketSnapshot
+from wire import JSON_CODEC, JSONCodec, negotiate
+
+# What to do when a client's outgoing queue is full
+SLOW_CONSUMER_DROP = "drop"  # Disconnect the client; it can reconnect and get a fresh snapshot
+SLOW_CONSUMER_CONFLATE = "conflate"  # Discard the client's pending updates and queue one fresh snapshot instead
+
+# Market updates per second a client may ask for with set_max_rate; requests outside are clamped
+MIN_MAX_RATE = 0.1
+MAX_MAX_RATE = 100.0
+
+
+class ClientConnection:
+    """One connected socket with its own bounded outgoing queue, drained by its own writer task."""
+
+    __slots__ = ("websocket", "codec", "queue", "writer", "closed", "symbols", "seq", "uid", "auth_expires_at",
+                 "min_interval", "due_at", "sent_tick", "pending_portfolio")
+
+    def __init__(self, websocket: WebSocket, queue_size: int, codec: JSONCodec = JSON_CODEC):
+        self.websocket = websocket
+        self.codec = codec  # Wire format, picked by subprotocol when the socket was accepted (see wire.py)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.symbols: Optional[Set[str]] = None  # None = every symbol (clients that never sent "subscribe")
+        self.seq = 0  # Sequence number of the last market message queued for this client
+        self.uid: Optional[str] = None  # Firebase UID once the client authenticated for its portfolio channel
+        self.auth_expires_at = 0.0  # `exp` of the ID token it authenticated with
+        # Conflated clients (see ConnectionManager.set_max_rate); min_interval 0 = every tick
+        self.min_interval = 0.0
+        self.due_at = 0.0  # Monotonic time its next update is due; 0 while it has no entry in the due heap
+        self.sent_tick = 0  # Tick its market data is up to date with
+        self.pending_portfolio: Optional[Union[str, bytes]] = None  # Latest portfolio_update not sent yet
+
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+
+class ConnectionManager:
+    """
+    Fans market data out to WebSocket clients.
+
+    Clients subscribe to symbols; a symbol -> subscribers index means each tick only
+    touches interested sockets, and clients that never subscribed get every symbol.
+    `publish_snapshot` encodes one delta fragment per changed symbol (using the
+    snapshot's change masks) for each wire codec in use, and each client's message is
+    assembled from its codec's fragments. Every market message carries a per-client `seq`;
+    a client that sees a gap can ask for a fresh snapshot.
+
+    Authenticated clients additionally get their own portfolio channel, fed through
+    `publish_to_user`.
+
+    A client can cap its update rate (`set_max_rate`). It then leaves the per-tick indexes
+    and costs nothing on ticks until its next update is due: the manager keeps the tick each
+    symbol last changed in, and at the due time the client gets one update with the latest
+    values of every subscribed symbol that changed since its previous one (full rows, as
+    several ticks are folded together). Its portfolio_update messages are conflated the
+    same way; other private messages (order_update) are never held back.
+
+    Sends never block the publisher: each client has a bounded queue drained by its
+    own writer task. When a queue is full the slow-consumer policy decides whether the
+    client is dropped or its pending updates are replaced by one fresh snapshot.
+    """
+
+    def __init__(self, queue_size: int = 32, slow_consumer_policy: str = SLOW_CONSUMER_CONFLATE):
+        if slow_consumer_policy not in (SLOW_CONSUMER_DROP, SLOW_CONSUMER_CONFLATE):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        self.all_symbols_subscribers: Set[ClientConnection] = set()
+        self.symbol_subscribers: Dict[str, Set[ClientConnection]] = {}
+        self.user_connections: Dict[str, Set[ClientConnection]] = {}  # firebase_uid -> authenticated clients
+        self.snapshot: Optional[MarketSnapshot] = None  # Last published tick
+        self.last_changed: Optional[np.ndarray] = None  # Per symbol, the last tick its price or change moved
+        self.conflated_clients: Set[ClientConnection] = set()
+        self._due: List[Tuple[float, int, ClientConnection]] = []  # Heap of conflated clients by due time
+        self._due_closed = 0  # Entries of clients that disconnected, dropped when they come due or on compaction
+        self._due_order = itertools.count()  # Tie-breaker, so clients themselves are never compared
+        self._closing: Set[asyncio.Task] = set()  # Closes of dropped clients; the loop only keeps weak references
+        # Returns the current portfolio message for a user; used to resync conflated clients
+        self.portfolio_source: Optional[Callable[[str], Dict[str, Any]]] = None
+        # Called with a firebase_uid when its last authenticated client goes (disconnect, expiry or re-auth)
+        self.on_user_gone: Optional[Callable[[str], None]] = None
+        # Counters
+        self.messages_enqueued = 0
+        self.messages_conflated = 0
+        self.clients_dropped = 0
+        self.send_errors = 0
+
+    async def connect(self, websocket: WebSocket) -> ClientConnection:
+        codec = negotiate(websocket.scope.get("subprotocols") or ())
+        await websocket.accept(subprotocol=codec.subprotocol)
+        client = ClientConnection(websocket, self.queue_size, codec)
+        client.writer = asyncio.create_task(self._writer(client))
+        self.active_connections[websocket] = client
+        self.all_symbols_subscribers.add(client)
+        if self.snapshot is not None:
+            greeting = codec.greeting(self.snapshot)
+            if greeting is not None:
+                self._offer(client, greeting)
+        return client
+
+    def disconnect(self, websocket: WebSocket):
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return  # Already removed (e.g. writer hit a send error first)
+        client.closed = True
+        self._unindex(client)
+        if client.writer is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+
+    async def send_personal_message(self, message: Dict[str, Any], websocket: WebSocket):
+        """Queues a message for one client, behind anything already pending for it."""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self._offer(client, client.codec.encode(message))
+
+    # --- Per-user portfolio channel ---
+    def authenticate(self, websocket: WebSocket, firebase_uid: str, expires_at: float):
+        """Binds the client to `firebase_uid`; re-authenticating (e.g. with a refreshed token) extends it."""
+        client = self.active_connections[websocket]
+        if client.uid is not None and client.uid != firebase_uid:
+            self._remove_user_connection(client)
+        client.uid = firebase_uid
+        client.auth_expires_at = expires_at
+        self.user_connections.setdefault(firebase_uid, set()).add(client)
+
+    def publish_to_user(self, firebase_uid: str, message: Dict[str, Any]):
+        """Queues a message on every authenticated connection of one user (encoded once per codec)."""
+        clients = self.user_connections.get(firebase_uid)
+        if not clients:
+            return
+        payloads: Dict[JSONCodec, Union[str, bytes]] = {}
+        now = time.time()
+        for client in list(clients):
+            if client.auth_expires_at <= now:  # Stop pushing private data on an expired token
+                self._remove_user_connection(client)
+                self._offer(client, client.codec.encode(
+                    {"type": "error", "detail": "ID token has expired. Please re-authenticate."}))
+                continue
+            payload = payloads.get(client.codec)
+            if payload is None:
+                payload = payloads[client.codec] = client.codec.encode(message)
+            if client.min_interval and message.get("type") == "portfolio_update":
+                client.pending_portfolio = payload  # Only the latest matters; sent with its next update
+            else:
+                self._offer(client, payload)
+
+    # --- Subscriptions ---
+    def subscribe(self, websocket: WebSocket, symbols: Iterable[str]) -> List[str]:
+        """Adds symbols to the client's subscription and returns the ones it did not have yet."""
+        client = self.active_connections[websocket]
+        if client.symbols is None:  # First explicit subscribe narrows the client from "everything"
+            self.all_symbols_subscribers.discard(client)
+            client.symbols = set()
+        added = [s for s in dict.fromkeys(symbols) if s not in client.symbols]
+        for symbol in added:
+            client.symbols.add(symbol)
+            if not client.min_interval:
+                self.symbol_subscribers.setdefault(symbol, set()).add(client)
+        return added
+
+    def unsubscribe(self, websocket: WebSocket, symbols: Iterable[str]):
+        client = self.active_connections[websocket]
+        if client.symbols is None:
+            self._unindex_market(client)
+            client.symbols = set(self.snapshot.symbols)
+            if not client.min_interval:
+                self._index_market(client)
+        for symbol in symbols:
+            if symbol in client.symbols:
+                client.symbols.discard(symbol)
+                self._remove_subscriber(symbol, client)
+
+    def set_max_rate(self, websocket: WebSocket, max_rate: Optional[float]):
+        """
+        Caps the client's market updates at `max_rate` per second (clamped to MIN_MAX_RATE ..
+        MAX_MAX_RATE), each carrying the latest values of the symbols that changed since the
+        previous one. None or 0: every tick. A client has at most one entry in the due heap,
+        so a new rate for a client already scheduled applies from its next update.
+        """
+        client = self.active_connections[websocket]
+        interval = 1.0 / min(max(max_rate, MIN_MAX_RATE), MAX_MAX_RATE) if max_rate else 0.0
+        if interval and not client.min_interval:
+            self._unindex_market(client)
+            self.conflated_clients.add(client)
+            client.sent_tick = self.snapshot.tick  # It got every tick so far
+        elif not interval and client.min_interval:
+            self.conflated_clients.discard(client)
+            self._index_market(client)
+            client.min_interval = 0.0
+            self._offer(client, self._encode_snapshot(client))  # Whatever was folded and not yet sent
+            if client.pending_portfolio is not None:
+                self._offer(client, client.pending_portfolio)
+                client.pending_portfolio = None
+            return
+        client.min_interval = interval
+        if interval and not client.due_at:
+            client.due_at = time.monotonic() + interval
+            heapq.heappush(self._due, (client.due_at, next(self._due_order), client))
+
+    def send_snapshot(self, websocket: WebSocket, symbols: Optional[Iterable[str]] = None):
+        """Queues full rows for `symbols` (default: the client's whole subscription)."""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self._offer(client, self._encode_snapshot(client, symbols))
+
+    # --- Publishing ---
+    def publish_snapshot(self, snapshot: MarketSnapshot):
+        """Sends each interested client only the fields that changed in this tick."""
+        self.snapshot = snapshot
+        price_changed, change_changed = snapshot.price_changed, snapshot.change_changed
+        if self.last_changed is None or len(self.last_changed) != len(snapshot):
+            self.last_changed = np.full(len(snapshot), snapshot.tick, dtype=np.int64)
+        else:
+            self.last_changed[price_changed | change_changed] = snapshot.tick
+        if not self.active_connections:
+            return
+        if self._due and self._due[0][0] <= time.monotonic():
+            self._publish_conflated(snapshot)
+
+        if self.all_symbols_subscribers:
+            indices = snapshot.changed_indices()
+        else:
+            index = snapshot.index
+            indices = [i for i in (index.get(s) for s in self.symbol_subscribers)
+                       if i is not None and (price_changed[i] or change_changed[i])]
+        if not indices:
+            return
+
+        # Per codec in use: one encoded delta row per changed symbol, shared by every client that wants it
+        encoded: Dict[JSONCodec, tuple] = {}  # codec -> (fragments by symbol, update header, every-symbol body)
+
+        def encoded_for(codec: JSONCodec) -> tuple:
+            entry = encoded.get(codec)
+            if entry is None:
+                fragments = codec.delta_fragments(snapshot, indices)
+                shared_body = codec.join(list(fragments.values())) if self.all_symbols_subscribers else None
+                entry = encoded[codec] = (fragments, codec.update_header(snapshot), shared_body)
+            return entry
+
+        for client in list(self.all_symbols_subscribers):
+            _, header, shared_body = encoded_for(client.codec)
+            self._offer_update(client, header, shared_body)
+
+        per_client: Dict[ClientConnection, List[Any]] = {}
+        for symbol, subscribers in self.symbol_subscribers.items():
+            for client in subscribers:
+                fragment = encoded_for(client.codec)[0].get(symbol)
+                if fragment is not None:
+                    per_client.setdefault(client, []).append(fragment)
+        for client, client_fragments in per_client.items():
+            self._offer_update(client, encoded_for(client.codec)[1], client.codec.join(client_fragments))
+
+    def queue_depths(self) -> Dict[str, int]:
+        depths = [client.queue.qsize() for client in self.active_connections.values()]
+        return {"max": max(depths, default=0), "total": sum(depths)}
+
+    # --- Internals ---
+    def _publish_conflated(self, snapshot: MarketSnapshot):
+        """Sends every conflated client that is due the symbols that changed since its last update."""
+        now = time.monotonic()
+        symbols, index, last_changed = snapshot.symbols, snapshot.index, self.last_changed
+        rows: Dict[JSONCodec, Dict[str, Any]] = {}  # codec -> full row fragment by symbol, shared by clients
+        headers: Dict[JSONCodec, Any] = {}
+        served: List[ClientConnection] = []
+        while self._due and self._due[0][0] <= now:
+            due_at, _, client = heapq.heappop(self._due)
+            if client.closed:
+                self._due_closed -= 1
+                continue
+            client.due_at = 0.0
+            if not client.min_interval:
+                continue  # Back to every tick
+            if client.symbols is None:
+                ids = np.flatnonzero(last_changed > client.sent_tick).tolist()
+            else:
+                subscribed = np.fromiter((index[s] for s in client.symbols), dtype=np.int64, count=len(client.symbols))
+                ids = subscribed[last_changed[subscribed] > client.sent_tick].tolist()
+            if ids:
+                codec = client.codec
+                cache = rows.setdefault(codec, {})
+                missing = [i for i in ids if symbols[i] not in cache]
+                if missing:
+                    cache.update(codec.delta_fragments(snapshot, missing, full=True))
+                header = headers.get(codec)
+                if header is None:
+                    header = headers[codec] = codec.update_header(snapshot)
+                self._offer_update(client, header, codec.join([cache[symbols[i]] for i in ids]))
+            client.sent_tick = snapshot.tick
+            if client.pending_portfolio is not None:
+                self._offer(client, client.pending_portfolio)
+                client.pending_portfolio = None
+            # Keep to the client's own schedule, unless ticks are further apart than its interval
+            client.due_at = due_at + client.min_interval
+            if client.due_at <= now:
+                client.due_at = now + client.min_interval
+            served.append(client)
+        for client in served:
+            heapq.heappush(self._due, (client.due_at, next(self._due_order), client))
+
+    def _offer_update(self, client: ClientConnection, header, body):
+        self._offer(client, client.codec.update(client.next_seq(), header, body))
+
+    def _encode_snapshot(self, client: ClientConnection, symbols: Optional[Iterable[str]] = None) -> Union[str, bytes]:
+        return client.codec.snapshot(client.next_seq(), self.snapshot, client.symbols if symbols is None else symbols)
+
+    def _offer(self, client: ClientConnection, payload: Union[str, bytes]):
+        if client.closed:
+            return
+        try:
+            client.queue.put_nowait(payload)
+            self.messages_enqueued += 1
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if self.slow_consumer_policy == SLOW_CONSUMER_DROP:
+            self.clients_dropped += 1
+            print(f"Dropping slow WebSocket client {client.websocket.client} (queue full).")
+            self.disconnect(client.websocket)
+            task = asyncio.create_task(self._close(client.websocket))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+            return
+
+        # Conflate: pending deltas are useless once any is skipped, so replace them all with one snapshot
+        while not client.queue.empty():
+            client.queue.get_nowait()
+            self.messages_conflated += 1
+        client.queue.put_nowait(self._encode_snapshot(client))
+        self.messages_enqueued += 1
+        if client.uid is not None and self.portfolio_source is not None and not client.queue.full():
+            client.queue.put_nowait(client.codec.encode(self.portfolio_source(client.uid)))
+            self.messages_enqueued += 1
+
+    def _index_market(self, client: ClientConnection):
+        if client.symbols is None:
+            self.all_symbols_subscribers.add(client)
+        else:
+            for symbol in client.symbols:
+                self.symbol_subscribers.setdefault(symbol, set()).add(client)
+
+    def _unindex_market(self, client: ClientConnection):
+        self.all_symbols_subscribers.discard(client)
+        for symbol in client.symbols or ():
+            self._remove_subscriber(symbol, client)
+
+    def _unindex(self, client: ClientConnection):
+        self._unindex_market(client)
+        self.conflated_clients.discard(client)
+        self._remove_user_connection(client)
+        if client.due_at:  # Its heap entry would hold the connection until due; compact once they are half the heap
+            self._due_closed += 1
+            if self._due_closed * 2 > len(self._due):
+                self._due = [entry for entry in self._due if not entry[2].closed]
+                heapq.heapify(self._due)
+                self._due_closed = 0
+
+    def _remove_user_connection(self, client: ClientConnection):
+        if client.uid is None:
+            return
+        clients = self.user_connections.get(client.uid)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.user_connections[client.uid]
+                if self.on_user_gone is not None:
+                    self.on_user_gone(client.uid)
+        client.uid = None
+
+    def _remove_subscriber(self, symbol: str, client: ClientConnection):
+        subscribers = self.symbol_subscribers.get(symbol)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del self.symbol_subscribers[symbol]
+
+    async def _writer(self, client: ClientConnection):
+        websocket = client.websocket
+        send = websocket.send_bytes if client.codec.binary else websocket.send_text
+        try:
+            while True:
+                payload = await client.queue.get()
+                await send(payload)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:  # Broken pipe, closed socket, etc. -- forget about this client
+            self.send_errors += 1
+            print(f"WebSocket send to {websocket.client} failed, removing client: {e}")
+            self.disconnect(websocket)
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # 1013 = Try Again Later
+        except Exception as e:  # Usually already closed by the client
+            print(f"Closing dropped WebSocket client {websocket.client} failed: {e}")
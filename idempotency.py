@@ -0,0 +1,102 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class IdempotencyKeyReused(ValueError):
+    """The key was already used for a request with different parameters."""
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "result", "error", "expires_at")
+
+    def __init__(self, fingerprint: bytes, result: Any, error: Optional[BaseException], expires_at: float):
+        self.fingerprint = fingerprint
+        self.result = result
+        self.error = error
+        self.expires_at = expires_at
+
+
+class IdempotencyCache:
+    """
+    Outcomes of requests sent with an Idempotency-Key, replayed when the request is retried.
+
+    `run(key, fingerprint, operation)` runs the operation the first time a key is seen and
+    stores its result (or an error `is_cacheable_error` accepts, e.g. a 4xx rejection) for
+    `ttl_seconds`. A retry gets the stored outcome without running anything; a retry that
+    arrives while the first attempt is still running waits for it instead of running twice.
+    Reusing a key with a different fingerprint (the request's parameters) raises
+    IdempotencyKeyReused. Outcomes that are not cached (server errors) let the next retry
+    run the operation again.
+
+    Every entry lives for the same TTL, so insertion order is expiry order: expired entries
+    are popped from the front in O(1), and past `max_entries` the oldest go first, which
+    bounds memory under any traffic.
+    """
+
+    def __init__(self, max_entries: int = 50000, ttl_seconds: float = 86400.0,
+                 is_cacheable_error: Callable[[BaseException], bool] = lambda e: False):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.is_cacheable_error = is_cacheable_error
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._inflight: Dict[Hashable, Tuple[bytes, asyncio.Future]] = {}
+        # Counters
+        self.executions = 0
+        self.replays = 0
+        self.conflicts = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def run(self, key: Hashable, fingerprint: bytes,
+                  operation: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """(result, replayed). A cached error is raised again, the same as the first time."""
+        while True:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    self.conflicts += 1
+                    raise IdempotencyKeyReused(key)
+                self.replays += 1
+                if entry.error is not None:
+                    raise entry.error.with_traceback(None)  # Don't let tracebacks pile up on the stored error
+                return entry.result, True
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            if pending[0] != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyKeyReused(key)
+            await asyncio.wait([pending[1]])  # Then look again: replay its outcome, or run if it wasn't cached
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (fingerprint, future)
+        self.executions += 1
+        try:
+            result = await operation()
+        except BaseException as e:
+            if isinstance(e, Exception) and self.is_cacheable_error(e):
+                self._store(key, _Entry(fingerprint, None, e, time.time() + self.ttl_seconds))
+            raise
+        else:
+            self._store(key, _Entry(fingerprint, result, None, time.time() + self.ttl_seconds))
+            return result, False
+        finally:
+            del self._inflight[key]
+            future.set_result(None)
+
+    # --- Internals ---
+    def _store(self, key: Hashable, entry: _Entry):
+        entries = self._entries
+        now = time.time()
+        while entries:  # Expire from the front: the oldest entries expire first
+            oldest = next(iter(entries.values()))
+            if oldest.expires_at > now and len(entries) < self.max_entries:
+                break
+            entries.popitem(last=False)
+        entries[key] = entry
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional
+
+
+class UserLedger:
+    """
+    One user's append-only history.
+
+    Entry positions are 0..n-1 in append order and `seqs[pos]` is the entry's sequence
+    number, so cursors resolve with a binary search. The newest `retention` entries are
+    kept as dicts; older ones are spilled to a JSON-lines file and only their file offset
+    stays in memory. Secondary indexes hold sequence numbers per type and per asset.
+    `archived` is set when even older entries exist only in durable storage.
+    """
+
+    __slots__ = ("path", "seqs", "offsets", "recent", "by_type", "by_asset", "archived")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.seqs = array("q")  # position -> seq (all entries)
+        self.offsets = array("q")  # position -> byte offset in `path` (spilled entries only)
+        self.recent: List[Dict[str, Any]] = []  # entries from position len(offsets) onwards
+        self.by_type: Dict[str, array] = {}
+        self.by_asset: Dict[str, array] = {}
+        self.archived = False
+
+    def __len__(self) -> int:
+        return len(self.seqs)
+
+    def append(self, record: Dict[str, Any]):
+        seq = record["seq"]
+        self.seqs.append(seq)
+        self.recent.append(record)
+        self.by_type.setdefault(record.get("type"), array("q")).append(seq)
+        self.by_asset.setdefault(record.get("asset_id"), array("q")).append(seq)
+
+    def spill(self, count: int):
+        """Moves the oldest `count` in-memory entries to disk."""
+        entries, self.recent = self.recent[:count], self.recent[count:]
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            for record in entries:
+                line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+                f.write(line)
+                self.offsets.append(offset)
+                offset += len(line)
+
+    def read(self, positions: List[int]) -> List[Dict[str, Any]]:
+        spilled = len(self.offsets)
+        records = []
+        f = None
+        try:
+            for pos in positions:
+                if pos >= spilled:
+                    records.append(self.recent[pos - spilled])
+                    continue
+                if f is None:
+                    f = open(self.path, "rb")
+                f.seek(self.offsets[pos])
+                records.append(json.loads(f.readline()))
+        finally:
+            if f is not None:
+                f.close()
+        return records
+
+
+class TransactionLedger:
+    """
+    Per-user append-only transaction history with O(1) appends and cursor pagination.
+
+    Every entry gets a `seq` from one monotonic counter; pages are newest-first and
+    clients pass the last `seq` they saw as `before` (older entries) or the first as
+    `after` (newer entries). Filters by type and asset are served from secondary indexes.
+
+    With several workers sharing one database, each numbers its entries
+    `seq_offset, seq_offset + seq_stride, ...` so their sequence numbers never collide.
+    """
+
+    def __init__(self, spill_dir: str, retention: int = 1000, spill_batch: int = 256,
+                 seq_offset: int = 0, seq_stride: int = 1):
+        self.spill_dir = spill_dir
+        self.retention = retention  # In-memory entries kept per user
+        self.spill_batch = spill_batch  # Spill in batches so the file append cost is amortized
+        self.seq_offset = seq_offset
+        self.seq_stride = seq_stride
+        self._ledgers: Dict[str, UserLedger] = {}
+        self._next_seq = self._align(1)
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def ensure_user(self, firebase_uid: str) -> UserLedger:
+        ledger = self._ledgers.get(firebase_uid)
+        if ledger is None:
+            name = hashlib.sha1(firebase_uid.encode("utf-8")).hexdigest()  # UIDs are not guaranteed filename-safe
+            path = os.path.join(self.spill_dir, f"{name}.jsonl")
+            if os.path.exists(path):  # Left over from a previous process; this ledger starts empty
+                os.remove(path)
+            ledger = self._ledgers[firebase_uid] = UserLedger(path)
+        return ledger
+
+    def append(self, firebase_uid: str, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Stamps `record` with the next sequence number and appends it to the user's history."""
+        ledger = self.ensure_user(firebase_uid)
+        record["seq"] = self._next_seq
+        self._next_seq += self.seq_stride
+        ledger.append(record)
+        if len(ledger.recent) >= self.retention + self.spill_batch:
+            ledger.spill(self.spill_batch)
+        return record
+
+    def resume(self, next_seq: int):
+        """Continues numbering after entries that already exist in storage."""
+        self._next_seq = max(self._next_seq, self._align(next_seq))
+
+    def restore(self, firebase_uid: str, record: Dict[str, Any]):
+        """Appends a record loaded from storage, keeping its original seq."""
+        ledger = self.ensure_user(firebase_uid)
+        ledger.append(record)
+        self._next_seq = max(self._next_seq, self._align(record["seq"] + 1))
+        if len(ledger.recent) >= self.retention + self.spill_batch:
+            ledger.spill(self.spill_batch)
+
+    def mark_archived(self, firebase_uid: str):
+        """The user has entries older than the ones restored, left in storage rather than loaded."""
+        self.ensure_user(firebase_uid).archived = True
+
+    def archived_below(self, firebase_uid: str) -> Optional[int]:
+        """Oldest seq held here if older entries exist only in storage (see mark_archived), else None."""
+        ledger = self._ledgers.get(firebase_uid)
+        if ledger is None or not ledger.archived or not ledger.seqs:
+            return None
+        return ledger.seqs[0]
+
+    def page(self, firebase_uid: str, limit: int = 50, before: Optional[int] = None, after: Optional[int] = None,
+             type: Optional[str] = None, asset_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Up to `limit` entries, newest first, with seq in (after, before) and matching the filters."""
+        ledger = self._ledgers.get(firebase_uid)
+        if ledger is None or limit <= 0:
+            return []
+
+        # Pick the narrowest index; the other filter (if any) is checked per entry
+        if asset_id is not None:
+            candidates = ledger.by_asset.get(asset_id, array("q"))
+            residual_type = type
+        elif type is not None:
+            candidates = ledger.by_type.get(type, array("q"))
+            residual_type = None
+        else:
+            candidates = ledger.seqs
+            residual_type = None
+
+        start = bisect_right(candidates, after) if after is not None else 0
+        end = bisect_left(candidates, before) if before is not None else len(candidates)
+        oldest_first = after is not None and before is None  # "What's new since my cursor?"
+
+        results: List[Dict[str, Any]] = []
+        while start < end and len(results) < limit:
+            want = limit - len(results)
+            if oldest_first:
+                chunk = candidates[start:min(end, start + want)]
+                start += len(chunk)
+            else:
+                chunk = candidates[max(start, end - want):end]
+                end -= len(chunk)
+                chunk = chunk[::-1]
+            positions = [bisect_left(ledger.seqs, seq) for seq in chunk]
+            for record in ledger.read(positions):
+                if residual_type is None or record.get("type") == residual_type:
+                    results.append(record)
+        if oldest_first:
+            results.reverse()
+        return results
+
+    def _align(self, seq: int) -> int:
+        """Smallest sequence number >= `seq` that belongs to this worker."""
+        return seq + (self.seq_offset - seq) % self.seq_stride
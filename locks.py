@@ -0,0 +1,47 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+
+class _KeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # Tasks holding or waiting for the lock
+
+
+class KeyedLocks:
+    """
+    One asyncio lock per key (e.g. per account), created on demand.
+
+    Operations on the same key run one at a time in arrival order (asyncio.Lock is FIFO),
+    while different keys never wait on each other. A key's lock is dropped as soon as no
+    task holds or waits for it, so memory stays proportional to the accounts in flight.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, _KeyLock] = {}
+        # Counters
+        self.acquisitions = 0
+        self.contended = 0
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = _KeyLock()
+        entry.users += 1
+        self.acquisitions += 1
+        if entry.lock.locked():
+            self.contended += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._locks[key]
@@ -1,17 +1,37 @@
 import firebase_admin
 from firebase_admin import credentials, auth
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi import (FastAPI, Depends, Header, HTTPException, Query, Request, Response, status, WebSocket,
+                     WebSocketDisconnect)
 from fastapi.security import OAuth2PasswordBearer  # We can reuse for header parsing
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uvicorn
 import asyncio
-import random
+import os
 import time
 from datetime import datetime, timezone
 import uuid
 
+from candles import CandleStore
+from cluster import PUBLIC_PATH_PREFIXES, RoutingMiddleware, WorkerRouter, claim_worker_slot, first_sequence_number
+from expiry import TimingWheel
+from fanout import ConnectionManager, SLOW_CONSUMER_CONFLATE
+from idempotency import IdempotencyCache, IdempotencyKeyReused
+from ledger import TransactionLedger
+from locks import KeyedLocks
+from market_engine import MarketEngine
+from metrics import CONTENT_TYPE, MetricsRegistry, instrumented_route, monitor_event_loop_lag, timed
+from orderbook import BUY, SELL, MatchingEngine, Order
+from positions import QUANTITY_EPSILON, PositionStore
+from ratelimit import AdmissionControl, AdmissionMiddleware, TokenBucketLimiter, parse_route_costs
+from scheduler import TickScheduler
+from storage import MemoryStorage, SQLiteStorage, Storage
+from tickbus import LocalTickBus, SocketTickBus
+from valuation import ValuationEngine
+from token_cache import TokenVerifier
+from wire import DEFAULT_RESPONSE_CLASS, decode_message, dumps
+
 # Database (using a simplified in-memory structure for this example, you'd use SQLAlchemy with a real DB)
 # Re-integrate your SQLAlchemy setup here. For brevity, I'll use dicts.
 # from .database import engine, SessionLocal, Base (your actual db setup)
@@ -37,7 +57,38 @@ except Exception as e:
     # Handle this critical error appropriately, app might not function correctly
     # For local dev, ensure the file path is correct. For prod, ensure env var is set.
 
-app = FastAPI(title="NovaTrade API")
+app = FastAPI(title="NovaTrade API", default_response_class=DEFAULT_RESPONSE_CLASS)  # orjson; see wire.py
+
+# --- Metrics (see metrics.py; scraped at GET /metrics) ---
+# Series are bound once (per route, per dependency, here), so recording on a hot path is a bisect and two additions
+metrics = MetricsRegistry()
+http_request_seconds = metrics.histogram(
+    "novatrade_http_request_duration_seconds",
+    "Time to handle an HTTP request, dependencies and response serialization included.", ("method", "route"))
+http_responses = metrics.counter("novatrade_http_responses_total", "HTTP responses by route and status code.",
+                                 ("method", "route", "status"))
+app.router.route_class = instrumented_route(http_request_seconds, http_responses)  # Before any route is declared
+dependency_seconds = metrics.histogram(
+    "novatrade_dependency_duration_seconds",
+    "Time spent in an auth dependency itself, not counting the dependencies it receives.", ("dependency",))
+event_loop_lag_seconds = metrics.histogram(
+    "novatrade_event_loop_lag_seconds",
+    "How late a 250 ms timer fires: how long ready work waited for the event loop.").labels()
+tick_seconds = metrics.histogram(
+    "novatrade_tick_duration_seconds",
+    "Time to handle a market tick: fan-out, candle recording, revaluation and limit order fills.").labels()
+tick_lateness_seconds = metrics.histogram(
+    "novatrade_tick_lateness_seconds", "How long after its deadline a market tick started.").labels()
+broadcast_seconds = metrics.histogram(
+    "novatrade_broadcast_duration_seconds",
+    "Time to encode a tick and queue it for every WebSocket client.").labels()
+ws_queue_depth = metrics.histogram(
+    "novatrade_websocket_queue_depth", "Deepest WebSocket client send queue right after a tick was queued.",
+    buckets=(0, 1, 2, 4, 8, 16, 32)).labels()
+trades_total = metrics.counter(
+    "novatrade_trades_total",
+    "Trade fills by side; fill is immediate (market or marketable limit order) or resting (limit order on a tick).",
+    ("side", "fill"))
 
 # --- CORS ---
 # IMPORTANT: Configure origins for your deployed frontend
@@ -49,14 +100,8 @@ origins = [
     # "https://your-firebase-hosting-domain.web.app", # Add your Firebase Hosting domain
     # "https://your-custom-domain.com", # Add your custom domain
 ]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,  # Allows specific origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
+# CORSMiddleware is added after the other middleware (see "Admission control"), so that it is the
+# outermost layer and its headers are on every response, including 429/503 rejections
 
 
 # --- Pydantic Models (Adjust based on your SQLAlchemy models) ---
@@ -79,13 +124,48 @@ class User(UserBase):
         orm_mode = True  # if using SQLAlchemy models, allows mapping from ORM objects
 
 
-# --- In-memory data stores (Replace with your actual database logic) ---
-# This is a simplified placeholder. You should use your SQLAlchemy setup for a real application.
+# --- Workers (see tickbus.py and cluster.py) ---
+# Set NOVATRADE_WORKERS to the same value as `uvicorn --workers`. With more than one worker, a single
+# producer steps the market and shares each tick over a Unix socket at NOVATRADE_BUS_PATH, and every
+# user's state lives in exactly one worker (requests reaching another worker are forwarded to it).
+NOVATRADE_WORKERS = int(os.environ.get("NOVATRADE_WORKERS", "1"))
+if NOVATRADE_WORKERS > 1:
+    _bus_path = os.environ.get("NOVATRADE_BUS_PATH", "/tmp/novatrade-bus.sock")
+    tick_bus: LocalTickBus = SocketTickBus(_bus_path, claim_worker_slot(_bus_path, NOVATRADE_WORKERS),
+                                           NOVATRADE_WORKERS)
+else:
+    tick_bus = LocalTickBus()
+if NOVATRADE_WORKERS > 1:
+    metrics.const_labels["worker"] = str(tick_bus.worker_id)  # Each worker serves its own /metrics
+
+# --- Durable storage (see storage.py) ---
+# NOVATRADE_STORAGE=sqlite (default) persists users, positions, transactions and payment intents to
+# NOVATRADE_DB_PATH with group commit; NOVATRADE_DB_SYNCHRONOUS=OFF trades fsyncs for throughput.
+# NOVATRADE_STORAGE=memory turns durability off entirely.
+if os.environ.get("NOVATRADE_STORAGE", "sqlite") == "memory":
+    storage: Storage = MemoryStorage()
+else:
+    storage = SQLiteStorage(os.environ.get("NOVATRADE_DB_PATH", "novatrade.db"),
+                            synchronous=os.environ.get("NOVATRADE_DB_SYNCHRONOUS", "FULL"))
+_max_user_id, _max_transaction_seq = storage.max_ids()
+
+# --- In-memory data stores ---
+# Hot caches in front of `storage`: a user's state is loaded on first access and then served from memory.
 fake_users_db: Dict[str, User] = {}  # Keyed by firebase_uid
-next_user_id_counter = 1  # Use a global counter for unique local IDs
-
-fake_portfolio_db: Dict[str, List[Dict[str, Any]]] = {}  # user_firebase_uid -> list of assets
-fake_transactions_db: Dict[str, List[Dict[str, Any]]] = {}  # user_firebase_uid -> list of transactions
+# Use a global counter for unique local IDs (each worker takes every NOVATRADE_WORKERS-th one)
+next_user_id_counter = first_sequence_number(_max_user_id + 1, tick_bus.worker_id, tick_bus.workers)
+_user_loads: Dict[str, asyncio.Future] = {}  # firebase_uid -> in-flight load, so concurrent misses load once
+
+position_store = PositionStore()  # (user_firebase_uid, asset_id) -> Position, see positions.py
+# user_firebase_uid -> append-only transaction history, see ledger.py. Entries beyond the in-memory
+# retention window (NOVATRADE_LEDGER_RETENTION per user) are spilled to NOVATRADE_LEDGER_DIR.
+transaction_ledger = TransactionLedger(
+    os.environ.get("NOVATRADE_LEDGER_DIR", "ledger_spill"),
+    retention=int(os.environ.get("NOVATRADE_LEDGER_RETENTION", "1000")),
+    seq_offset=tick_bus.worker_id,
+    seq_stride=tick_bus.workers,
+)
+transaction_ledger.resume(_max_transaction_seq + 1)
 
 MOCK_ASSETS_PRICES = {  # Asset ID -> current price, 24h change, type
     "BTCUSD": {"price": 60000.00, "change_24h": 1.5, "type": "crypto"},
@@ -99,17 +179,29 @@ MOCK_ASSETS_PRICES = {  # Asset ID -> current price, 24h change, type
 
 # --- Authentication Dependency ---
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # tokenUrl is nominal, Firebase handles token issuance
+token_verifier = TokenVerifier(max_entries=10000)  # Verified-token cache, see token_cache.py
 
 
-async def get_current_user_firebase_data(token: str = Depends(oauth2_scheme)) -> dict:
+@timed(dependency_seconds.labels("get_current_user_firebase_data"))
+async def get_current_user_firebase_data(request: Request, token: str = Depends(oauth2_scheme)) -> dict:
     """Verifies Firebase ID token and returns decoded token data."""
+    verified = getattr(request.state, "firebase_data", None)  # Set when a middleware already verified it
+    if verified is not None and verified[0] == token:
+        if isinstance(verified[1], HTTPException):
+            raise verified[1]
+        return verified[1]
+    return await _verify_firebase_token(token)
+
+
+async def _verify_firebase_token(token: str) -> dict:
+    """Decoded token data; raises HTTPException (401, or 503 without Firebase Admin) if it can't be verified."""
     if not firebase_admin._apps:  # Check if Firebase Admin is initialized
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Firebase Admin SDK not initialized. Check server configuration.",
         )
     try:
-        decoded_token = firebase_admin.auth.verify_id_token(token)
+        decoded_token = await token_verifier.verify(token)  # Cached; cold verifications run off the event loop
         return decoded_token  # Contains 'uid', 'email', 'name', etc.
     except firebase_admin.auth.ExpiredIdTokenError:
         raise HTTPException(
@@ -132,39 +224,78 @@ async def get_current_user_firebase_data(token: str = Depends(oauth2_scheme)) ->
         )
 
 
+def _user_op(user: User):
+    return ("user", dict(user))
+
+
+def _position_op(firebase_uid: str, asset_id: str):
+    position = position_store.get(firebase_uid, asset_id)
+    if position is None:
+        return ("delete_position", firebase_uid, asset_id)
+    return ("position", firebase_uid, asset_id, position.quantity, position.average_buy_price)
+
+
+async def _load_or_create_user(firebase_data: dict) -> User:
+    """Cache miss: hydrate the user's state from storage, or create the user if they are new."""
+    global next_user_id_counter  # Use the global counter
+
+    firebase_uid = firebase_data["uid"]
+    # Only the retention window of history is loaded; older pages are read from storage on demand
+    stored = await storage.load_user(firebase_uid, max(1, transaction_ledger.retention))
+    if stored is not None:
+        user = User(**stored["user"])
+        fake_users_db[firebase_uid] = user
+        position_store.ensure_user(firebase_uid)
+        for asset_id, quantity, average_buy_price in stored["positions"]:
+            position_store.restore(firebase_uid, asset_id, quantity, average_buy_price)
+            valuation_engine.position_changed(firebase_uid, asset_id)
+        transaction_ledger.ensure_user(firebase_uid)
+        for record in stored["transactions"]:
+            transaction_ledger.restore(firebase_uid, record)
+        if stored["more_transactions"]:
+            transaction_ledger.mark_archived(firebase_uid)
+        return user
+
+    # Create user in local DB (simulated)
+    email = firebase_data.get("email")
+    # Firebase 'name' comes from user.updateProfile({ displayName: ... }) on client
+    full_name = firebase_data.get("name") or firebase_data.get("displayName")
+
+    new_user_data = {
+        "id": next_user_id_counter,  # Assign a new local ID
+        "firebase_uid": firebase_uid,
+        "email": email,
+        "full_name": full_name,
+        "is_active": True,
+        "balance_usd": 10000.00  # Initial demo balance for new users
+    }
+    user = User(**new_user_data)
+    next_user_id_counter += tick_bus.workers  # Increment for the next user
+    await storage.commit([_user_op(user)])
+    fake_users_db[firebase_uid] = user
+    position_store.ensure_user(firebase_uid)  # Initialize portfolio
+    transaction_ledger.ensure_user(firebase_uid)  # Initialize transactions
+    print(f"New user created in local DB: {user.email} (UID: {firebase_uid}, LocalID: {user.id})")
+    return user
+
+
+@timed(dependency_seconds.labels("get_current_active_user"))
 async def get_current_active_user(firebase_data: dict = Depends(get_current_user_firebase_data)) -> User:
     """
     Gets user from local DB based on Firebase UID.
     Creates user in local DB if not exists. This simulates user profile creation/sync.
     """
-    global next_user_id_counter  # Use the global counter
-
     firebase_uid = firebase_data.get("uid")
     if not firebase_uid:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Firebase UID not found in token")
 
     user = fake_users_db.get(firebase_uid)
     if not user:
-        # Create user in local DB (simulated)
-        email = firebase_data.get("email")
-        # Firebase 'name' comes from user.updateProfile({ displayName: ... }) on client
-        full_name = firebase_data.get("name") or firebase_data.get("displayName")
-
-        new_user_data = {
-            "id": next_user_id_counter,  # Assign a new local ID
-            "firebase_uid": firebase_uid,
-            "email": email,
-            "full_name": full_name,
-            "is_active": True,
-            "balance_usd": 10000.00  # Initial demo balance for new users
-        }
-        user = User(**new_user_data)
-        fake_users_db[firebase_uid] = user
-        fake_portfolio_db.setdefault(firebase_uid, [])  # Initialize portfolio
-        fake_transactions_db.setdefault(firebase_uid, [])  # Initialize transactions
-
-        next_user_id_counter += 1  # Increment for the next user
-        print(f"New user created in local DB: {user.email} (UID: {firebase_uid}, LocalID: {user.id})")
+        pending = _user_loads.get(firebase_uid)
+        if pending is None:
+            pending = _user_loads[firebase_uid] = asyncio.ensure_future(_load_or_create_user(firebase_data))
+            pending.add_done_callback(lambda _: _user_loads.pop(firebase_uid, None))
+        user = await asyncio.shield(pending)
 
     if not user.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user")
@@ -175,6 +306,58 @@ async def get_current_active_user(firebase_data: dict = Depends(get_current_user
 # POST /users/register is GONE (Registration handled by Firebase Client SDK)
 # POST /token is GONE (Token issuance handled by Firebase)
 
+async def _uid_from_token(scope, token: str) -> Optional[str]:
+    """For the middlewares. The outcome is kept on the request state, so the token is verified once per request."""
+    try:
+        firebase_data = await _verify_firebase_token(token)
+    except HTTPException as e:
+        scope.setdefault("state", {})["firebase_data"] = (token, e)
+        return None
+    scope.setdefault("state", {})["firebase_data"] = (token, firebase_data)
+    return firebase_data.get("uid")
+
+
+# Sends each authenticated request to the worker that owns the user (a no-op with one worker)
+worker_router = WorkerRouter(tick_bus, _uid_from_token)
+app.add_middleware(RoutingMiddleware, router=worker_router)
+worker_router.app = app  # Forwarded requests run through the full app on the owning worker
+
+# --- Admission control (see ratelimit.py) ---
+# Token buckets per client IP and per user (rates in cost units per second; a rate of 0 turns the limit off),
+# charged each route's cost, and a cap on requests in flight. Behind a reverse proxy, run uvicorn with
+# --proxy-headers and --forwarded-allow-ips so the client IP is the real one and not the proxy's.
+ROUTE_COSTS = {"/trade/execute-batch": 10.0, "/trade/": 2.0, "/payments/": 2.0, "/market/candles": 2.0}
+ROUTE_COSTS.update(parse_route_costs(os.environ.get("NOVATRADE_ROUTE_COSTS", "")))
+
+
+def _serves_user_here(scope, firebase_uid: str) -> bool:
+    """Whether this worker serves the request rather than forwarding it to the user's owner (see cluster.py)."""
+    return (tick_bus.workers == 1 or bool(scope.get("novatrade.forwarded"))
+            or scope["path"].startswith(PUBLIC_PATH_PREFIXES) or worker_router.owns(firebase_uid))
+
+
+admission_control = AdmissionControl(
+    ip_limiter=TokenBucketLimiter(float(os.environ.get("NOVATRADE_IP_RATE", "100")),
+                                  float(os.environ.get("NOVATRADE_IP_BURST", "200"))),
+    user_limiter=TokenBucketLimiter(float(os.environ.get("NOVATRADE_USER_RATE", "20")),
+                                    float(os.environ.get("NOVATRADE_USER_BURST", "40"))),
+    connect_limiter=TokenBucketLimiter(float(os.environ.get("NOVATRADE_WS_CONNECT_RATE", "2")),
+                                       float(os.environ.get("NOVATRADE_WS_CONNECT_BURST", "10"))),
+    max_inflight=int(os.environ.get("NOVATRADE_MAX_INFLIGHT", "512")),
+    route_costs=ROUTE_COSTS,
+    resolve_uid=_uid_from_token,
+    charge_user=_serves_user_here,
+)
+app.add_middleware(AdmissionMiddleware, control=admission_control)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,  # Allows specific origins
+    allow_credentials=True,
+    allow_methods=["*"],  # Allows all methods
+    allow_headers=["*"],  # Allows all headers
+)
+
+
 @app.get("/users/me", response_model=User)
 async def read_users_me(current_user: User = Depends(get_current_active_user)):
     """
@@ -186,94 +369,278 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
 
 
 # --- Market Data Endpoints ---
-@app.get("/market/prices", response_model=List[Dict[str, Any]])
-async def get_market_prices(current_user: User = Depends(get_current_active_user)):  # Protected endpoint
-    live_prices = []
-    for symbol, data in MOCK_ASSETS_PRICES.items():
-        price_factor = 1 + (random.random() - 0.5) * 0.02  # +/- 1% fluctuation for dynamic feel
-        change_factor = 1 + (random.random() - 0.5) * 0.1  # Fluctuate change %
-        live_prices.append({
-            "symbol": symbol,
-            "price": round(data["price"] * price_factor, 4 if data["type"] == "forex" else 2),
-            "change_24h": round(data["change_24h"] * change_factor, 2),
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-        })
-    return live_prices
-
+# Vectorized simulation of every instrument; REST and WebSocket both read its current snapshot.
+# NOVATRADE_SIM_SYMBOLS adds synthetic instruments for load tests, NOVATRADE_SIM_SEED makes runs reproducible.
+market_engine = MarketEngine(
+    MOCK_ASSETS_PRICES,
+    extra_symbols=int(os.environ.get("NOVATRADE_SIM_SYMBOLS", "0")),
+    seed=int(os.environ["NOVATRADE_SIM_SEED"]) if os.environ.get("NOVATRADE_SIM_SEED") else None,
+)
+# Tick history and 1m/5m/1h/1d OHLCV bars, memory-mapped under NOVATRADE_HISTORY_DIR (see candles.py)
+candle_store = CandleStore(os.environ.get("NOVATRADE_HISTORY_DIR", "history"), market_engine.symbols)
 
-# --- WebSocket for Market Data ---
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses weak comparison: `*`, or any listed tag equal to ours ignoring a W/ prefix."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+@app.get("/market/prices", response_model=List[Dict[str, Any]])
+async def get_market_prices(request: Request, symbols: Optional[str] = None,
+                            current_user: User = Depends(get_current_active_user)):  # Protected endpoint
+    """
+    Prices for the current tick (the same ones the WebSocket pushed), optionally filtered
+    with `symbols=BTCUSD,ETHUSD`. Bodies are pre-encoded once per tick; send the ETag back
+    in If-None-Match to get a 304 until the next tick.
+    """
+    snapshot = market_engine.snapshot
+    requested = None
+    if symbols:
+        requested = [s for s in symbols.split(",") if s]
+        unknown = [s for s in requested if s not in snapshot]
+        if unknown:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown symbols: {', '.join(unknown)}")
+
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=snapshot.encoded_rows(requested), media_type="application/json", headers=headers)
+
+
+@app.get("/market/candles", response_model=List[Dict[str, Any]])
+async def get_market_candles(symbol: str, interval: str = "1m",
+                             start: Optional[int] = Query(None, alias="from", description="Epoch ms, inclusive"),
+                             end: Optional[int] = Query(None, alias="to", description="Epoch ms, inclusive"),
+                             limit: int = Query(500, ge=1, le=5000),
+                             firebase_data: dict = Depends(get_current_user_firebase_data)):  # Any signed-in user
+    """
+    OHLCV bars for one symbol, oldest first, as {"time", "open", "high", "low", "close", "volume"}
+    with `time` the bar's open time in epoch ms and `volume` its tick count. The last bar is the
+    one still forming. Without `from`, returns the latest `limit` bars up to `to`.
+    """
+    if interval not in candle_store.intervals:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid interval. Must be one of {', '.join(candle_store.intervals)}.")
+    if symbol not in candle_store.index:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown symbol: {symbol}")
+    bars = candle_store.candles(symbol, interval, start, end, limit)
+    return Response(content=dumps(bars), media_type="application/json")
 
 
-manager = ConnectionManager()
+# --- WebSocket for Market Data ---
+TICK_INTERVAL_SECONDS = float(os.environ.get("NOVATRADE_TICK_INTERVAL", "5"))  # Update interval, down to ~0.01
+tick_scheduler = TickScheduler(TICK_INTERVAL_SECONDS)  # See scheduler.py
+manager = ConnectionManager(queue_size=32, slow_consumer_policy=SLOW_CONSUMER_CONFLATE)  # See fanout.py
+manager.publish_snapshot(market_engine.snapshot)  # So the first clients get a snapshot before the first tick
 
 
 async def market_data_publisher():
-    """Periodically sends market updates to connected WebSocket clients."""
+    """Steps the market on a fixed schedule while this worker is the tick producer (always, with one worker)."""
     while True:
-        await asyncio.sleep(5)  # Update interval
-        prices_update = []
-        for symbol, data in MOCK_ASSETS_PRICES.items():
-            price_factor = 1 + (random.random() - 0.5) * 0.02
-            change_factor = 1 + (random.random() - 0.5) * 0.1
-            prices_update.append({
-                "symbol": symbol,
-                "price": round(data["price"] * price_factor, 4 if data["type"] == "forex" else 2),
-                "change_24h": round(data["change_24h"] * change_factor, 2),
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-            })
-        if manager.active_connections:  # Only broadcast if there are active connections
-            await manager.broadcast({"type": "market_update", "data": prices_update})
+        lateness = await tick_scheduler.wait()
+        if not tick_bus.is_producer:
+            continue
+        tick_lateness_seconds.observe(lateness)
+        snapshot = market_engine.step()
+        tick_bus.publish_tick(snapshot.tick, snapshot.epoch_ms, market_engine.raw_prices)
+        try:
+            await handle_tick(snapshot)
+        except Exception as e:  # Never let one bad tick stop the stream
+            print(f"Error handling tick {snapshot.tick}: {e}")
+
+
+async def on_bus_tick(tick: int, epoch_ms: int, raw_prices):
+    """A tick produced by another worker: adopt it so every worker serves the same prices."""
+    await handle_tick(market_engine.apply(tick, epoch_ms, raw_prices))
+
+
+async def handle_tick(snapshot):
+    """Fans a tick out to this worker's WebSocket clients and updates the users this worker owns."""
+    started = time.perf_counter()
+    manager.publish_snapshot(snapshot)
+    broadcast_seconds.observe(time.perf_counter() - started)
+    if manager.active_connections:
+        ws_queue_depth.observe(manager.queue_depths()["max"])
+    if tick_bus.is_producer:  # One writer; the other workers read the same files
+        candle_store.record(snapshot)
+    # Only users holding a symbol whose price moved are revalued; only connected ones get a push
+    changed_users = valuation_engine.apply_snapshot(snapshot)
+    changed_users |= await fill_resting_orders(snapshot)  # Limit orders crossed by the new prices
+    for firebase_uid in changed_users:
+        if firebase_uid in manager.user_connections or firebase_uid in remote_watchers:
+            push_to_user(firebase_uid, portfolio_message(firebase_uid))
+    tick_seconds.observe(time.perf_counter() - started)
+
+
+# firebase_uid -> other workers with an authenticated WebSocket for this (locally owned) user
+remote_watchers: Dict[str, Set[int]] = {}
+
+
+def push_to_user(firebase_uid: str, message: Dict[str, Any]):
+    """Queues a private message on the user's sockets, on this worker and on any worker watching them."""
+    manager.publish_to_user(firebase_uid, message)
+    if firebase_uid in remote_watchers:
+        tick_bus.send({"type": "user_message", "uid": firebase_uid, "message": message})
+
+
+async def on_bus_message(message: Dict[str, Any]):
+    if await worker_router.handle_message(message):
+        return
+    message_type = message.get("type")
+    if message_type == "user_message":  # From the user's owner, for sockets connected here
+        manager.publish_to_user(message["uid"], message["message"])
+    elif message_type == "watch":  # A socket on another worker authenticated as a user we own
+        try:
+            user = await get_current_active_user(message["firebase_data"])
+        except HTTPException:
+            return
+        remote_watchers.setdefault(user.firebase_uid, set()).add(message["worker"])
+        push_to_user(user.firebase_uid, portfolio_message(user.firebase_uid))
+    elif message_type == "unwatch":
+        watchers = remote_watchers.get(message["uid"])
+        if watchers is not None:
+            watchers.discard(message["worker"])
+            if not watchers:
+                del remote_watchers[message["uid"]]
 
 
 @app.on_event("startup")
 async def startup_event():
+    await restore_resting_orders()  # Before the first tick, so no fills are missed
+    if tick_bus.worker_id == 0:  # One worker sweeps; the others load intents on demand
+        await restore_payment_intents()
+    tick_bus.on_tick = on_bus_tick
+    tick_bus.on_message = on_bus_message
+    await tick_bus.start()
     # Start background tasks if any, e.g., market data publisher
     asyncio.create_task(market_data_publisher())
     print("Market data publisher started.")
+    asyncio.create_task(monitor_event_loop_lag(event_loop_lag_seconds))
+    asyncio.create_task(expire_payment_intents())
+    if firebase_admin._apps:
+        asyncio.create_task(token_verifier.run_cert_refresher())  # Keeps Google signing certs warm
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await storage.close()  # Flushes the group-commit queue
+    candle_store.flush()
 
 
 @app.websocket("/ws/market-data")
 async def websocket_endpoint(websocket: WebSocket):
-    # Authentication for WebSockets is tricky. Common methods:
-    # 1. Token in query param: ws://.../?token=FIREBASE_ID_TOKEN (backend verifies on connect)
-    # 2. Token as first message: Client sends token, backend verifies, then proceeds.
-    # This example does not implement WebSocket authentication for simplicity.
-    # For a production app, secure your WebSocket endpoint.
+    # Market data is public. Authenticating additionally opens the client's portfolio channel
+    # (portfolio_update messages pushed whenever its valuation changes, order_update messages when a
+    # resting limit order fills), either with
+    # ws://.../ws/market-data?token=FIREBASE_ID_TOKEN or by sending {"type": "auth", "token": ...}.
+    # Send "auth" again with a refreshed token before the old one expires.
+    #
+    # Client messages:
+    #   {"type": "subscribe", "symbols": ["BTCUSD"]}    -> snapshot of the new symbols, then deltas for them only
+    #   {"type": "unsubscribe", "symbols": ["BTCUSD"]}
+    #   {"type": "snapshot"}                            -> full rows for the subscription (e.g. after a seq gap)
+    #   {"type": "max_rate", "max_rate": 2}             -> at most 2 market updates a second (0 or null: every tick)
+    # Clients that never subscribe receive every symbol. A max rate (also ?max_rate=2 when connecting)
+    # folds ticks together: each update has the latest values of the symbols that changed since the last one.
+    #
+    # Messages are JSON text frames, unless the client asks for the "novatrade.msgpack.v1" subprotocol:
+    # binary msgpack frames with integer symbol ids and epoch-ms timestamps (see wire.MsgpackCodec).
     await manager.connect(websocket)
     print(f"Client {websocket.client} connected to market data WebSocket.")
-    # Send initial snapshot of market data
-    initial_prices = []
-    for symbol, data in MOCK_ASSETS_PRICES.items():
-        initial_prices.append({
-            "symbol": symbol,
-            "price": round(data["price"], 4 if data["type"] == "forex" else 2),
-            "change_24h": data["change_24h"],
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-        })
-    await websocket.send_json({"type": "market_snapshot", "data": initial_prices})
+    # Send initial snapshot of market data (queued, so it is never interleaved with a broadcast send)
+    manager.send_snapshot(websocket)
     try:
+        if websocket.query_params.get("max_rate"):
+            await set_max_rate(websocket, websocket.query_params["max_rate"])
+        if websocket.query_params.get("token"):
+            await authenticate_websocket(websocket, websocket.query_params["token"])
         while True:
-            # Keep connection alive, or handle client messages if any
-            # For example, client could send {"type": "subscribe", "symbols": ["BTCUSD"]}
-            data = await websocket.receive_text()  # Or receive_json
-            # print(f"Received from {websocket.client}: {data}")
+            event = await websocket.receive()
+            if event["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(event.get("code", 1000))
+            try:
+                message = decode_message(event["text"] if event.get("text") is not None else event.get("bytes") or b"")
+                message_type = message.get("type")
+                symbols = message.get("symbols") or []
+                if not isinstance(symbols, list) or not all(isinstance(s, str) for s in symbols):
+                    raise ValueError("symbols must be a list of strings")
+            except (ValueError, TypeError, AttributeError) as e:
+                await manager.send_personal_message({"type": "error", "detail": f"Invalid message: {e}"}, websocket)
+                continue
+
+            if message_type == "subscribe":
+                snapshot = market_engine.snapshot
+                unknown = [s for s in symbols if s not in snapshot]
+                if unknown:
+                    await manager.send_personal_message(
+                        {"type": "error", "detail": f"Unknown symbols: {', '.join(unknown)}"}, websocket)
+                added = manager.subscribe(websocket, [s for s in symbols if s in snapshot])
+                if added:
+                    manager.send_snapshot(websocket, added)
+            elif message_type == "unsubscribe":
+                manager.unsubscribe(websocket, symbols)
+            elif message_type == "snapshot":
+                manager.send_snapshot(websocket)
+            elif message_type == "auth":
+                await authenticate_websocket(websocket, str(message.get("token") or ""))
+            elif message_type == "max_rate":
+                await set_max_rate(websocket, message.get("max_rate"))
+            else:
+                await manager.send_personal_message(
+                    {"type": "error", "detail": f"Unknown message type: {message_type}"}, websocket)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
         print(f"Client {websocket.client} disconnected from market data WebSocket.")
+    except RuntimeError:  # Socket already closed by the manager (e.g. dropped as a slow consumer)
+        pass
+    finally:
+        manager.disconnect(websocket)
+
+
+def unwatch_remote_user(firebase_uid: str):
+    """Our last socket watching a user another worker owns is gone: stop their updates coming here."""
+    if not worker_router.owns(firebase_uid):
+        tick_bus.send({"type": "unwatch", "uid": firebase_uid, "worker": tick_bus.worker_id},
+                      to=worker_router.owner(firebase_uid))
+
+
+manager.on_user_gone = unwatch_remote_user
+
+
+async def set_max_rate(websocket: WebSocket, max_rate: Any):
+    try:
+        rate = float(max_rate or 0)
+        if not rate >= 0:  # Also rejects NaN
+            raise ValueError
+    except (TypeError, ValueError):
+        await manager.send_personal_message(
+            {"type": "error", "detail": "max_rate must be a non-negative number of updates per second"}, websocket)
+        return
+    manager.set_max_rate(websocket, rate)
+
+
+async def authenticate_websocket(websocket: WebSocket, token: str):
+    """Verifies the token like any protected route and binds the socket to the user's portfolio channel."""
+    try:
+        firebase_data = await _verify_firebase_token(token)
+        firebase_uid = firebase_data.get("uid")
+        if firebase_uid and not worker_router.owns(firebase_uid):
+            # Another worker holds this user's state: it sends the portfolio and later updates over the bus
+            manager.authenticate(websocket, firebase_uid, float(firebase_data.get("exp", 0)))
+            tick_bus.send({"type": "watch", "worker": tick_bus.worker_id, "firebase_data": {
+                key: firebase_data.get(key) for key in ("uid", "email", "name")}}, to=worker_router.owner(firebase_uid))
+            return
+        user = await get_current_active_user(firebase_data)
+    except HTTPException as e:
+        await manager.send_personal_message({"type": "error", "detail": e.detail}, websocket)
+        return
+    manager.authenticate(websocket, user.firebase_uid, float(firebase_data.get("exp", 0)))
+    await manager.send_personal_message(portfolio_message(user.firebase_uid), websocket)
 
 
 # --- Portfolio Endpoint ---
@@ -287,40 +654,23 @@ class PortfolioItem(BaseModel):
     unrealized_pnl_percent: Optional[float] = None
 
 
+# Per-user valuations maintained incrementally on each tick, see valuation.py
+valuation_engine = ValuationEngine(position_store, market_engine.snapshot)
+
+
+def portfolio_message(firebase_uid: str) -> Dict[str, Any]:
+    items, summary = valuation_engine.portfolio(firebase_uid)
+    return {"type": "portfolio_update", "data": items, "summary": summary}
+
+
+manager.portfolio_source = portfolio_message
+
+
 @app.get("/portfolio", response_model=List[PortfolioItem])
 async def get_portfolio(current_user: User = Depends(get_current_active_user)):
-    user_portfolio_data = fake_portfolio_db.get(current_user.firebase_uid, [])
-    enriched_portfolio: List[PortfolioItem] = []
-
-    # Get current market prices once for efficiency
-    current_market_prices_list = []
-    for symbol, data in MOCK_ASSETS_PRICES.items():  # Using MOCK_ASSETS for sim, replace with live feed
-        current_market_prices_list.append(
-            {"symbol": symbol, "price": data["price"]})  # Base price for calculation consistency
-    current_prices_map = {p["symbol"]: p["price"] for p in current_market_prices_list}
-
-    for item_data in user_portfolio_data:
-        asset_id = item_data["asset_id"]
-        quantity = item_data["quantity"]
-        avg_buy_price = item_data["average_buy_price"]
-
-        current_price = current_prices_map.get(asset_id, avg_buy_price)  # Fallback to avg_buy_price if not in market
-        current_value = quantity * current_price
-        unrealized_pnl = (current_price - avg_buy_price) * quantity
-
-        cost_basis = avg_buy_price * quantity
-        unrealized_pnl_percent = (unrealized_pnl / cost_basis) * 100 if cost_basis != 0 else 0.0
-
-        enriched_portfolio.append(PortfolioItem(
-            asset_id=asset_id,
-            quantity=quantity,
-            average_buy_price=avg_buy_price,
-            current_price=current_price,
-            current_value=current_value,
-            unrealized_pnl=unrealized_pnl,
-            unrealized_pnl_percent=unrealized_pnl_percent
-        ))
-    return enriched_portfolio
+    # Kept for initial loads and non-WebSocket clients; live updates are pushed on the portfolio channel
+    items, _ = valuation_engine.portfolio(current_user.firebase_uid)
+    return items
 
 
 # --- Trade Execution Endpoint ---
@@ -333,104 +683,419 @@ class TradeRequest(BaseModel):
 
 class TradeResponse(BaseModel):
     message: str
-    transaction: Dict[str, Any]
+    transaction: Optional[Dict[str, Any]] = None  # Set when the trade filled
+    order: Optional[Dict[str, Any]] = None  # Set when a limit order was placed on the book
+
+
+# Serializes each account's check -> mutate -> durable commit sequence (trades, order changes, deposits),
+# so an account's operations are atomic and applied in arrival order while other accounts run in parallel
+account_locks = KeyedLocks()
+
+# Resting limit orders, matched against the simulated market on every tick (see orderbook.py)
+# Each worker matches only its own users' orders, so the simulated liquidity is split between workers
+matching_engine = MatchingEngine(
+    liquidity_usd=float(os.environ.get("NOVATRADE_BOOK_LIQUIDITY_USD", "100000")) / tick_bus.workers)
+trades_immediate = {side: trades_total.labels(side, "immediate") for side in (BUY, SELL)}
+trades_resting = {side: trades_total.labels(side, "resting") for side in (BUY, SELL)}
+
+
+# --- Idempotency (see idempotency.py) ---
+# POST /trade/execute, /payments/create-intent and /payments/confirm/{intent_id} accept an Idempotency-Key
+# header (a unique value per operation, e.g. a UUID). A retry with the same key and parameters gets the first
+# outcome back, marked "Idempotent-Replayed: true", without running again. Keys are per user and endpoint.
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+idempotency_cache = IdempotencyCache(
+    max_entries=int(os.environ.get("NOVATRADE_IDEMPOTENCY_MAX_KEYS", "50000")),
+    ttl_seconds=float(os.environ.get("NOVATRADE_IDEMPOTENCY_TTL", "86400")),
+    is_cacheable_error=lambda e: isinstance(e, HTTPException) and e.status_code < 500,  # Rejections replay too
+)
+
+
+async def run_idempotent(current_user: User, endpoint: str, idempotency_key: Optional[str], params: Any,
+                         response: Response, operation):
+    """Runs `operation` once per (user, endpoint, key); `params` must be the same on every retry."""
+    if idempotency_key is None:
+        return await operation()
+    if not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Idempotency-Key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+    try:
+        result, replayed = await idempotency_cache.run((current_user.firebase_uid, endpoint, idempotency_key),
+                                                       dumps(params), operation)
+    except IdempotencyKeyReused:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Idempotency-Key was already used with different request parameters")
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+def _available_to_sell(firebase_uid: str, asset_id: str) -> float:
+    """Held quantity not already promised to the user's resting SELL orders (float dust counts as zero)."""
+    position = position_store.get(firebase_uid, asset_id)
+    held = position.quantity if position is not None else 0.0
+    available = held - matching_engine.reserved_quantity(firebase_uid, asset_id)
+    return available if available > QUANTITY_EPSILON else 0.0
 
 
 @app.post("/trade/execute", response_model=TradeResponse)
-async def execute_trade(trade: TradeRequest, current_user: User = Depends(get_current_active_user)):
-    asset_info = MOCK_ASSETS_PRICES.get(trade.asset_id)
-    if not asset_info:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Asset not found")
+async def execute_trade(trade: TradeRequest, response: Response, current_user: User = Depends(get_current_active_user),
+                        idempotency_key: Optional[str] = Header(None)):
+    """
+    Market orders fill immediately at the live price. A limit order that is already marketable
+    (BUY limit at or above the price, SELL limit at or below it) fills the same way; otherwise it
+    rests on the asset's order book and fills on a later tick (see GET/PATCH/DELETE /orders).
+    """
+    async def execute():
+        async with account_locks.hold(current_user.firebase_uid):
+            return await _execute_trade(trade, current_user)
+
+    return await run_idempotent(current_user, "trade", idempotency_key, dict(trade), response, execute)
+
+
+async def _execute_trade(trade: TradeRequest, current_user: User) -> TradeResponse:
+    response = _apply_trade(trade, current_user, market_engine.snapshot)  # Execute against the live snapshot
+    await _settle_trades(current_user, [trade.asset_id], [response])
+    return response
 
-    current_market_price = asset_info["price"]  # Use the base mock price for execution
 
-    # Determine execution price (simplified: market order or exact limit)
-    execution_price = current_market_price
+def _apply_trade(trade: TradeRequest, current_user: User, snapshot) -> TradeResponse:
+    """
+    Validates one trade and applies it to the in-memory balance, positions and order book, raising
+    HTTPException (before changing anything) if it is rejected. Does not await, so a caller holding
+    the account lock can apply several trades atomically; _settle_trades records and persists them.
+    """
+    current_market_price = snapshot.price(trade.asset_id)
+    if current_market_price is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Asset not found")
+    trade_type = trade.trade_type.upper()
+    if trade_type not in (BUY, SELL):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid trade type. Must be BUY or SELL.")
+    if trade.quantity <= QUANTITY_EPSILON:  # Dust would slip past the sell checks' rounding tolerance
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Quantity must be positive")
+    price_format_decimals = 4 if snapshot.asset_type(trade.asset_id) == 'forex' else 2
+
     if trade.price_limit is not None:
-        if trade.trade_type == "BUY":
-            if trade.price_limit < current_market_price:
-                # For a real limit order, this would be queued or potentially partially filled.
-                # For this simulation, we'll assume it means "buy at this price or better".
-                # If the limit is too low, it might not execute in a real scenario.
-                # Here, we just use the limit if it's advantageous or equal.
-                pass  # execution_price = min(trade.price_limit, current_market_price) - but for simulation just use limit
-            execution_price = trade.price_limit  # Assume limit is met for BUY
-        elif trade.trade_type == "SELL":
-            if trade.price_limit > current_market_price:
-                # Similar logic for sell.
-                pass
-            execution_price = trade.price_limit  # Assume limit is met for SELL
-        # A more realistic simulation for limit orders not being met:
-        # if (trade.trade_type == "BUY" and trade.price_limit < current_market_price) or \
-        #    (trade.trade_type == "SELL" and trade.price_limit > current_market_price):
-        #     raise HTTPException(status_code=400, detail=f"Limit order price not met. Market: {current_market_price}, Limit: {trade.price_limit}")
+        if trade.price_limit <= 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Price limit must be positive")
+        marketable = (current_market_price <= trade.price_limit if trade_type == BUY
+                      else current_market_price >= trade.price_limit)
+        if not marketable:
+            order = place_limit_order(trade, trade_type, current_user)
+            return TradeResponse(
+                message=(
+                    f"Limit order {trade_type} {trade.quantity} {trade.asset_id} "
+                    f"@ ${trade.price_limit:.{price_format_decimals}f} placed."
+                ),
+                order=order.to_dict()
+            )
+    execution_price = current_market_price  # Fills at the market price, which is at or better than any limit
 
     total_cost_or_proceeds = trade.quantity * execution_price
-    user_portfolio = fake_portfolio_db.setdefault(current_user.firebase_uid, [])
-    user_transactions = fake_transactions_db.setdefault(current_user.firebase_uid, [])
-
-    if trade.trade_type.upper() == "BUY":
+    if trade_type == BUY:
         if current_user.balance_usd < total_cost_or_proceeds:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Insufficient funds")
         current_user.balance_usd -= total_cost_or_proceeds
 
-        existing_asset_item = next((item for item in user_portfolio if item["asset_id"] == trade.asset_id), None)
-        if existing_asset_item:
-            new_total_quantity = existing_asset_item["quantity"] + trade.quantity
-            # Calculate new average buy price: (old_total_cost + new_trade_cost) / new_total_quantity
-            new_avg_price = ((existing_asset_item["average_buy_price"] * existing_asset_item["quantity"]) +
-                             (execution_price * trade.quantity)) / new_total_quantity
-            existing_asset_item["quantity"] = new_total_quantity
-            existing_asset_item["average_buy_price"] = new_avg_price
-        else:
-            user_portfolio.append({
-                "asset_id": trade.asset_id,
-                "quantity": trade.quantity,
-                "average_buy_price": execution_price
-            })
-    elif trade.trade_type.upper() == "SELL":
-        existing_asset_item = next((item for item in user_portfolio if item["asset_id"] == trade.asset_id), None)
-        if not existing_asset_item or existing_asset_item["quantity"] < trade.quantity:
+        position_store.buy(current_user.firebase_uid, trade.asset_id, trade.quantity, execution_price)
+    else:
+        if _available_to_sell(current_user.firebase_uid, trade.asset_id) < trade.quantity - QUANTITY_EPSILON:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Not enough assets to sell")
-
-        existing_asset_item["quantity"] -= trade.quantity
+        position_store.sell(current_user.firebase_uid, trade.asset_id, trade.quantity)
         current_user.balance_usd += total_cost_or_proceeds
-        if existing_asset_item["quantity"] == 0:  # Remove asset from portfolio if quantity is zero
-            user_portfolio.remove(existing_asset_item)
-    else:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid trade type. Must be BUY or SELL.")
 
-    # Record transaction
+    # Transaction record (appended to the ledger by _settle_trades)
     transaction_record = {
         "id": str(uuid.uuid4()),
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "type": trade.trade_type.upper(),
+        "type": trade_type,
         "asset_id": trade.asset_id,
         "quantity": trade.quantity,
         "price_per_unit": execution_price,
         "total_amount": total_cost_or_proceeds,
         "status": "COMPLETED"  # Simplified status
     }
-    user_transactions.insert(0, transaction_record)  # Add to beginning of list
-    fake_users_db[current_user.firebase_uid] = current_user  # Persist balance change (in memory)
-
-    asset_type = asset_info.get('type', 'stock')  # Default to stock if type not defined
-    price_format_decimals = 4 if asset_type == 'forex' else 2
-
     return TradeResponse(
         message=(
-            f"Trade {trade.trade_type.upper()} {trade.quantity} {trade.asset_id} "
+            f"Trade {trade_type} {trade.quantity} {trade.asset_id} "
             f"@ ${execution_price:.{price_format_decimals}f} executed successfully."
         ),
         transaction=transaction_record
     )
 
 
+def place_limit_order(trade: TradeRequest, trade_type: str, current_user: User) -> Order:
+    """Rests a non-marketable limit order. BUY orders hold their cost from the balance until filled or cancelled."""
+    if trade_type == BUY:
+        hold = trade.quantity * trade.price_limit
+        if current_user.balance_usd < hold:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Insufficient funds")
+        current_user.balance_usd -= hold
+    elif _available_to_sell(current_user.firebase_uid, trade.asset_id) < trade.quantity - QUANTITY_EPSILON:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Not enough assets to sell")
+
+    return matching_engine.add(Order(str(uuid.uuid4()), current_user.firebase_uid, trade.asset_id, trade_type,
+                                     trade.price_limit, trade.quantity, datetime.now(timezone.utc).isoformat()))
+
+
+async def _settle_trades(current_user: User, asset_ids: List[str], responses: List[TradeResponse]):
+    """Ledgers and durably commits trades applied by _apply_trade (one commit), then pushes the new portfolio."""
+    firebase_uid = current_user.firebase_uid
+    ops = [_user_op(current_user)]
+    for asset_id in dict.fromkeys(asset_ids):
+        valuation_engine.position_changed(firebase_uid, asset_id)
+        ops.append(_position_op(firebase_uid, asset_id))
+    for response in responses:
+        if response.transaction is not None:
+            transaction_ledger.append(firebase_uid, response.transaction)  # O(1), stamps "seq"
+            trades_immediate[response.transaction["type"]].inc()
+            ops.append(("transaction", firebase_uid, response.transaction))
+        if response.order is not None:
+            ops.append(("order", response.order))
+    fake_users_db[firebase_uid] = current_user  # Persist balance change (in memory)
+    await storage.commit(ops)  # Durable before we answer; concurrent trades share one group commit
+    push_to_user(firebase_uid, portfolio_message(firebase_uid))
+
+
+# --- Batch Trade Endpoint ---
+BATCH_BEST_EFFORT = "best_effort"  # Every order stands alone; rejected ones are reported and skipped
+BATCH_ALL_OR_NOTHING = "all_or_nothing"  # Any rejection rolls back the orders already applied
+MAX_BATCH_ORDERS = 500
+
+
+class TradeBatchRequest(BaseModel):
+    orders: List[TradeRequest]
+    mode: str = BATCH_BEST_EFFORT
+
+
+class TradeBatchResponse(BaseModel):
+    mode: str
+    executed: int  # Orders filled or placed on the book
+    rejected: int
+    results: List[Dict[str, Any]]  # One per order, in request order
+
+
+@app.post("/trade/execute-batch", response_model=TradeBatchResponse)
+async def execute_trade_batch(batch: TradeBatchRequest, response: Response,
+                              current_user: User = Depends(get_current_active_user)):
+    """
+    Executes up to MAX_BATCH_ORDERS orders, in order, in one account critical section against one
+    market snapshot, with a single durable commit. Each result has the order's `index` and a
+    `status` of "executed", "placed" (resting limit order), "rejected" (with `status_code` and
+    `detail`) or, when an all_or_nothing batch fails, "rolled_back". A failed all_or_nothing
+    batch changes nothing and answers 400.
+    """
+    mode = batch.mode.lower()
+    if mode not in (BATCH_BEST_EFFORT, BATCH_ALL_OR_NOTHING):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid mode. Must be {BATCH_BEST_EFFORT} or {BATCH_ALL_OR_NOTHING}.")
+    if not 1 <= len(batch.orders) <= MAX_BATCH_ORDERS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"A batch must contain between 1 and {MAX_BATCH_ORDERS} orders")
+
+    firebase_uid = current_user.firebase_uid
+    asset_ids = [trade.asset_id for trade in batch.orders]
+    async with account_locks.hold(firebase_uid):
+        snapshot = market_engine.snapshot  # One price view for the whole batch
+        saved_balance = current_user.balance_usd
+        saved_positions = {}
+        for asset_id in asset_ids:
+            position = position_store.get(firebase_uid, asset_id)
+            saved_positions[asset_id] = (position.quantity, position.average_buy_price) if position else None
+
+        outcomes: List[Any] = []  # TradeResponse or HTTPException per order
+        for trade in batch.orders:
+            try:
+                outcomes.append(_apply_trade(trade, current_user, snapshot))
+            except HTTPException as e:
+                outcomes.append(e)
+                if mode == BATCH_ALL_OR_NOTHING:
+                    break
+
+        applied = [outcome for outcome in outcomes if isinstance(outcome, TradeResponse)]
+        rolled_back = mode == BATCH_ALL_OR_NOTHING and len(applied) < len(outcomes)
+        if rolled_back:
+            current_user.balance_usd = saved_balance
+            for asset_id, saved in saved_positions.items():
+                if saved is None:
+                    position_store.discard(firebase_uid, asset_id)
+                else:
+                    position_store.restore(firebase_uid, asset_id, *saved)
+            for outcome in applied:
+                if outcome.order is not None:
+                    matching_engine.cancel(matching_engine.get(firebase_uid, outcome.order["id"]))
+        elif applied:
+            await _settle_trades(current_user, asset_ids, applied)
+
+    results = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, HTTPException):
+            results.append({"index": index, "status": "rejected", "status_code": outcome.status_code,
+                            "detail": outcome.detail})
+        elif rolled_back:
+            results.append({"index": index, "status": "rolled_back"})
+        else:
+            results.append({"index": index, "status": "executed" if outcome.transaction is not None else "placed",
+                            "message": outcome.message, "transaction": outcome.transaction, "order": outcome.order})
+    for index in range(len(outcomes), len(batch.orders)):  # Not attempted after an all_or_nothing rejection
+        results.append({"index": index, "status": "rolled_back"})
+    if rolled_back:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+    executed = 0 if rolled_back else len(applied)
+    return TradeBatchResponse(mode=mode, executed=executed, rejected=len(outcomes) - len(applied), results=results)
+
+
+async def fill_resting_orders(snapshot) -> Set[str]:
+    """Matches the order books against a new tick and settles the fills. Returns the users whose holdings changed."""
+    # Settlement does not await until its commit, so it never lands inside a locked operation's
+    # check -> mutate step; account_locks only has to cover the request handlers
+    fills = matching_engine.match(snapshot)
+    if not fills:
+        return set()
+    ops = []
+    filled_orders: Dict[str, Order] = {}
+    for order, quantity, price in fills:
+        firebase_uid = order.firebase_uid
+        user = fake_users_db[firebase_uid]  # Owners of resting orders are always loaded
+        if order.side == BUY:
+            user.balance_usd += quantity * (order.price - price)  # Return the part of the hold the better price saved
+            position_store.buy(firebase_uid, order.asset_id, quantity, price)
+        else:
+            position_store.sell(firebase_uid, order.asset_id, quantity)  # Reserved, so always held
+            user.balance_usd += quantity * price
+        transaction_record = {
+            "id": str(uuid.uuid4()),
+            "timestamp": snapshot.timestamp,
+            "type": order.side,
+            "asset_id": order.asset_id,
+            "quantity": quantity,
+            "price_per_unit": price,
+            "total_amount": quantity * price,
+            "status": "COMPLETED",
+            "order_id": order.id,
+            "order_status": order.status,  # PARTIALLY_FILLED until the last fill
+        }
+        transaction_ledger.append(firebase_uid, transaction_record)
+        trades_resting[order.side].inc()
+        valuation_engine.position_changed(firebase_uid, order.asset_id)
+        ops.append(_user_op(user))
+        ops.append(_position_op(firebase_uid, order.asset_id))
+        ops.append(("transaction", firebase_uid, transaction_record))
+        filled_orders[order.id] = order
+    for order in filled_orders.values():
+        ops.append(("order", order.to_dict()) if order.active else ("delete_order", order.id))
+        push_to_user(order.firebase_uid, {"type": "order_update", "order": order.to_dict()})
+    await storage.commit(ops)
+    return {order.firebase_uid for order in filled_orders.values()}
+
+
+async def restore_resting_orders():
+    """Puts resting orders from storage back on the books, loading their owners so fills can settle."""
+    for record in sorted(await storage.load_orders(), key=lambda r: r["seq"]):  # Keeps time priority
+        if not worker_router.owns(record["firebase_uid"]):  # Another worker's user
+            continue
+        if record["firebase_uid"] not in fake_users_db:
+            await _load_or_create_user({"uid": record["firebase_uid"]})
+        matching_engine.add(Order(record["id"], record["firebase_uid"], record["asset_id"], record["side"],
+                                  record["price"], record["quantity"], record["created_at"], filled=record["filled"]))
+
+
+# --- Order Endpoints ---
+class OrderAmendRequest(BaseModel):
+    price_limit: Optional[float] = None
+    quantity: Optional[float] = None  # New total quantity, including anything already filled
+
+
+def _get_open_order(current_user: User, order_id: str) -> Order:
+    order = matching_engine.get(current_user.firebase_uid, order_id)
+    if order is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Open order not found")
+    return order
+
+
+@app.get("/orders", response_model=List[Dict[str, Any]])
+async def get_orders(current_user: User = Depends(get_current_active_user)):
+    """The user's resting limit orders, oldest first."""
+    return [order.to_dict() for order in matching_engine.open_orders(current_user.firebase_uid)]
+
+
+@app.delete("/orders/{order_id}", response_model=Dict[str, Any])
+async def cancel_order(order_id: str, current_user: User = Depends(get_current_active_user)):
+    async with account_locks.hold(current_user.firebase_uid):
+        order = _get_open_order(current_user, order_id)
+        matching_engine.cancel(order)
+        if order.side == BUY:
+            current_user.balance_usd += order.remaining * order.price  # Release the hold
+        await storage.commit([_user_op(current_user), ("delete_order", order.id)])
+        result = order.to_dict()
+        result["status"] = "CANCELLED"
+        return result
+
+
+@app.patch("/orders/{order_id}", response_model=Dict[str, Any])
+async def amend_order(order_id: str, amendment: OrderAmendRequest,
+                      current_user: User = Depends(get_current_active_user)):
+    """
+    Changes an order's limit price and/or total quantity. Reducing the quantity keeps the order's
+    place in the queue; a new price or a larger quantity sends it to the back of its new price level.
+    """
+    async with account_locks.hold(current_user.firebase_uid):
+        order = _get_open_order(current_user, order_id)
+        new_price = order.price if amendment.price_limit is None else amendment.price_limit
+        new_quantity = order.quantity if amendment.quantity is None else amendment.quantity
+        if new_price <= 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Price limit must be positive")
+        if new_quantity <= order.filled:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Quantity must be greater than the quantity already filled")
+
+        new_remaining = new_quantity - order.filled
+        if order.side == BUY:
+            extra_hold = new_remaining * new_price - order.remaining * order.price
+            if current_user.balance_usd < extra_hold:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Insufficient funds")
+            current_user.balance_usd -= extra_hold
+        elif _available_to_sell(current_user.firebase_uid, order.asset_id) < \
+                new_remaining - order.remaining - QUANTITY_EPSILON:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Not enough assets to sell")
+
+        matching_engine.amend(order, price=new_price, quantity=new_quantity)
+        await storage.commit([_user_op(current_user), ("order", order.to_dict())])
+        return order.to_dict()
+
+
 # --- Transactions Endpoint ---
 @app.get("/transactions", response_model=List[Dict[str, Any]])
-async def get_transactions(limit: int = 50, current_user: User = Depends(get_current_active_user)):
-    user_transactions = fake_transactions_db.get(current_user.firebase_uid, [])
-    return user_transactions[:limit]  # Return most recent transactions up to limit
+async def get_transactions(limit: int = Query(50, ge=1, le=500),
+                           before: Optional[int] = None,
+                           after: Optional[int] = None,
+                           tx_type: Optional[str] = Query(None, alias="type"),
+                           asset_id: Optional[str] = None,
+                           current_user: User = Depends(get_current_active_user)):
+    """
+    Most recent transactions first. Page back with `before=<seq of the last entry>`, or fetch
+    newer entries with `after=<seq of the first entry>`. Optional `type` / `asset_id` filters.
+    """
+    firebase_uid = current_user.firebase_uid
+    tx_type = tx_type.upper() if tx_type else None
+    boundary = transaction_ledger.archived_below(firebase_uid)
+    if boundary is None or (after is not None and after >= boundary - 1):  # Served from memory
+        return transaction_ledger.page(firebase_uid, limit=limit, before=before, after=after, type=tx_type,
+                                       asset_id=asset_id)
+    # History older than `boundary` was never loaded (see _load_or_create_user): read that part from storage
+    if after is not None and before is None:  # Oldest first from the cursor: storage first, then memory
+        older = await storage.load_transactions(firebase_uid, limit, before=boundary, after=after, type=tx_type,
+                                                asset_id=asset_id, oldest_first=True)
+        newer = transaction_ledger.page(firebase_uid, limit=limit - len(older), after=after, type=tx_type,
+                                        asset_id=asset_id)
+        return newer + older[::-1]
+    newer = transaction_ledger.page(firebase_uid, limit=limit, before=before, after=after, type=tx_type,
+                                    asset_id=asset_id)
+    if len(newer) == limit:
+        return newer
+    return newer + await storage.load_transactions(firebase_uid, limit - len(newer),
+                                                   before=boundary if before is None else min(before, boundary),
+                                                   after=after, type=tx_type, asset_id=asset_id)
 
 
 # --- Payment Endpoints (Simulated) ---
@@ -442,35 +1107,102 @@ class PaymentIntentCreate(BaseModel):
 class PaymentIntentResponse(PaymentIntentCreate):
     id: str
     status: str  # e.g., "requires_confirmation", "succeeded", "failed"
+    expires_at: Optional[int] = None  # Epoch seconds; an intent still unconfirmed by then is deleted
 
 
-# In-memory store for payment intents (replace with DB in production)
+# Unconfirmed payment intents, in front of `storage`. Each is deleted NOVATRADE_INTENT_TTL seconds after
+# creation unless confirmed first (confirmed ones leave the cache and stay in storage).
+PAYMENT_INTENT_TTL_SECONDS = int(os.environ.get("NOVATRADE_INTENT_TTL", "3600"))
 payment_intents_db: Dict[str, PaymentIntentResponse] = {}
+intent_expiry = TimingWheel(resolution=1.0, slots=4096)  # intent_id -> expires_at, see expiry.py
+payment_intents_expired = metrics.counter("novatrade_payment_intents_expired_total",
+                                          "Unconfirmed payment intents deleted at expiry.").labels()
+
+
+async def expire_payment_intents():
+    """Background task: deletes unconfirmed payment intents once they expire."""
+    while True:
+        await asyncio.sleep(intent_expiry.resolution)
+        ops = []
+        for intent_id in intent_expiry.advance():
+            intent = payment_intents_db.pop(intent_id, None)
+            if intent is not None and intent.status == "requires_confirmation":
+                ops.append(("delete_intent", intent_id))
+        if ops:
+            payment_intents_expired.inc(len(ops))
+            try:
+                await storage.commit(ops)
+            except Exception as e:
+                print(f"Failed to delete expired payment intents: {e}")
+
+
+async def restore_payment_intents():
+    """At startup: expires intents a previous process left unconfirmed, and schedules the rest."""
+    now = time.time()
+    expired = []
+    for record in await storage.load_intents("requires_confirmation"):
+        intent = PaymentIntentResponse(**record)
+        if intent.expires_at is None:  # Created before intents expired
+            intent.expires_at = int(now) + PAYMENT_INTENT_TTL_SECONDS
+        if intent.expires_at <= now:
+            expired.append(("delete_intent", intent.id))
+        else:
+            payment_intents_db.setdefault(intent.id, intent)
+            intent_expiry.schedule(intent.id, intent.expires_at)
+    if expired:
+        payment_intents_expired.inc(len(expired))
+        await storage.commit(expired)
 
 
 @app.post("/payments/create-intent", response_model=PaymentIntentResponse)
-async def create_payment_intent(intent_data: PaymentIntentCreate,
-                                current_user: User = Depends(get_current_active_user)):
+async def create_payment_intent(intent_data: PaymentIntentCreate, response: Response,
+                                current_user: User = Depends(get_current_active_user),
+                                idempotency_key: Optional[str] = Header(None)):
     if intent_data.amount < 1.00:  # Minimum deposit amount
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Minimum deposit amount is $1.00")
 
-    intent_id = f"pi_{uuid.uuid4().hex[:24]}"  # Generate a unique payment intent ID
+    async def create():
+        intent_id = f"pi_{uuid.uuid4().hex[:24]}"  # Generate a unique payment intent ID
 
-    payment_intent = PaymentIntentResponse(
-        id=intent_id,
-        amount=intent_data.amount,
-        currency=intent_data.currency.upper(),  # Store currency in uppercase
-        status="requires_confirmation"
-    )
-    payment_intents_db[intent_id] = payment_intent  # Store in our "DB"
-    return payment_intent
+        payment_intent = PaymentIntentResponse(
+            id=intent_id,
+            amount=intent_data.amount,
+            currency=intent_data.currency.upper(),  # Store currency in uppercase
+            status="requires_confirmation",
+            expires_at=int(time.time()) + PAYMENT_INTENT_TTL_SECONDS,
+        )
+        payment_intents_db[intent_id] = payment_intent  # Store in our "DB"
+        intent_expiry.schedule(intent_id, payment_intent.expires_at)
+        await storage.commit([("intent", dict(payment_intent))])
+        return PaymentIntentResponse(**dict(payment_intent))  # A copy: confirming changes the cached intent
+
+    return await run_idempotent(current_user, "create-intent", idempotency_key, dict(intent_data), response, create)
 
 
 @app.post("/payments/confirm/{intent_id}", response_model=TradeResponse)  # Reusing TradeResponse for message + tx
-async def confirm_payment_intent(intent_id: str, current_user: User = Depends(get_current_active_user)):
+async def confirm_payment_intent(intent_id: str, response: Response,
+                                 current_user: User = Depends(get_current_active_user),
+                                 idempotency_key: Optional[str] = Header(None)):
+    async def confirm():
+        async with account_locks.hold(current_user.firebase_uid):
+            return await _confirm_payment_intent(intent_id, current_user)
+
+    return await run_idempotent(current_user, "confirm-intent", idempotency_key, intent_id, response, confirm)
+
+
+async def _confirm_payment_intent(intent_id: str, current_user: User) -> TradeResponse:
     intent = payment_intents_db.get(intent_id)
     if not intent:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment intent not found")
+        stored = await storage.load_intent(intent_id)
+        if stored is not None:
+            intent = PaymentIntentResponse(**stored)
+            if intent.status == "requires_confirmation":  # Cache it (and expire it) like a new one
+                if intent.expires_at is None:  # Created before intents expired
+                    intent.expires_at = int(time.time()) + PAYMENT_INTENT_TTL_SECONDS
+                intent = payment_intents_db.setdefault(intent_id, intent)
+                intent_expiry.schedule(intent_id, intent.expires_at)
+    if not intent or (intent.status == "requires_confirmation" and intent.expires_at <= time.time()):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment intent not found or expired")
     if intent.status != "requires_confirmation":
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -479,11 +1211,12 @@ async def confirm_payment_intent(intent_id: str, current_user: User = Depends(ge
 
     # Simulate successful payment confirmation
     intent.status = "succeeded"
+    payment_intents_db.pop(intent_id, None)  # Only unconfirmed intents are cached
+    intent_expiry.cancel(intent_id)
     current_user.balance_usd += intent.amount
     fake_users_db[current_user.firebase_uid] = current_user  # Persist balance change
 
     # Record deposit transaction
-    user_transactions = fake_transactions_db.setdefault(current_user.firebase_uid, [])
     deposit_transaction = {
         "id": str(uuid.uuid4()),
         "timestamp": datetime.now(timezone.utc).isoformat(),
@@ -494,7 +1227,12 @@ async def confirm_payment_intent(intent_id: str, current_user: User = Depends(ge
         "total_amount": intent.amount,
         "status": "COMPLETED"
     }
-    user_transactions.insert(0, deposit_transaction)
+    transaction_ledger.append(current_user.firebase_uid, deposit_transaction)
+    await storage.commit([
+        ("intent", dict(intent)),
+        _user_op(current_user),
+        ("transaction", current_user.firebase_uid, deposit_transaction),
+    ])
 
     return TradeResponse(  # Reusing TradeResponse structure for consistency
         message=f"Payment of {intent.currency} {intent.amount:.2f} confirmed successfully.",
@@ -502,6 +1240,85 @@ async def confirm_payment_intent(intent_id: str, current_user: User = Depends(ge
     )
 
 
+# --- Metrics Endpoint ---
+# Values kept elsewhere are read at scrape time, so they cost nothing in between
+metrics.gauge_callback("novatrade_websocket_connections", "Open WebSocket connections.",
+                       lambda: len(manager.active_connections))
+metrics.gauge_callback("novatrade_websocket_users", "Users with an authenticated WebSocket on this worker.",
+                       lambda: len(manager.user_connections))
+metrics.gauge_callback("novatrade_websocket_queued_messages", "Messages waiting in WebSocket send queues.",
+                       lambda: manager.queue_depths()["total"])
+metrics.counter_callback("novatrade_websocket_messages_enqueued_total", "Messages queued for WebSocket clients.",
+                         lambda: manager.messages_enqueued)
+metrics.counter_callback("novatrade_websocket_messages_conflated_total",
+                         "Queued messages replaced by a fresh snapshot because the client fell behind.",
+                         lambda: manager.messages_conflated)
+metrics.counter_callback("novatrade_websocket_clients_dropped_total", "Clients dropped as slow consumers.",
+                         lambda: manager.clients_dropped)
+metrics.counter_callback("novatrade_websocket_send_errors_total", "WebSocket sends that failed.",
+                         lambda: manager.send_errors)
+metrics.gauge_callback("novatrade_websocket_conflated_clients", "WebSocket clients with a max update rate.",
+                       lambda: len(manager.conflated_clients))
+metrics.gauge_callback("novatrade_market_tick", "Number of the current market tick.",
+                       lambda: market_engine.snapshot.tick)
+metrics.counter_callback("novatrade_ticks_missed_total", "Tick deadlines skipped because a tick ran late.",
+                         lambda: tick_scheduler.missed)
+metrics.gauge_callback("novatrade_users_loaded", "Users whose state is held in memory.", lambda: len(fake_users_db))
+metrics.gauge_callback("novatrade_resting_orders", "Limit orders resting on the books.", lambda: len(matching_engine))
+metrics.counter_callback("novatrade_token_cache_hits_total", "ID tokens found in the verified-token cache.",
+                         lambda: token_verifier.hits)
+metrics.counter_callback("novatrade_token_cache_misses_total", "ID tokens verified cryptographically.",
+                         lambda: token_verifier.misses)
+metrics.gauge_callback("novatrade_token_cache_entries", "Verified ID tokens held in the cache.",
+                       lambda: len(token_verifier))
+metrics.counter_callback("novatrade_token_local_verifications_total",
+                         "Cold ID tokens verified locally against Google's signing certs.",
+                         lambda: token_verifier.local_verifications)
+metrics.counter_callback("novatrade_token_fallback_verifications_total",
+                         "Cold ID tokens verified by firebase_admin (no cert for the key id yet, emulator).",
+                         lambda: token_verifier.fallback_verifications)
+metrics.counter_callback("novatrade_token_cold_verify_seconds_total", "Time spent verifying cold ID tokens.",
+                         lambda: token_verifier.cold_seconds_total)
+metrics.counter_callback("novatrade_account_lock_contended_total",
+                         "Account operations that waited for another one on the same account.",
+                         lambda: account_locks.contended)
+metrics.counter_callback("novatrade_requests_forwarded_total", "Requests forwarded to the worker owning the user.",
+                         lambda: worker_router.forwarded)
+metrics.gauge_callback("novatrade_payment_intents_pending", "Unconfirmed payment intents awaiting expiry.",
+                       lambda: len(intent_expiry))
+metrics.gauge_callback("novatrade_idempotency_keys", "Idempotency-Key outcomes held for replay.",
+                       lambda: len(idempotency_cache))
+metrics.counter_callback("novatrade_idempotency_replays_total",
+                         "Retried requests answered from the Idempotency-Key cache.",
+                         lambda: idempotency_cache.replays)
+metrics.gauge_callback("novatrade_http_requests_in_flight", "HTTP requests being handled (admitted, not finished).",
+                       lambda: admission_control.inflight)
+metrics.counter_callback("novatrade_admission_shed_total", "HTTP requests shed with 503 at the in-flight cap.",
+                         lambda: admission_control.shed)
+metrics.counter_callback("novatrade_rate_limited_ip_total", "HTTP requests refused (429) by the per-IP limit.",
+                         lambda: admission_control.ip_limiter.rejected)
+metrics.counter_callback("novatrade_rate_limited_user_total", "HTTP requests refused (429) by the per-user limit.",
+                         lambda: admission_control.user_limiter.rejected)
+metrics.counter_callback("novatrade_websocket_connects_refused_total",
+                         "WebSocket handshakes refused by the per-IP limit.",
+                         lambda: admission_control.websockets_refused)
+if isinstance(tick_bus, SocketTickBus):
+    metrics.counter_callback("novatrade_bus_ticks_conflated_total",
+                             "Ticks from the bus skipped because this worker was still applying older ones.",
+                             lambda: tick_bus.ticks_conflated)
+if isinstance(storage, SQLiteStorage):
+    metrics.counter_callback("novatrade_storage_commits_total", "Operations committed to SQLite.",
+                             lambda: storage.commits)
+    metrics.counter_callback("novatrade_storage_groups_total", "SQLite transactions (group commits).",
+                             lambda: storage.groups)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus scrape endpoint. With several workers each scrape reaches one of them; samples carry `worker`."""
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
+
+
 # --- Main execution (if running directly using `python main.py`) ---
 if __name__ == "__main__":
     # This block is for direct execution. `uvicorn main:app --reload` is preferred for development.
@@ -0,0 +1,182 @@
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from wire import dumps
+
+# Per-tick standard deviation of log returns, by asset type
+DEFAULT_VOLATILITY = {"crypto": 0.004, "forex": 0.0005, "stock": 0.002}
+PRICE_DECIMALS = {"forex": 4}  # Everything else is quoted to 2 decimals
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.flags.writeable = False
+    return array
+
+
+class MarketSnapshot:
+    """
+    Immutable market state for one tick. The REST routes and the WebSocket publisher
+    read the same snapshot, so a client never sees two different "live" prices for a tick.
+
+    Arrays are read-only and indexed like `symbols`; `price_changed` / `change_changed`
+    mark which published values differ from the previous tick.
+    """
+
+    __slots__ = ("tick", "_timestamp", "epoch_ms", "symbols", "index", "types", "prices", "change_24h",
+                 "price_changed", "change_changed", "etag", "_rows", "_fragments", "_body")
+
+    def __init__(self, tick: int, symbols: tuple, index: Dict[str, int], types: tuple,
+                 prices: np.ndarray, change_24h: np.ndarray, price_changed: np.ndarray, change_changed: np.ndarray,
+                 epoch_ms: Optional[int] = None):
+        if epoch_ms is None:
+            epoch_ms = int(time.time() * 1000)
+        self.tick = tick
+        self._timestamp: Optional[str] = None
+        self.epoch_ms = epoch_ms
+        self.symbols = symbols
+        self.index = index
+        self.types = types
+        self.prices = _read_only(prices)
+        self.change_24h = _read_only(change_24h)
+        self.price_changed = _read_only(price_changed)
+        self.change_changed = _read_only(change_changed)
+        self.etag = f'"{tick}-{self.epoch_ms}"'  # Identifies this tick's encoded bodies for If-None-Match
+        self._rows: Optional[List[Dict[str, Any]]] = None
+        self._fragments: Optional[List[bytes]] = None
+        self._body: Optional[bytes] = None
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    @property
+    def timestamp(self) -> str:
+        """ISO 8601 form of `epoch_ms`, formatted on first use (binary clients only need epoch_ms)."""
+        if self._timestamp is None:
+            self._timestamp = datetime.fromtimestamp(self.epoch_ms / 1000, timezone.utc).isoformat()
+        return self._timestamp
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self.index
+
+    def price(self, symbol: str) -> Optional[float]:
+        i = self.index.get(symbol)
+        return None if i is None else float(self.prices[i])
+
+    def asset_type(self, symbol: str) -> Optional[str]:
+        i = self.index.get(symbol)
+        return None if i is None else self.types[i]
+
+    def changed_indices(self) -> List[int]:
+        return np.flatnonzero(self.price_changed | self.change_changed).tolist()
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """All symbols as `{"symbol", "price", "change_24h", "timestamp"}` dicts, built once per snapshot."""
+        if self._rows is None:
+            timestamp = self.timestamp
+            self._rows = [
+                {"symbol": symbol, "price": price, "change_24h": change, "timestamp": timestamp}
+                for symbol, price, change in zip(self.symbols, self.prices.tolist(), self.change_24h.tolist())
+            ]
+        return self._rows
+
+    def rows_for(self, symbols: Iterable[str]) -> List[Dict[str, Any]]:
+        rows = self.rows()
+        return [rows[self.index[s]] for s in symbols if s in self.index]
+
+    def encoded_rows(self, symbols: Optional[Iterable[str]] = None) -> bytes:
+        """
+        JSON array of `rows()` (or just `symbols`), encoded once per snapshot. Filtered
+        bodies are joined from pre-encoded per-symbol fragments, so serving a request
+        costs a join, not a serialization pass.
+        """
+        if self._fragments is None:
+            self._fragments = [dumps(row) for row in self.rows()]
+        if symbols is None:
+            if self._body is None:
+                self._body = b"[" + b",".join(self._fragments) + b"]"
+            return self._body
+        fragments = self._fragments
+        return b"[" + b",".join(fragments[self.index[s]] for s in symbols if s in self.index) + b"]"
+
+
+class MarketEngine:
+    """
+    Simulates every instrument in one vectorized step.
+
+    Prices follow geometric Brownian motion: each tick multiplies every price by
+    exp(-sigma^2 / 2 + sigma * Z), Z ~ N(0, 1), drawn from a seedable generator.
+    change_24h is measured against a fixed reference price derived from the seed
+    data, so it always agrees with the published price.
+    """
+
+    def __init__(self, assets: Dict[str, Dict[str, Any]], extra_symbols: int = 0, seed: Optional[int] = None,
+                 volatility: Optional[Dict[str, float]] = None):
+        self.rng = np.random.default_rng(seed)
+        volatility = {**DEFAULT_VOLATILITY, **(volatility or {})}
+
+        symbols = list(assets)
+        types = [assets[s].get("type", "stock") for s in symbols]
+        prices = [float(assets[s]["price"]) for s in symbols]
+        changes = [float(assets[s].get("change_24h", 0.0)) for s in symbols]
+        # Synthetic instruments for load-testing realistic universes
+        for i in range(extra_symbols):
+            symbols.append(f"SIM{i:05d}")
+            types.append("stock")
+        prices.extend(self.rng.uniform(1.0, 1000.0, extra_symbols).tolist())
+        changes.extend([0.0] * extra_symbols)
+
+        self.symbols = tuple(symbols)
+        self.types = tuple(types)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self._raw_prices = np.array(prices, dtype=np.float64)
+        self._reference = self._raw_prices / (1 + np.array(changes, dtype=np.float64) / 100)
+        self._sigma = np.array([volatility.get(t, volatility["stock"]) for t in self.types], dtype=np.float64)
+        self._drift = -0.5 * self._sigma ** 2  # Keeps the expected price flat
+        self._decimals = np.array([PRICE_DECIMALS.get(t, 2) for t in self.types], dtype=np.int64)
+        self._scale = 10.0 ** self._decimals
+        self.tick = 0
+        self.snapshot = self._publish(np.ones(len(self.symbols), dtype=bool), np.ones(len(self.symbols), dtype=bool))
+
+    def step(self) -> MarketSnapshot:
+        """Advances every instrument by one tick and returns the new snapshot."""
+        shocks = self.rng.standard_normal(len(self.symbols))
+        self._raw_prices *= np.exp(self._drift + self._sigma * shocks)
+        previous = self.snapshot
+        prices, changes = self._quote()
+        return self._publish(prices != previous.prices, changes != previous.change_24h, prices, changes)
+
+    @property
+    def raw_prices(self) -> np.ndarray:
+        """Unrounded prices: the engine's whole state besides the tick number (see tickbus.py)."""
+        return self._raw_prices
+
+    def apply(self, tick: int, epoch_ms: int, raw_prices: np.ndarray) -> MarketSnapshot:
+        """
+        Adopts a tick produced by another worker's engine. The snapshot matches the producer's
+        exactly, and this engine can continue stepping from it if it becomes the producer.
+        """
+        if len(raw_prices) != len(self.symbols):
+            raise ValueError(f"Tick has {len(raw_prices)} prices for {len(self.symbols)} symbols")
+        self._raw_prices = np.array(raw_prices, dtype=np.float64)
+        previous = self.snapshot
+        prices, changes = self._quote()
+        self.tick = tick - 1
+        return self._publish(prices != previous.prices, changes != previous.change_24h, prices, changes, epoch_ms)
+
+    # --- Internals ---
+    def _quote(self):
+        prices = np.round(self._raw_prices * self._scale) / self._scale  # Per-symbol decimals in one pass
+        changes = np.round((self._raw_prices / self._reference - 1) * 10000) / 100
+        return prices, changes
+
+    def _publish(self, price_changed: np.ndarray, change_changed: np.ndarray, prices=None, changes=None,
+                 epoch_ms: Optional[int] = None):
+        if prices is None:
+            prices, changes = self._quote()
+        self.tick += 1
+        self.snapshot = MarketSnapshot(self.tick, self.symbols, self.index, self.types,
+                                       prices, changes, price_changed, change_changed, epoch_ms)
+        return self.snapshot
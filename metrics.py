@@ -0,0 +1,249 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException
+
+# Seconds; spans a cache hit (~10us) to a slow storage commit
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    return ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str):
+        """
+        The series for these label values, created on first use. Look series up once (at
+        startup, or per route) and keep them: recording into one is then a couple of additions.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child(_format_labels(self.labelnames, values))
+        return child
+
+    def _new_child(self, label_text: str):
+        raise NotImplementedError
+
+    def samples(self, const_labels: str) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterSeries:
+    __slots__ = ("label_text", "value")
+
+    def __init__(self, label_text: str):
+        self.label_text = label_text
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self, label_text: str) -> _CounterSeries:
+        return _CounterSeries(label_text)
+
+    def samples(self, const_labels: str) -> List[str]:
+        return [f"{self.name}{_braces(_join(const_labels, child.label_text))} {_format_value(child.value)}"
+                for child in self._children.values()]
+
+
+class _HistogramSeries:
+    __slots__ = ("label_text", "bounds", "counts", "sum")
+
+    def __init__(self, label_text: str, bounds: Tuple[float, ...]):
+        self.label_text = label_text
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self, label_text: str) -> _HistogramSeries:
+        return _HistogramSeries(label_text, self.buckets)
+
+    def samples(self, const_labels: str) -> List[str]:
+        lines = []
+        for child in self._children.values():
+            labels = _join(const_labels, child.label_text)
+            prefix = f"{labels}," if labels else ""
+            counts = list(child.counts)  # Copy first: the totals below must agree with the buckets
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{_format_value(bound)}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{_braces(labels)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{_braces(labels)} {cumulative}")
+        return lines
+
+
+class _Callback(_Metric):
+    """A value read from elsewhere (a counter attribute, a collection's size) when metrics are scraped."""
+
+    def __init__(self, name: str, help_text: str, kind: str, read: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.kind = kind
+        self.read = read
+
+    def samples(self, const_labels: str) -> List[str]:
+        return [f"{self.name}{_braces(const_labels)} {_format_value(self.read())}"]
+
+
+def _join(const_labels: str, label_text: str) -> str:
+    return f"{const_labels},{label_text}" if const_labels and label_text else const_labels or label_text
+
+
+def _braces(labels: str) -> str:
+    return f"{{{labels}}}" if labels else ""
+
+
+class MetricsRegistry:
+    """
+    Metrics for the /metrics endpoint, in the Prometheus text format.
+
+    Hot paths record into series bound ahead of time (`labels(...)`), so a request costs a
+    bisect over the bucket bounds and a few additions, with no label lookups or strings built.
+    Values that already live on other objects (connection counts, cache hits) are registered
+    as callbacks and only read when scraped.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self.const_labels: Dict[str, str] = {}  # Added to every sample, e.g. the worker id
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge_callback(self, name: str, help_text: str, read: Callable[[], float]):
+        self._register(_Callback(name, help_text, "gauge", read))
+
+    def counter_callback(self, name: str, help_text: str, read: Callable[[], float]):
+        self._register(_Callback(name, help_text, "counter", read))
+
+    def render(self) -> str:
+        const_labels = _format_labels(self.const_labels.keys(), self.const_labels.values())
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(const_labels))
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+
+def instrumented_route(latency: Histogram, responses: Counter) -> type:
+    """
+    An APIRoute class (for `app.router.route_class`, before routes are declared) that records
+    each request's handling time in `latency` (labels: method, route) and counts responses in
+    `responses` (labels: method, route, status). Series are bound when the route is declared.
+    """
+
+    class InstrumentedRoute(APIRoute):
+        def get_route_handler(self) -> Callable:
+            handler = super().get_route_handler()
+            method = ",".join(sorted(self.methods or ()))
+            series = latency.labels(method, self.path_format)
+            by_status: Dict[int, _CounterSeries] = {}
+            perf_counter = time.perf_counter
+
+            async def timed_handler(request):
+                start = perf_counter()
+                status_code = 500
+                try:
+                    response = await handler(request)
+                    status_code = response.status_code
+                    return response
+                except HTTPException as e:
+                    status_code = e.status_code
+                    raise
+                except RequestValidationError:
+                    status_code = 422
+                    raise
+                finally:
+                    series.observe(perf_counter() - start)
+                    counter = by_status.get(status_code)
+                    if counter is None:
+                        counter = by_status[status_code] = responses.labels(method, self.path_format, str(status_code))
+                    counter.value += 1
+
+            return timed_handler
+
+    return InstrumentedRoute
+
+
+def timed(series: _HistogramSeries) -> Callable:
+    """Decorator recording an async function's run time (e.g. a FastAPI dependency) in a histogram series."""
+
+    def decorator(fn):
+        @functools.wraps(fn)  # FastAPI reads the dependency's signature through __wrapped__
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+async def monitor_event_loop_lag(series: _HistogramSeries, interval: float = 0.25):
+    """
+    Background task: sleeps `interval` seconds at a time and records how late it woke up, i.e.
+    how long callbacks that were ready waited for the event loop (blocking code, long ticks).
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        series.observe(max(0.0, loop.time() - start - interval))
@@ -0,0 +1,221 @@
+import heapq
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+
+from market_engine import MarketSnapshot
+from positions import QUANTITY_EPSILON
+
+BUY = "BUY"
+SELL = "SELL"
+
+# Stale heap entries (cancelled or re-prioritised orders) are swept once they outnumber live ones
+_COMPACT_MIN_STALE = 64
+
+
+class Order:
+    """A resting limit order. `seq` is its time priority; amending the price or size up gives it a new one."""
+
+    __slots__ = ("id", "firebase_uid", "asset_id", "side", "price", "quantity", "filled", "seq", "created_at",
+                 "active")
+
+    def __init__(self, id: str, firebase_uid: str, asset_id: str, side: str, price: float, quantity: float,
+                 created_at: str, filled: float = 0.0):
+        self.id = id
+        self.firebase_uid = firebase_uid
+        self.asset_id = asset_id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.filled = filled
+        self.seq = 0
+        self.created_at = created_at
+        self.active = False
+
+    @property
+    def remaining(self) -> float:
+        return self.quantity - self.filled
+
+    @property
+    def status(self) -> str:
+        if self.filled >= self.quantity:
+            return "FILLED"
+        return "PARTIALLY_FILLED" if self.filled > 0 else "OPEN"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "firebase_uid": self.firebase_uid,
+            "asset_id": self.asset_id,
+            "side": self.side,
+            "price": self.price,
+            "quantity": self.quantity,
+            "filled": self.filled,
+            "remaining": self.remaining,
+            "status": self.status,
+            "seq": self.seq,
+            "created_at": self.created_at,
+        }
+
+
+class AssetBook:
+    """
+    One asset's resting orders with price-time priority.
+
+    Bids are a max-heap and asks a min-heap keyed on (price, seq), so placing an order
+    and taking the best one are O(log n). Cancels are lazy: the order is marked inactive
+    and its entry is discarded when it reaches the top, with a full sweep once stale
+    entries outnumber live ones (amortized O(1) per cancel).
+    """
+
+    __slots__ = ("bids", "asks", "live", "stale")
+
+    def __init__(self):
+        self.bids: List[Tuple[float, int, Order]] = []  # (-price, seq, order)
+        self.asks: List[Tuple[float, int, Order]] = []  # (price, seq, order)
+        self.live = 0
+        self.stale = 0
+
+    def push(self, order: Order):
+        if order.side == BUY:
+            heapq.heappush(self.bids, (-order.price, order.seq, order))
+        else:
+            heapq.heappush(self.asks, (order.price, order.seq, order))
+        self.live += 1
+
+    def discard(self, order: Order):
+        """The order's current heap entry no longer counts; it is dropped lazily."""
+        self.live -= 1
+        self.stale += 1
+        if self.stale > self.live and self.stale >= _COMPACT_MIN_STALE:
+            self.bids = [e for e in self.bids if _is_live(e)]
+            self.asks = [e for e in self.asks if _is_live(e)]
+            heapq.heapify(self.bids)
+            heapq.heapify(self.asks)
+            self.stale = 0
+
+    def best(self, side: str) -> Optional[Order]:
+        heap = self.bids if side == BUY else self.asks
+        while heap and not _is_live(heap[0]):
+            heapq.heappop(heap)
+            self.stale -= 1
+        return heap[0][2] if heap else None
+
+    def pop_best(self, side: str):
+        heapq.heappop(self.bids if side == BUY else self.asks)
+        self.live -= 1
+
+
+def _is_live(entry: Tuple[float, int, Order]) -> bool:
+    order = entry[2]
+    return order.active and order.seq == entry[1]
+
+
+class MatchingEngine:
+    """
+    Per-asset limit order books matched against the simulated market on every tick.
+
+    The simulated market is the counterparty: on each tick, bids at or above the price
+    and asks at or below it fill at the market price, best price first and oldest first
+    within a price. Each side of each asset can absorb `liquidity_usd` of notional per
+    tick, so large orders fill partially across several ticks. The engine only tracks
+    orders; balances, positions and the ledger are settled by the caller from the fills.
+    """
+
+    def __init__(self, liquidity_usd: float = 100000.0):
+        self.liquidity_usd = liquidity_usd
+        self.books: Dict[str, AssetBook] = {}
+        self.orders: Dict[str, Order] = {}
+        self._by_user: Dict[str, Dict[str, Order]] = {}
+        self._reserved: Dict[Tuple[str, str], float] = {}  # (uid, asset) -> quantity held by resting SELLs
+        self._seq = itertools.count(1)
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def add(self, order: Order) -> Order:
+        order.seq = next(self._seq)
+        order.active = True
+        self.orders[order.id] = order
+        self._by_user.setdefault(order.firebase_uid, {})[order.id] = order
+        if order.side == SELL:
+            self._reserve(order, order.remaining)
+        self.books.setdefault(order.asset_id, AssetBook()).push(order)
+        return order
+
+    def get(self, firebase_uid: str, order_id: str) -> Optional[Order]:
+        return self._by_user.get(firebase_uid, {}).get(order_id)
+
+    def open_orders(self, firebase_uid: str) -> List[Order]:
+        return sorted(self._by_user.get(firebase_uid, {}).values(), key=lambda o: o.seq)
+
+    def reserved_quantity(self, firebase_uid: str, asset_id: str) -> float:
+        """Quantity of `asset_id` promised to the user's resting SELL orders."""
+        return self._reserved.get((firebase_uid, asset_id), 0.0)
+
+    def cancel(self, order: Order):
+        if order.side == SELL:
+            self._reserve(order, -order.remaining)
+        self._remove(order)  # Marks it inactive first, so a compaction in discard() sweeps its entry
+        self.books[order.asset_id].discard(order)
+
+    def amend(self, order: Order, price: Optional[float] = None, quantity: Optional[float] = None):
+        """
+        Changes the limit price and/or total quantity (which must stay above what already filled).
+        Reducing the quantity keeps time priority; a new price or a larger size re-queues the order.
+        """
+        new_price = order.price if price is None else price
+        new_quantity = order.quantity if quantity is None else quantity
+        if order.side == SELL:
+            self._reserve(order, (new_quantity - order.filled) - order.remaining)
+        keeps_priority = new_price == order.price and new_quantity <= order.quantity
+        order.price = new_price
+        order.quantity = new_quantity
+        if not keeps_priority:
+            book = self.books[order.asset_id]
+            order.seq = next(self._seq)  # The old heap entry no longer matches, so it is now stale
+            book.discard(order)
+            book.push(order)
+
+    def match(self, snapshot: MarketSnapshot) -> List[Tuple[Order, float, float]]:
+        """Fills crossed orders at the snapshot's prices and returns (order, quantity, price) per fill."""
+        fills: List[Tuple[Order, float, float]] = []
+        for asset_id, book in self.books.items():
+            if not book.live:
+                continue
+            market_price = snapshot.price(asset_id)
+            if market_price is None:
+                continue
+            for side in (BUY, SELL):
+                available = self.liquidity_usd / market_price
+                while available > QUANTITY_EPSILON:
+                    order = book.best(side)
+                    if order is None or (order.price < market_price if side == BUY else order.price > market_price):
+                        break
+                    quantity = min(order.remaining, available)
+                    available -= quantity
+                    order.filled += quantity
+                    if order.side == SELL:
+                        self._reserve(order, -quantity)
+                    if order.remaining <= QUANTITY_EPSILON:
+                        order.filled = order.quantity
+                        book.pop_best(side)
+                        self._remove(order)
+                    fills.append((order, quantity, market_price))
+        return fills
+
+    # --- Internals ---
+    def _remove(self, order: Order):
+        order.active = False
+        del self.orders[order.id]
+        user_orders = self._by_user[order.firebase_uid]
+        del user_orders[order.id]
+        if not user_orders:
+            del self._by_user[order.firebase_uid]
+
+    def _reserve(self, order: Order, delta: float):
+        key = (order.firebase_uid, order.asset_id)
+        reserved = self._reserved.get(key, 0.0) + delta
+        if reserved <= QUANTITY_EPSILON:
+            self._reserved.pop(key, None)
+        else:
+            self._reserved[key] = reserved
@@ -0,0 +1,86 @@
+from typing import Dict, Iterator, Optional
+
+# Positions smaller than this after a sell are treated as closed (avoids float dust like 1e-17)
+QUANTITY_EPSILON = 1e-12
+
+
+class Position:
+    """One holding. `__slots__` keeps it to three fields with no per-instance dict."""
+
+    __slots__ = ("asset_id", "quantity", "average_buy_price")
+
+    def __init__(self, asset_id: str, quantity: float, average_buy_price: float):
+        self.asset_id = asset_id
+        self.quantity = quantity
+        self.average_buy_price = average_buy_price
+
+    @property
+    def cost_basis(self) -> float:
+        return self.quantity * self.average_buy_price
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"asset_id": self.asset_id, "quantity": self.quantity, "average_buy_price": self.average_buy_price}
+
+
+class PositionStore:
+    """
+    Positions keyed by (firebase_uid, asset_id), stored as uid -> {asset_id -> Position}.
+
+    Lookup, insert and delete are O(1) dict operations, and a user's holdings can be
+    iterated without scanning anyone else's.
+    """
+
+    def __init__(self):
+        self._by_user: Dict[str, Dict[str, Position]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(holdings) for holdings in self._by_user.values())
+
+    def ensure_user(self, firebase_uid: str):
+        self._by_user.setdefault(firebase_uid, {})
+
+    def get(self, firebase_uid: str, asset_id: str) -> Optional[Position]:
+        holdings = self._by_user.get(firebase_uid)
+        return holdings.get(asset_id) if holdings else None
+
+    def holdings(self, firebase_uid: str) -> Iterator[Position]:
+        return iter(self._by_user.get(firebase_uid, {}).values())
+
+    def restore(self, firebase_uid: str, asset_id: str, quantity: float, average_buy_price: float):
+        """Puts back a position loaded from storage as-is."""
+        self._by_user.setdefault(firebase_uid, {})[asset_id] = Position(asset_id, quantity, average_buy_price)
+
+    def discard(self, firebase_uid: str, asset_id: str):
+        """Drops a position outright (undoing changes that were never committed)."""
+        holdings = self._by_user.get(firebase_uid)
+        if holdings:
+            holdings.pop(asset_id, None)
+
+    def buy(self, firebase_uid: str, asset_id: str, quantity: float, price: float) -> Position:
+        """Adds to (or opens) a position, updating the average buy price."""
+        holdings = self._by_user.setdefault(firebase_uid, {})
+        position = holdings.get(asset_id)
+        if position is None:
+            position = holdings[asset_id] = Position(asset_id, quantity, price)
+            return position
+        new_total_quantity = position.quantity + quantity
+        # New average buy price: (old_total_cost + new_trade_cost) / new_total_quantity
+        position.average_buy_price = (position.cost_basis + price * quantity) / new_total_quantity
+        position.quantity = new_total_quantity
+        return position
+
+    def sell(self, firebase_uid: str, asset_id: str, quantity: float) -> Optional[Position]:
+        """
+        Reduces a position, deleting it once it reaches zero. Returns the remaining position
+        (None if closed). Raises ValueError if the user does not hold `quantity`; a shortfall of
+        float dust (up to QUANTITY_EPSILON) sells what is held.
+        """
+        holdings = self._by_user.get(firebase_uid)
+        position = holdings.get(asset_id) if holdings else None
+        if position is None or position.quantity < quantity - QUANTITY_EPSILON:
+            raise ValueError("Not enough assets to sell")
+        position.quantity -= min(quantity, position.quantity)
+        if position.quantity <= QUANTITY_EPSILON:  # Remove asset from portfolio if quantity is zero
+            del holdings[asset_id]
+            return None
+        return position
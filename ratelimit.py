@@ -0,0 +1,176 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from cluster import bearer_token
+from wire import dumps
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class TokenBucketLimiter:
+    """
+    One token bucket per key (a user, an IP): `burst` tokens, refilled at `rate` per second.
+
+    A check is a dict lookup and a few float operations; buckets are refilled lazily when
+    their key is next seen, so idle keys cost nothing. At most `max_keys` buckets are kept,
+    least recently used dropped first (a dropped bucket was idle long enough to be nearly
+    full anyway). A rate of 0 disables the limiter.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, _Bucket]" = OrderedDict()
+        # Counters
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Takes `cost` tokens and returns 0, or takes nothing and returns the seconds until it could."""
+        if self.rate <= 0:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = _Bucket(self.burst, now)
+            if len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        cost = min(cost, self.burst)  # A cost above the burst could never be paid
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return 0.0
+        self.rejected += 1
+        return (cost - bucket.tokens) / self.rate
+
+
+class AdmissionControl:
+    """
+    Decides whether a request is served at all, before any work is done on it.
+
+    HTTP requests are shed with 503 while `max_inflight` requests are already being handled,
+    then charged their route's cost (`route_costs`: path prefix -> tokens, default 1) against
+    the client IP's bucket and, for a valid bearer token, the user's bucket; an empty bucket
+    answers 429. Both carry Retry-After. WebSocket handshakes are charged to the IP's connect
+    bucket and refused (HTTP 403) when it is empty.
+
+    `charge_user(scope, uid)` says whether this process should charge the user's bucket;
+    with several workers it is the worker that ends up serving the request, so every request
+    is charged once. Requests forwarded from another worker were admitted there and arrive
+    from a loopback address, so they only go through that user check.
+    """
+
+    def __init__(self, ip_limiter: TokenBucketLimiter, user_limiter: TokenBucketLimiter,
+                 connect_limiter: TokenBucketLimiter, max_inflight: int, route_costs: Dict[str, float],
+                 resolve_uid: Callable[[dict, str], Awaitable[Optional[str]]],
+                 charge_user: Callable[[dict, str], bool] = lambda scope, uid: True):
+        self.ip_limiter = ip_limiter
+        self.user_limiter = user_limiter
+        self.connect_limiter = connect_limiter
+        self.max_inflight = max_inflight
+        self.route_costs = sorted(route_costs.items(), key=lambda item: -len(item[0]))  # Longest prefix wins
+        self.resolve_uid = resolve_uid
+        self.charge_user = charge_user
+        self.inflight = 0
+        # Counters
+        self.shed = 0
+        self.websockets_refused = 0
+
+    def cost(self, path: str) -> float:
+        for prefix, cost in self.route_costs:
+            if path.startswith(prefix):
+                return cost
+        return 1.0
+
+    async def check_http(self, scope) -> Optional[Tuple[int, str, float]]:
+        """None to admit the request, else (status code, detail, seconds to wait)."""
+        cost = self.cost(scope["path"])
+        if not scope.get("novatrade.forwarded"):
+            if self.inflight >= self.max_inflight:
+                self.shed += 1
+                return 503, "Server busy, retry shortly", 1.0
+            client = scope.get("client")
+            wait = self.ip_limiter.acquire(client[0], cost) if client else 0.0
+            if wait:
+                return 429, "Too many requests from this address", wait
+        if self.user_limiter.enabled:
+            token = bearer_token(scope)
+            uid = await self.resolve_uid(scope, token) if token else None
+            if uid is not None and self.charge_user(scope, uid):
+                wait = self.user_limiter.acquire(uid, cost)
+                if wait:
+                    return 429, "Too many requests for this user", wait
+        return None
+
+    def check_websocket(self, scope) -> bool:
+        client = scope.get("client")
+        if client and self.connect_limiter.acquire(client[0]):
+            self.websockets_refused += 1
+            return False
+        return True
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying an AdmissionControl; rejections never reach the app."""
+
+    def __init__(self, app, control: AdmissionControl):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        control = self.control
+        if scope["type"] == "websocket":
+            if not control.check_websocket(scope):
+                await send({"type": "websocket.close", "code": 1013})  # Before accept: the handshake gets a 403
+                return
+            return await self.app(scope, receive, send)
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        rejection = await control.check_http(scope)
+        if rejection is not None:
+            return await _reject(send, *rejection)
+        control.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            control.inflight -= 1
+
+
+async def _reject(send, status_code: int, detail: str, retry_after: float):
+    body = dumps({"detail": detail})
+    await send({"type": "http.response.start", "status": status_code, "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode("latin-1")),
+        (b"retry-after", str(max(1, math.ceil(retry_after))).encode("latin-1")),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def parse_route_costs(text: str) -> Dict[str, float]:
+    """Route costs from "prefix=cost,...", e.g. "/trade/execute-batch=10,/market/=1"."""
+    costs = {}
+    for part in text.split(","):
+        if part.strip():
+            prefix, _, cost = part.partition("=")
+            costs[prefix.strip()] = float(cost)
+    return costs
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Optional
+
+
+class TickScheduler:
+    """
+    Fixed-rate deadlines for a periodic task, on the event loop's clock.
+
+    Tick n is due at start + n * interval, so the time spent handling a tick does not push
+    the following ones back: the period never drifts, whatever each tick costs, as long as
+    it costs less than `interval`. When a tick starts so late that later deadlines have
+    already passed too, those are skipped rather than run back to back (a burst of stale
+    ticks helps nobody) and counted in `missed`.
+    """
+
+    def __init__(self, interval: float):
+        if interval <= 0:
+            raise ValueError(f"Tick interval must be positive, got {interval}")
+        self.interval = interval
+        self._deadline: Optional[float] = None
+        # Counters
+        self.ticks = 0
+        self.missed = 0
+
+    async def wait(self) -> float:
+        """Sleeps until the next deadline and returns how late it woke up, in seconds."""
+        loop = asyncio.get_running_loop()
+        if self._deadline is None:
+            self._deadline = loop.time() + self.interval
+        delay = self._deadline - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        late = max(0.0, loop.time() - self._deadline)
+        if late >= self.interval:
+            skipped = int(late // self.interval)
+            self.missed += skipped
+            self._deadline += skipped * self.interval
+        self._deadline += self.interval
+        self.ticks += 1
+        return late
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# A write is a list of ops committed atomically. Each op is a tuple:
+#   ("user", user_dict) | ("position", uid, asset_id, quantity, average_buy_price)
+#   ("delete_position", uid, asset_id) | ("transaction", uid, record) | ("intent", intent_dict)
+#   ("delete_intent", intent_id) | ("order", order_dict) | ("delete_order", order_id)
+Op = Tuple[Any, ...]
+
+
+class Storage:
+    """
+    Interface for the durable store behind the in-memory caches in main.py.
+
+    Reads hydrate one user at a time on a cache miss, so startup cost does not grow
+    with the number of accounts. `commit` returns once its ops are durable.
+
+    Callers change their in-memory state first and commit after, and nothing is undone if the
+    commit raises: the request fails, but memory stays ahead of disk until a later commit of the
+    same rows (user and position rows are written whole) or a restart reloads what is durable.
+    """
+
+    def max_ids(self) -> Tuple[int, int]:
+        """(highest local user id, highest transaction seq), used to resume the counters."""
+        return 0, 0
+
+    async def load_user(self, firebase_uid: str, recent_transactions: int) -> Optional[Dict[str, Any]]:
+        """
+        {"user": dict, "positions": [(asset_id, qty, avg)], "transactions": [record, ...],
+        "more_transactions": bool} or None. Only the newest `recent_transactions` records are
+        loaded (oldest first); `more_transactions` says whether older ones exist.
+        """
+        return None
+
+    async def load_transactions(self, firebase_uid: str, limit: int, before: Optional[int] = None,
+                                after: Optional[int] = None, type: Optional[str] = None,
+                                asset_id: Optional[str] = None, oldest_first: bool = False) -> List[Dict[str, Any]]:
+        """Up to `limit` records with seq in (after, before) matching the filters, newest first by default."""
+        return []
+
+    async def load_intent(self, intent_id: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    async def load_intents(self, status: str) -> List[Dict[str, Any]]:
+        """Every payment intent with this status."""
+        return []
+
+    async def load_orders(self) -> List[Dict[str, Any]]:
+        """Every resting limit order. They are matched on every tick, so all of them are loaded at startup."""
+        return []
+
+    async def commit(self, ops: List[Op]):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    """Durability off: nothing is written and nothing survives a restart."""
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    firebase_uid TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    email TEXT,
+    full_name TEXT,
+    is_active INTEGER NOT NULL,
+    balance_usd REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS positions (
+    firebase_uid TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    average_buy_price REAL NOT NULL,
+    PRIMARY KEY (firebase_uid, asset_id)
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    seq INTEGER PRIMARY KEY,
+    firebase_uid TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_by_user ON transactions (firebase_uid, seq);
+CREATE TABLE IF NOT EXISTS payment_intents (
+    id TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+);
+"""
+
+
+class SQLiteStorage(Storage):
+    """
+    SQLite in WAL mode with group commit.
+
+    `commit` hands its ops to a single writer thread and awaits a future. The writer
+    takes everything that queued up while the previous transaction was being written
+    and commits it as one SQLite transaction, so N concurrent trades cost one fsync
+    instead of N, and the event loop never blocks on disk. If a group fails, its commits
+    are retried one by one so a single bad write cannot fail its neighbours.
+
+    Crash recovery is SQLite's: the tables are the snapshot and the WAL is replayed on
+    open. `synchronous` picks the durability level ("FULL" fsyncs every group, "OFF"
+    leaves flushing to the OS).
+    """
+
+    def __init__(self, path: str, synchronous: str = "FULL", max_batch: int = 1024):
+        self.path = path
+        self.synchronous = synchronous
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._reader = self._connect()
+        self._reader.executescript(_SCHEMA)
+        self._read_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._writer_loop, name="sqlite-group-commit", daemon=True)
+        self._writer.start()
+        # Counters
+        self.commits = 0
+        self.groups = 0
+
+    def max_ids(self) -> Tuple[int, int]:
+        with self._read_lock:
+            max_user_id = self._reader.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+            max_seq = self._reader.execute("SELECT COALESCE(MAX(seq), 0) FROM transactions").fetchone()[0]
+        return max_user_id, max_seq
+
+    async def load_user(self, firebase_uid: str, recent_transactions: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load_user, firebase_uid, recent_transactions)
+
+    async def load_transactions(self, firebase_uid: str, limit: int, before: Optional[int] = None,
+                                after: Optional[int] = None, type: Optional[str] = None,
+                                asset_id: Optional[str] = None, oldest_first: bool = False) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load_transactions, firebase_uid, limit, before, after, type, asset_id,
+                                       oldest_first)
+
+    async def load_intent(self, intent_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load_intent, intent_id)
+
+    async def load_intents(self, status: str) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load_intents, status)
+
+    async def load_orders(self) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load_orders)
+
+    async def commit(self, ops: List[Op]):
+        if not ops:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((ops, future))
+        await future
+
+    async def close(self):
+        self._queue.put(None)
+        await asyncio.to_thread(self._writer.join)
+        self._reader.close()
+
+    # --- Internals ---
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    def _load_user(self, firebase_uid: str, recent_transactions: int) -> Optional[Dict[str, Any]]:
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT id, email, full_name, is_active, balance_usd FROM users WHERE firebase_uid = ?",
+                (firebase_uid,)).fetchone()
+            if row is None:
+                return None
+            positions = self._reader.execute(
+                "SELECT asset_id, quantity, average_buy_price FROM positions WHERE firebase_uid = ?",
+                (firebase_uid,)).fetchall()
+            rows = self._reader.execute(  # One extra row tells whether older history exists
+                "SELECT record FROM transactions WHERE firebase_uid = ? ORDER BY seq DESC LIMIT ?",
+                (firebase_uid, recent_transactions + 1)).fetchall()
+        more = len(rows) > recent_transactions
+        transactions = [json.loads(r[0]) for r in reversed(rows[:recent_transactions])]
+        user = {"id": row[0], "firebase_uid": firebase_uid, "email": row[1], "full_name": row[2],
+                "is_active": bool(row[3]), "balance_usd": row[4]}
+        return {"user": user, "positions": positions, "transactions": transactions, "more_transactions": more}
+
+    def _load_transactions(self, firebase_uid: str, limit: int, before: Optional[int], after: Optional[int],
+                           type: Optional[str], asset_id: Optional[str], oldest_first: bool) -> List[Dict[str, Any]]:
+        conditions, params = ["firebase_uid = ?"], [firebase_uid]
+        for condition, value in (("seq < ?", before), ("seq > ?", after),
+                                 ("json_extract(record, '$.type') = ?", type),
+                                 ("json_extract(record, '$.asset_id') = ?", asset_id)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = (f"SELECT record FROM transactions WHERE {' AND '.join(conditions)} "
+                 f"ORDER BY seq {'ASC' if oldest_first else 'DESC'} LIMIT ?")
+        with self._read_lock:
+            rows = self._reader.execute(query, (*params, limit)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def _load_intent(self, intent_id: str) -> Optional[Dict[str, Any]]:
+        with self._read_lock:
+            row = self._reader.execute("SELECT record FROM payment_intents WHERE id = ?", (intent_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _load_intents(self, status: str) -> List[Dict[str, Any]]:
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT record FROM payment_intents WHERE json_extract(record, '$.status') = ?", (status,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def _load_orders(self) -> List[Dict[str, Any]]:
+        with self._read_lock:
+            rows = self._reader.execute("SELECT record FROM orders").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, ops: List[Op]):
+        for op in ops:
+            kind = op[0]
+            if kind == "user":
+                u = op[1]
+                conn.execute(
+                    "INSERT OR REPLACE INTO users (firebase_uid, id, email, full_name, is_active, balance_usd) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (u["firebase_uid"], u["id"], u["email"], u["full_name"], int(u["is_active"]), u["balance_usd"]))
+            elif kind == "position":
+                conn.execute("INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?)", op[1:])
+            elif kind == "delete_position":
+                conn.execute("DELETE FROM positions WHERE firebase_uid = ? AND asset_id = ?", op[1:])
+            elif kind == "transaction":
+                conn.execute("INSERT INTO transactions (seq, firebase_uid, record) VALUES (?, ?, ?)",
+                             (op[2]["seq"], op[1], json.dumps(op[2], separators=(",", ":"))))
+            elif kind == "intent":
+                conn.execute("INSERT OR REPLACE INTO payment_intents (id, record) VALUES (?, ?)",
+                             (op[1]["id"], json.dumps(op[1], separators=(",", ":"))))
+            elif kind == "delete_intent":  # Expiry: never deletes an intent another worker has confirmed meanwhile
+                conn.execute("DELETE FROM payment_intents WHERE id = ? "
+                             "AND json_extract(record, '$.status') = 'requires_confirmation'", (op[1],))
+            elif kind == "order":
+                conn.execute("INSERT OR REPLACE INTO orders (id, record) VALUES (?, ?)",
+                             (op[1]["id"], json.dumps(op[1], separators=(",", ":"))))
+            elif kind == "delete_order":
+                conn.execute("DELETE FROM orders WHERE id = ?", (op[1],))
+            else:
+                raise ValueError(f"Unknown storage op: {kind}")
+
+    def _write_group(self, conn: sqlite3.Connection, batch) -> List[Optional[BaseException]]:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for ops, _ in batch:
+                self._apply(conn, ops)
+            conn.execute("COMMIT")
+            return [None] * len(batch)
+        except Exception:
+            if conn.in_transaction:  # Not when BEGIN itself failed (e.g. another connection holds the write lock)
+                conn.execute("ROLLBACK")
+            if len(batch) == 1:
+                raise
+        results: List[Optional[BaseException]] = []
+        for item in batch:  # Isolate the bad commit(s)
+            try:
+                results.extend(self._write_group(conn, [item]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _writer_loop(self):
+        conn = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.max_batch:  # Everything that queued up during the last write
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # Finish this group, then stop
+                    break
+                batch.append(item)
+            try:
+                results = self._write_group(conn, batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            self.groups += 1
+            self.commits += len(batch)
+            for (_, future), error in zip(batch, results):
+                future.get_loop().call_soon_threadsafe(_resolve, future, error)
+        conn.close()
+
+
+def _resolve(future: asyncio.Future, error: Optional[BaseException]):
+    if future.done():  # Caller was cancelled
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
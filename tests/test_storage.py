@@ -0,0 +1,45 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from storage import SQLiteStorage
+
+
+class NoWaitStorage(SQLiteStorage):
+    """Fails a locked BEGIN at once instead of after SQLite's default 5 s busy timeout."""
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = super()._connect()
+        conn.execute("PRAGMA busy_timeout=0")
+        return conn
+
+
+def user_op(uid: str, balance: float):
+    return ("user", {"firebase_uid": uid, "id": 1, "email": None, "full_name": None, "is_active": True,
+                     "balance_usd": balance})
+
+
+def test_commits_fail_when_begin_fails(tmp_path):
+    path = str(tmp_path / "novatrade.db")
+
+    async def scenario():
+        storage = NoWaitStorage(path)
+        blocker = sqlite3.connect(path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")  # Holds the write lock, so the writer's BEGIN fails
+        try:
+            results = await asyncio.wait_for(asyncio.gather(
+                *(storage.commit([user_op(f"u{i}", 100.0)]) for i in range(4)), return_exceptions=True), 10)
+        finally:
+            blocker.execute("ROLLBACK")
+            blocker.close()
+        await asyncio.wait_for(storage.commit([user_op("u0", 50.0)]), 10)  # The writer recovers
+        loaded = await storage.load_user("u0", 0)
+        await storage.close()
+        return results, loaded
+
+    results, loaded = asyncio.run(scenario())
+    assert len(results) == 4
+    for result in results:
+        assert isinstance(result, sqlite3.OperationalError)
+    assert loaded["user"]["balance_usd"] == pytest.approx(50.0)
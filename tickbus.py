@@ -0,0 +1,244 @@
+import asyncio
+import fcntl
+import json
+import os
+import struct
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+TickHandler = Callable[[int, int, np.ndarray], Awaitable[None]]  # (tick, epoch_ms, raw_prices)
+MessageHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+BROADCAST = -1
+
+# Frame: payload length, kind, payload
+_FRAME = struct.Struct("!IB")
+_HELLO, _TICK, _MESSAGE = 1, 2, 3
+_TICK_HEADER = struct.Struct("!qqI")  # tick, epoch_ms, symbol count; followed by float64 raw prices
+_MESSAGE_HEADER = struct.Struct("!i")  # destination worker (BROADCAST for all others); followed by JSON
+
+# A peer that falls this far behind is disconnected rather than buffered without bound
+_MAX_PEER_BUFFER = 64 * 1024 * 1024
+# Received ticks waiting to be applied. Each carries the full raw prices, so when a follower falls
+# behind the oldest ones are dropped: applying the newest catches its engine up all the same
+_MAX_PENDING_TICKS = 4
+
+
+def _frame(kind: int, payload: bytes) -> bytes:
+    return _FRAME.pack(len(payload), kind) + payload
+
+
+def _message_frame(message: Dict[str, Any], to: int) -> bytes:
+    return _frame(_MESSAGE, _MESSAGE_HEADER.pack(to) + json.dumps(message, separators=(",", ":")).encode())
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    length, kind = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return kind, await reader.readexactly(length)
+
+
+class LocalTickBus:
+    """
+    Tick bus for a single worker: this process always produces ticks and there is nobody
+    else to talk to. SocketTickBus has the same interface for `--workers N`.
+
+    Producers call `publish_tick` after stepping their own engine; `on_tick` only fires for
+    ticks produced by another worker. `send` delivers JSON messages to another worker (or to
+    every other worker with BROADCAST) and `on_message` receives them.
+    """
+
+    def __init__(self):
+        self.worker_id = 0
+        self.workers = 1
+        self.on_tick: Optional[TickHandler] = None
+        self.on_message: Optional[MessageHandler] = None
+
+    @property
+    def is_producer(self) -> bool:
+        return True
+
+    async def start(self):
+        pass
+
+    def publish_tick(self, tick: int, epoch_ms: int, raw_prices: np.ndarray):
+        pass
+
+    def send(self, message: Dict[str, Any], to: int = BROADCAST):
+        if to == self.worker_id:
+            self._deliver(message)
+
+    def _deliver(self, message: Dict[str, Any]):
+        if self.on_message is not None:
+            asyncio.ensure_future(self.on_message(message))
+
+
+class SocketTickBus(LocalTickBus):
+    """
+    Tick bus shared by the workers of one box over a Unix domain socket.
+
+    Whichever worker holds an exclusive flock on `<path>.lock` is the producer. It steps the
+    market engine and runs the hub at `path`. The hub sends every tick to all other workers
+    and relays messages between them. The other workers connect to the hub and apply the
+    ticks it sends. Ticks carry the engine's raw prices, so every worker's engine holds the
+    same state. If the producer dies, its lock is released and the first worker to grab it
+    becomes the next producer, continuing from the last tick.
+    """
+
+    def __init__(self, path: str, worker_id: int, workers: int, reconnect_delay: float = 0.2):
+        super().__init__()
+        self.path = path
+        self.worker_id = worker_id
+        self.workers = workers
+        self.reconnect_delay = reconnect_delay
+        self._lock_fd: Optional[int] = None
+        self._peers: Dict[int, asyncio.StreamWriter] = {}  # Hub only: worker_id -> connection
+        self._hub: Optional[asyncio.StreamWriter] = None  # Followers only: connection to the hub
+        self._last_tick: Optional[bytes] = None  # Hub only: sent to workers as they connect
+        self._ticks: Optional[asyncio.Queue] = None  # Created on the serving loop in start()
+        # Counters
+        self.ticks_received = 0
+        self.ticks_conflated = 0
+        self.messages_dropped = 0
+
+    @property
+    def is_producer(self) -> bool:
+        return self._lock_fd is not None
+
+    async def start(self):
+        self._ticks = asyncio.Queue(maxsize=_MAX_PENDING_TICKS)
+        asyncio.ensure_future(self._run())
+        asyncio.ensure_future(self._apply_ticks())
+
+    def publish_tick(self, tick: int, epoch_ms: int, raw_prices: np.ndarray):
+        prices = np.ascontiguousarray(raw_prices, dtype="<f8")
+        frame = _frame(_TICK, _TICK_HEADER.pack(tick, epoch_ms, len(prices)) + prices.tobytes())
+        self._last_tick = frame
+        for worker_id in list(self._peers):
+            self._write_peer(worker_id, frame)
+
+    def send(self, message: Dict[str, Any], to: int = BROADCAST):
+        if to == self.worker_id:
+            self._deliver(message)
+        elif self.is_producer:
+            self._route(_message_frame(message, to), to, sender=self.worker_id, message=message)
+        elif self._hub is not None:
+            self._hub.write(_message_frame(message, to))
+        else:  # Between producers
+            self.messages_dropped += 1
+
+    # --- Internals ---
+    async def _run(self):
+        while True:
+            if self._try_lock():
+                await self._serve()
+                return  # The producer keeps the lock until the process exits
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:  # Producer not up yet, or just died
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            writer.write(_frame(_HELLO, struct.pack("!i", self.worker_id)))
+            self._hub = writer
+            print(f"Worker {self.worker_id} following the tick bus at {self.path}")
+            try:
+                while True:
+                    kind, payload = await _read_frame(reader)
+                    if kind == _TICK:
+                        self._queue_tick(payload)
+                    elif kind == _MESSAGE:
+                        self._deliver(json.loads(payload[_MESSAGE_HEADER.size:]))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self._hub = None
+                writer.close()
+
+    def _try_lock(self) -> bool:
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _serve(self):
+        if os.path.exists(self.path):  # Left by a previous producer
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._serve_peer, path=self.path)
+        print(f"Worker {self.worker_id} is producing ticks on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            kind, payload = await _read_frame(reader)
+            if kind != _HELLO:
+                return
+            worker_id = struct.unpack("!i", payload)[0]
+            old = self._peers.pop(worker_id, None)
+            if old is not None:
+                old.close()
+            self._peers[worker_id] = writer
+            if self._last_tick is not None:  # Catch up before the next tick
+                writer.write(self._last_tick)
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind == _MESSAGE:
+                    to = _MESSAGE_HEADER.unpack_from(payload)[0]
+                    self._route(_frame(_MESSAGE, payload), to, sender=worker_id, payload=payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker_id is not None and self._peers.get(worker_id) is writer:
+                del self._peers[worker_id]
+            writer.close()
+
+    def _route(self, frame: bytes, to: int, sender: int, message: Optional[Dict[str, Any]] = None,
+               payload: Optional[bytes] = None):
+        if to == BROADCAST:
+            for worker_id in list(self._peers):
+                if worker_id != sender:
+                    self._write_peer(worker_id, frame)
+            if sender != self.worker_id:
+                self._deliver(message if message is not None else json.loads(payload[_MESSAGE_HEADER.size:]))
+        elif to == self.worker_id:
+            self._deliver(message if message is not None else json.loads(payload[_MESSAGE_HEADER.size:]))
+        elif to in self._peers:
+            self._write_peer(to, frame)
+        else:
+            self.messages_dropped += 1
+            message = message if message is not None else json.loads(payload[_MESSAGE_HEADER.size:])
+            if "id" in message:  # Let the sender fail a pending request now instead of timing out
+                self.send({"type": "undeliverable", "id": message["id"]}, to=sender)
+
+    def _write_peer(self, worker_id: int, frame: bytes):
+        writer = self._peers[worker_id]
+        if writer.transport.get_write_buffer_size() > _MAX_PEER_BUFFER:
+            print(f"Tick bus: dropping worker {worker_id}, which stopped reading")
+            del self._peers[worker_id]
+            writer.close()
+            return
+        writer.write(frame)
+
+    def _queue_tick(self, payload: bytes):
+        if self._ticks.full():
+            self._ticks.get_nowait()
+            self.ticks_conflated += 1
+        self._ticks.put_nowait(payload)
+
+    async def _apply_ticks(self):
+        """Applies received ticks one at a time, in order, off the socket reader's path."""
+        while True:
+            payload = await self._ticks.get()
+            tick, epoch_ms, count = _TICK_HEADER.unpack_from(payload)
+            raw_prices = np.frombuffer(payload, dtype="<f8", count=count, offset=_TICK_HEADER.size)
+            self.ticks_received += 1
+            if self.on_tick is not None:
+                try:
+                    await self.on_tick(tick, epoch_ms, raw_prices)
+                except Exception as e:  # Never let one bad tick stop the stream
+                    print(f"Tick bus: error applying tick {tick}: {e}")
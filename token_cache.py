@@ -0,0 +1,199 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import firebase_admin
+from firebase_admin import auth
+from google.auth import crypt
+from google.auth.transport import requests as google_requests
+
+# Public x509 certs Google signs Firebase ID tokens with (same URL firebase_admin uses internally)
+ID_TOKEN_CERT_URI = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+ID_TOKEN_ISSUER_PREFIX = "https://securetoken.google.com/"
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+class TokenVerifier:
+    """
+    Verifies Firebase ID tokens without blocking the event loop.
+
+    Verified claims are cached by SHA-256 of the raw token until the token's `exp`
+    claim, with LRU eviction once `max_entries` is reached. Cold verifications run in
+    a worker thread and check the RS256 signature locally against Google's public
+    certs, which `run_cert_refresher` keeps fresh in the background. Anything we
+    cannot check locally (no certs yet, unknown `kid`, emulator) falls back to
+    `firebase_admin.auth.verify_id_token`, so error types stay the same either way.
+    """
+
+    def __init__(self, max_entries: int = 10000, clock_skew_seconds: int = 0):
+        self.max_entries = max_entries
+        self.clock_skew_seconds = clock_skew_seconds
+        self._cache: "OrderedDict[bytes, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        self._verifiers: Dict[str, crypt.RSAVerifier] = {}  # kid -> verifier built from the cert PEM
+        self._certs_expire_at = 0.0
+        self._certs_pinned = False
+        self._project_id: Optional[str] = None
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.local_verifications = 0
+        self.fallback_verifications = 0
+        self.cold_seconds_total = 0.0  # Time spent in cold verifications (what every hit saves)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    # --- Public API ---
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """Returns decoded claims for `token`, raising the same errors as `auth.verify_id_token`."""
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        entry = self._cache.get(key)
+        if entry is not None:
+            claims, expires_at = entry
+            if expires_at > time.time():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return claims
+            del self._cache[key]
+
+        # Concurrent requests carrying the same cold token share one verification
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            started = time.perf_counter()
+            claims = await asyncio.to_thread(self._verify_cold, token)
+            self.cold_seconds_total += time.perf_counter() - started
+            self._store(key, claims)
+            future.set_result(claims)
+            return claims
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so an unawaited future doesn't log a warning
+            raise
+        finally:
+            del self._inflight[key]
+
+    def pin_certs(self, certs: Dict[str, str], project_id: str):
+        """
+        Trusts exactly these signing certs or public keys (kid -> PEM) for `project_id` and never
+        fetches Google's. For running without a Firebase project, e.g. benchmarks/loadtest.py.
+        """
+        self._verifiers = {kid: crypt.RSAVerifier.from_string(pem) for kid, pem in certs.items()}
+        self._certs_expire_at = float("inf")
+        self._certs_pinned = True
+        self._project_id = project_id
+
+    async def run_cert_refresher(self):
+        """Background task: keeps Google's signing certs cached, refreshing per their Cache-Control max-age."""
+        if self._certs_pinned:
+            return
+        while True:
+            try:
+                max_age = await asyncio.to_thread(self._refresh_certs)
+                delay = max(60.0, max_age * 0.9)  # Refresh a bit before Google rotates them
+            except Exception as e:
+                print(f"Token cert refresh failed, retrying in 30s: {e}")
+                delay = 30.0
+            await asyncio.sleep(delay)
+
+    # --- Internals ---
+    def _store(self, key: bytes, claims: Dict[str, Any]):
+        expires_at = float(claims.get("exp", 0))
+        if expires_at <= time.time():
+            return
+        self._cache[key] = (claims, expires_at)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _refresh_certs(self) -> float:
+        response = google_requests.Request()(ID_TOKEN_CERT_URI, method="GET")
+        if response.status != 200:
+            raise RuntimeError(f"cert endpoint returned HTTP {response.status}")
+        certs = json.loads(response.data.decode("utf-8"))
+        self._verifiers = {kid: crypt.RSAVerifier.from_string(pem) for kid, pem in certs.items()}
+        match = _MAX_AGE_RE.search(response.headers.get("cache-control", ""))
+        max_age = float(match.group(1)) if match else 3600.0
+        self._certs_expire_at = time.time() + max_age
+        return max_age
+
+    def _get_project_id(self) -> Optional[str]:
+        if self._project_id is None and firebase_admin._apps:
+            self._project_id = firebase_admin.get_app().project_id
+        return self._project_id
+
+    def _verify_cold(self, token: str) -> Dict[str, Any]:
+        """Runs in a worker thread. Local RS256 check when possible, SDK verification otherwise."""
+        project_id = self._get_project_id()
+        if project_id and not os.environ.get("FIREBASE_AUTH_EMULATOR_HOST"):
+            if not self._verifiers or self._certs_expire_at < time.time():
+                try:
+                    self._refresh_certs()
+                except Exception as e:
+                    print(f"Token cert refresh failed, falling back to SDK verification: {e}")
+            claims = self._verify_locally(token, project_id)
+            if claims is not None:
+                self.local_verifications += 1
+                return claims
+        self.fallback_verifications += 1
+        return auth.verify_id_token(token, clock_skew_seconds=self.clock_skew_seconds)
+
+    def _verify_locally(self, token: str, project_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Mirrors the checks `auth.verify_id_token` performs. Returns None when the signing
+        key is not in our cert cache so the caller can defer to the SDK.
+        """
+        try:
+            header_b64, payload_b64, signature_b64 = token.split(".")
+            header = json.loads(_b64url_decode(header_b64))
+            claims = json.loads(_b64url_decode(payload_b64))
+            signature = _b64url_decode(signature_b64)
+        except ValueError as e:
+            raise auth.InvalidIdTokenError(f"Malformed ID token: {e}", cause=e)
+
+        verifier = self._verifiers.get(header.get("kid"))
+        if verifier is None:
+            return None
+        if header.get("alg") != "RS256":
+            raise auth.InvalidIdTokenError(
+                f'Firebase ID token has incorrect algorithm. Expected "RS256" but got "{header.get("alg")}".')
+        if not verifier.verify(f"{header_b64}.{payload_b64}".encode("ascii"), signature):
+            raise auth.InvalidIdTokenError("Could not verify token signature.")
+
+        now = time.time()
+        skew = self.clock_skew_seconds
+        if not isinstance(claims.get("exp"), (int, float)) or not isinstance(claims.get("iat"), (int, float)):
+            raise auth.InvalidIdTokenError("Firebase ID token is missing the iat or exp claim.")
+        if now > claims["exp"] + skew:
+            raise auth.ExpiredIdTokenError(f"Token expired, {claims['exp']} < {int(now)}", cause=None)
+        if now < claims["iat"] - skew:
+            raise auth.InvalidIdTokenError(f"Token used too early, {int(now)} < {claims['iat']}.")
+        if claims.get("aud") != project_id:
+            raise auth.InvalidIdTokenError(
+                f'Firebase ID token has incorrect "aud" (audience) claim. Expected "{project_id}".')
+        if claims.get("iss") != ID_TOKEN_ISSUER_PREFIX + project_id:
+            raise auth.InvalidIdTokenError('Firebase ID token has incorrect "iss" (issuer) claim.')
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise auth.InvalidIdTokenError('Firebase ID token has an invalid "sub" (subject) claim.')
+
+        claims["uid"] = subject
+        return claims
@@ -0,0 +1,117 @@
+from typing import Any, Dict, List, Set, Tuple
+
+from market_engine import MarketSnapshot
+from positions import PositionStore
+
+
+class UserValuation:
+    """Running per-user aggregates. P&L is derived, so only two floats are maintained."""
+
+    __slots__ = ("total_value", "cost_basis")
+
+    def __init__(self):
+        self.total_value = 0.0
+        self.cost_basis = 0.0
+
+    def summary(self) -> Dict[str, float]:
+        unrealized_pnl = self.total_value - self.cost_basis
+        return {
+            "total_value": self.total_value,
+            "cost_basis": self.cost_basis,
+            "unrealized_pnl": unrealized_pnl,
+            "unrealized_pnl_percent": (unrealized_pnl / self.cost_basis) * 100 if self.cost_basis != 0 else 0.0,
+        }
+
+
+class ValuationEngine:
+    """
+    Keeps every user's portfolio valuation current without recomputing it per request.
+
+    A reverse index (asset -> holders) means a price tick only touches users holding a
+    symbol whose price changed, and each of their totals moves by quantity * price delta.
+    All aggregates are marked against the same per-asset prices (`_marks`), which always
+    match the last applied snapshot. A user's aggregate is rebuilt from scratch whenever
+    one of their positions changes, which also clears any accumulated float drift.
+    """
+
+    def __init__(self, positions: PositionStore, snapshot: MarketSnapshot):
+        self.positions = positions
+        self.snapshot = snapshot
+        self.holders: Dict[str, Set[str]] = {}  # asset_id -> firebase_uids holding it
+        self._marks: Dict[str, float] = {}  # asset_id -> price the aggregates are valued at
+        self._valuations: Dict[str, UserValuation] = {}
+
+    def position_changed(self, firebase_uid: str, asset_id: str):
+        """Call after any buy/sell so the reverse index and the user's aggregate stay correct."""
+        if self.positions.get(firebase_uid, asset_id) is not None:
+            self.holders.setdefault(asset_id, set()).add(firebase_uid)
+        else:
+            holders = self.holders.get(asset_id)
+            if holders is not None:
+                holders.discard(firebase_uid)
+                if not holders:
+                    del self.holders[asset_id]
+                    self._marks.pop(asset_id, None)
+        self._revalue_user(firebase_uid)
+
+    def apply_snapshot(self, snapshot: MarketSnapshot) -> Set[str]:
+        """Moves aggregates to the new tick's prices and returns the users whose valuation changed."""
+        self.snapshot = snapshot
+        changed_users: Set[str] = set()
+        index, prices, price_changed = snapshot.index, snapshot.prices, snapshot.price_changed
+        for asset_id, holders in self.holders.items():
+            i = index.get(asset_id)
+            if i is None or not price_changed[i]:
+                continue
+            new_price = float(prices[i])
+            delta = new_price - self._marks[asset_id]
+            self._marks[asset_id] = new_price
+            for firebase_uid in holders:
+                self._valuations[firebase_uid].total_value += self.positions.get(firebase_uid, asset_id).quantity * delta
+            changed_users |= holders
+        return changed_users
+
+    def summary(self, firebase_uid: str) -> Dict[str, float]:
+        valuation = self._valuations.get(firebase_uid)
+        return (valuation or UserValuation()).summary()
+
+    def portfolio(self, firebase_uid: str) -> Tuple[List[Dict[str, Any]], Dict[str, float]]:
+        """Per-holding rows (the PortfolioItem fields) plus the user's aggregate summary."""
+        items = []
+        for position in self.positions.holdings(firebase_uid):
+            current_price = self._mark(position.asset_id, position.average_buy_price)
+            cost_basis = position.cost_basis
+            unrealized_pnl = (current_price - position.average_buy_price) * position.quantity
+            items.append({
+                "asset_id": position.asset_id,
+                "quantity": position.quantity,
+                "average_buy_price": position.average_buy_price,
+                "current_price": current_price,
+                "current_value": position.quantity * current_price,
+                "unrealized_pnl": unrealized_pnl,
+                "unrealized_pnl_percent": (unrealized_pnl / cost_basis) * 100 if cost_basis != 0 else 0.0,
+            })
+        return items, self.summary(firebase_uid)
+
+    # --- Internals ---
+    def _mark(self, asset_id: str, fallback: float) -> float:
+        price = self._marks.get(asset_id)
+        if price is None:
+            price = self.snapshot.price(asset_id)
+            if price is None:  # Not in the market: value at the average buy price
+                return fallback
+            if asset_id in self.holders:
+                self._marks[asset_id] = price
+        return price
+
+    def _revalue_user(self, firebase_uid: str):
+        valuation = UserValuation()
+        holds_anything = False
+        for position in self.positions.holdings(firebase_uid):
+            holds_anything = True
+            valuation.total_value += position.quantity * self._mark(position.asset_id, position.average_buy_price)
+            valuation.cost_basis += position.cost_basis
+        if holds_anything:
+            self._valuations[firebase_uid] = valuation
+        else:
+            self._valuations.pop(firebase_uid, None)
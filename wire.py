@@ -0,0 +1,201 @@
+import inspect
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import msgpack
+import orjson
+from fastapi import routing
+from fastapi.datastructures import Default
+from fastapi.responses import JSONResponse
+
+if TYPE_CHECKING:
+    from market_engine import MarketSnapshot
+
+MSGPACK_SUBPROTOCOL = "novatrade.msgpack.v1"
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact JSON as bytes (orjson; numpy scalars and arrays are accepted as-is)."""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+def decode_message(data: Union[str, bytes]) -> Any:
+    """A client's WebSocket message: JSON in text frames, msgpack in binary frames."""
+    if isinstance(data, str):
+        return orjson.loads(data)
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except ValueError as e:  # msgpack's errors often have no message of their own
+        raise ValueError(f"not valid msgpack ({type(e).__name__})") from e
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _fastapi_dumps_json() -> bool:
+    """Whether FastAPI serializes `response_model` routes straight to JSON bytes with pydantic."""
+    return "dump_json" in inspect.signature(routing.serialize_response).parameters
+
+
+# For FastAPI(default_response_class=...). Older FastAPI renders every response with
+# jsonable_encoder + json.dumps, so orjson is several times faster there. Newer FastAPI
+# skips both with pydantic's own serializer (faster still), but only while the response
+# class is its default, so that is kept where available.
+DEFAULT_RESPONSE_CLASS = Default(JSONResponse) if _fastapi_dumps_json() else ORJSONResponse
+
+
+class JSONCodec:
+    """
+    Text frames of JSON: the default WebSocket protocol, and the one index.html speaks.
+
+    A codec encodes every message the ConnectionManager sends. Market updates are built
+    from per-symbol fragments that are encoded once per tick and shared by every client
+    using the codec: `delta_fragments` -> `join` (per subscription) -> `update` (per client).
+    """
+
+    subprotocol: Optional[str] = None
+    binary = False
+
+    def __init__(self):
+        self._symbol_json: Dict[str, str] = {}
+
+    def encode(self, message: Dict[str, Any]) -> str:
+        return orjson.dumps(message).decode()
+
+    def greeting(self, snapshot: "MarketSnapshot") -> Optional[str]:
+        """Sent once before anything else on a new connection, if not None."""
+        return None
+
+    def snapshot(self, seq: int, snapshot: "MarketSnapshot", symbols: Optional[Iterable[str]] = None) -> str:
+        data = snapshot.rows() if symbols is None else snapshot.rows_for(symbols)
+        return self.encode({"type": "market_snapshot", "seq": seq, "tick": snapshot.tick, "data": data})
+
+    def delta_fragments(self, snapshot: "MarketSnapshot", indices: Sequence[int],
+                        full: bool = False) -> Dict[str, str]:
+        """One encoded delta row per changed symbol, with only the fields that changed (every field if `full`)."""
+        symbols = snapshot.symbols
+        prices, changes = snapshot.prices.tolist(), snapshot.change_24h.tolist()  # Plain floats encode much faster
+        price_changed, change_changed = _change_masks(snapshot, full)
+        fragments: Dict[str, str] = {}
+        for i in indices:
+            symbol = symbols[i]
+            symbol_json = self._symbol_json.get(symbol)
+            if symbol_json is None:
+                symbol_json = self._symbol_json[symbol] = orjson.dumps(symbol).decode()
+            if price_changed[i] and change_changed[i]:
+                fragments[symbol] = f'{{"symbol":{symbol_json},"price":{prices[i]!r},"change_24h":{changes[i]!r}}}'
+            elif price_changed[i]:
+                fragments[symbol] = f'{{"symbol":{symbol_json},"price":{prices[i]!r}}}'
+            else:
+                fragments[symbol] = f'{{"symbol":{symbol_json},"change_24h":{changes[i]!r}}}'
+        return fragments
+
+    def join(self, fragments: List[str]) -> str:
+        return ",".join(fragments)
+
+    def update_header(self, snapshot: "MarketSnapshot") -> str:
+        return f',"tick":{snapshot.tick},"timestamp":"{snapshot.timestamp}","data":['
+
+    def update(self, seq: int, header: str, body: str) -> str:
+        return f'{{"type":"market_update","seq":{seq}{header}{body}]}}'
+
+
+class MsgpackCodec(JSONCodec):
+    """
+    Binary msgpack frames, for clients that ask for the "novatrade.msgpack.v1" subprotocol.
+
+    Messages are the JSON ones with compact market data: the first message is
+    {"type": "symbols", "symbols": [...]} and rows refer to a symbol by its index in that
+    list. Timestamps are epoch milliseconds in "ts", and rows are arrays:
+        market_snapshot data: [[symbol_id, price, change_24h], ...]
+        market_update data:   [[symbol_id, price or nil, change_24h or nil], ...]  (nil = unchanged)
+    Clients may send their messages as msgpack or as JSON text.
+    """
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def __init__(self):
+        super().__init__()
+        self._greeting: Optional[Tuple[tuple, bytes]] = None  # (symbols, encoded "symbols" message)
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def greeting(self, snapshot: "MarketSnapshot") -> bytes:
+        if self._greeting is None or self._greeting[0] is not snapshot.symbols:  # The symbol list never changes
+            self._greeting = (snapshot.symbols, self.encode({"type": "symbols", "symbols": list(snapshot.symbols)}))
+        return self._greeting[1]
+
+    def snapshot(self, seq: int, snapshot: "MarketSnapshot", symbols: Optional[Iterable[str]] = None) -> bytes:
+        prices, changes = snapshot.prices.tolist(), snapshot.change_24h.tolist()
+        if symbols is None:
+            ids: Iterable[int] = range(len(prices))
+        else:
+            index = snapshot.index
+            ids = [index[s] for s in symbols if s in index]
+        return self.encode({"type": "market_snapshot", "seq": seq, "tick": snapshot.tick, "ts": snapshot.epoch_ms,
+                            "data": [[i, prices[i], changes[i]] for i in ids]})
+
+    def delta_fragments(self, snapshot: "MarketSnapshot", indices: Sequence[int],
+                        full: bool = False) -> Dict[str, bytes]:
+        symbols = snapshot.symbols
+        prices, changes = snapshot.prices.tolist(), snapshot.change_24h.tolist()
+        price_changed, change_changed = _change_masks(snapshot, full)
+        packb = msgpack.packb
+        return {symbols[i]: packb([i, prices[i] if price_changed[i] else None,
+                                   changes[i] if change_changed[i] else None]) for i in indices}
+
+    def join(self, fragments: List[bytes]) -> bytes:
+        return _array_header(len(fragments)) + b"".join(fragments)
+
+    def update_header(self, snapshot: "MarketSnapshot") -> bytes:
+        packb = msgpack.packb
+        return packb("tick") + packb(snapshot.tick) + packb("ts") + packb(snapshot.epoch_ms) + packb("data")
+
+    def update(self, seq: int, header: bytes, body: bytes) -> bytes:
+        return b"".join((_UPDATE_PREFIX, _uint(seq), header, body))  # Runs per client, so no packb here
+
+
+def _change_masks(snapshot: "MarketSnapshot", full: bool) -> Tuple[Sequence[bool], Sequence[bool]]:
+    if full:  # Rows folding several ticks together: every field, changed in this tick or not
+        everything = [True] * len(snapshot.symbols)
+        return everything, everything
+    return snapshot.price_changed.tolist(), snapshot.change_changed.tolist()
+
+
+# A 5-entry map: type, seq, tick, ts, data
+_UPDATE_PREFIX = b"\x85" + msgpack.packb("type") + msgpack.packb("market_update") + msgpack.packb("seq")
+
+
+def _uint(value: int) -> bytes:
+    if value < 0x80:
+        return bytes((value,))
+    if value < 0x10000:
+        return (b"\xcc" + bytes((value,))) if value < 0x100 else b"\xcd" + value.to_bytes(2, "big")
+    if value < 0x100000000:
+        return b"\xce" + value.to_bytes(4, "big")
+    return b"\xcf" + value.to_bytes(8, "big")
+
+
+def _array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 0x10000:
+        return b"\xdc" + length.to_bytes(2, "big")
+    return b"\xdd" + length.to_bytes(4, "big")
+
+
+JSON_CODEC = JSONCodec()
+# Opt-in WebSocket codecs by subprotocol; a client offering none of these gets JSON_CODEC
+CODECS: Dict[str, JSONCodec] = {MSGPACK_SUBPROTOCOL: MsgpackCodec()}
+
+
+def negotiate(subprotocols: Iterable[str]) -> JSONCodec:
+    """The codec for the first subprotocol the client offered that we support."""
+    for subprotocol in subprotocols:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return JSON_CODEC